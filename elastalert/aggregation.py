@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+import collections
+import json
+import os
+import tempfile
+import threading
+
+from .alerts import DateTimeEncoder
+from .util import elastalert_logger
+
+
+class AggregationBuffer(object):
+    """ Holds the matches of a rule's aggregations which could not be written to the writeback index, by
+    aggregation key, until they are sent.
+
+    At most max_matches matches are kept in memory. Beyond that, the in-memory matches of the aggregation key
+    with the most of them are appended to a temporary file in spill_dir, and read back when the aggregation is
+    sent, so that a long writeback outage does not use up all memory. Spilled matches are stored as JSON, so
+    the datetimes they hold are read back as timestamp strings.
+
+    :param max_matches: The maximum number of matches to keep in memory.
+    :param spill_dir: The directory of the temporary files, or None for the system default.
+    """
+
+    def __init__(self, max_matches=10000, spill_dir=None):
+        self.max_matches = max_matches
+        self.spill_dir = spill_dir
+        self.lock = threading.Lock()
+        self.buffers = collections.OrderedDict()
+        self.spill_files = {}
+        self.spill_counts = collections.Counter()
+        self.in_memory = 0
+
+    def __len__(self):
+        with self.lock:
+            return self.in_memory + sum(self.spill_counts.values())
+
+    def keys(self):
+        """ Returns the aggregation keys which have matches. """
+        with self.lock:
+            keys = list(self.buffers)
+            keys.extend(key for key in self.spill_files if key not in self.buffers)
+        return keys
+
+    def add(self, aggregation_key_value, match):
+        with self.lock:
+            self.buffers.setdefault(aggregation_key_value, []).append(match)
+            self.in_memory += 1
+            if self.in_memory > self.max_matches:
+                self.spill(max(self.buffers, key=lambda key: len(self.buffers[key])))
+
+    def spill(self, aggregation_key_value):
+        """ Appends the in-memory matches of an aggregation key to its file. Must hold lock. """
+        matches = self.buffers.pop(aggregation_key_value)
+        path = self.spill_files.get(aggregation_key_value)
+        if path is None:
+            path = self.spill_files[aggregation_key_value] = self.new_spill_file()
+        elastalert_logger.warning('Spilling %d aggregated matches (aggregation_key: %s) to %s' % (
+            len(matches), aggregation_key_value, path))
+        with open(path, 'a') as spill_file:
+            for match in matches:
+                spill_file.write(json.dumps(match, cls=DateTimeEncoder) + '\n')
+        self.spill_counts[aggregation_key_value] += len(matches)
+        self.in_memory -= len(matches)
+
+    def new_spill_file(self):
+        fd, path = tempfile.mkstemp(prefix='elastalert_aggregation_', suffix='.json', dir=self.spill_dir)
+        os.close(fd)
+        return path
+
+    def pop(self, aggregation_key_value):
+        """ Removes and returns the matches of an aggregation key, oldest first. """
+        with self.lock:
+            matches = []
+            path = self.spill_files.pop(aggregation_key_value, None)
+            if path is not None:
+                with open(path) as spill_file:
+                    matches.extend(json.loads(line) for line in spill_file)
+                os.remove(path)
+                del self.spill_counts[aggregation_key_value]
+            in_memory = self.buffers.pop(aggregation_key_value, [])
+            self.in_memory -= len(in_memory)
+            matches.extend(in_memory)
+        return matches
+
+    def drain(self, write):
+        """ Removes the matches one at a time, oldest first for each aggregation key, and passes them to write,
+        until write returns a false value. The matches which were not passed to write are kept. Spilled matches
+        are read back one at a time, so retrying a large backlog does not load it into memory. Matches may be
+        added while the buffer is drained, and write may add the match it fails to write back. """
+        for aggregation_key_value in self.keys():
+            with self.lock:
+                path = self.spill_files.pop(aggregation_key_value, None)
+                count = self.spill_counts.pop(aggregation_key_value, 0)
+                matches = self.buffers.pop(aggregation_key_value, [])
+                self.in_memory -= len(matches)
+            rest_path = None
+            if path is not None:
+                failed = False
+                with open(path) as spill_file:
+                    for line in spill_file:
+                        count -= 1
+                        if not write(json.loads(line)):
+                            failed = True
+                            if count:
+                                # Keep the rest of the file
+                                rest_path = self.new_spill_file()
+                                with open(rest_path, 'w') as rest_file:
+                                    rest_file.writelines(spill_file)
+                            break
+                os.remove(path)
+                if failed:
+                    self.restore(aggregation_key_value, rest_path, count, matches)
+                    return
+            for i, match in enumerate(matches):
+                if not write(match):
+                    self.restore(aggregation_key_value, None, 0, matches[i + 1:])
+                    return
+
+    def restore(self, aggregation_key_value, path, count, matches):
+        """ Puts back matches taken by drain, before those added since. The spilled matches are read before the
+        in-memory ones, so if matches added since were spilled, the restored matches are put in front of them in
+        the file. """
+        with self.lock:
+            new_path = self.spill_files.get(aggregation_key_value)
+            if new_path is not None:
+                if path is None:
+                    path = self.new_spill_file()
+                with open(new_path) as new_file, open(path, 'a') as spill_file:
+                    for match in matches:
+                        spill_file.write(json.dumps(match, cls=DateTimeEncoder) + '\n')
+                    for line in new_file:
+                        spill_file.write(line)
+                os.remove(new_path)
+                count += len(matches)
+                matches = []
+            if path is not None:
+                self.spill_files[aggregation_key_value] = path
+                self.spill_counts[aggregation_key_value] += count
+            if matches:
+                self.buffers[aggregation_key_value] = matches + self.buffers.get(aggregation_key_value, [])
+                self.in_memory += len(matches)
@@ -1,22 +1,28 @@
 # -*- coding: utf-8 -*-
 import copy
 import datetime
+import functools
 import json
 import logging
+import operator
 import os
 import re
 import subprocess
 import sys
+import threading
 import time
 import uuid
 import warnings
 from email.mime.text import MIMEText
 from email.utils import formatdate
 from html.parser import HTMLParser
+from http.cookiejar import DefaultCookiePolicy
+from json.encoder import encode_basestring
 from smtplib import SMTP
 from smtplib import SMTP_SSL
 from smtplib import SMTPAuthenticationError
 from smtplib import SMTPException
+from smtplib import SMTPServerDisconnected
 from socket import error
 
 import boto3
@@ -31,12 +37,16 @@ from staticconf.loader import yaml_loader
 from texttable import Texttable
 from twilio.base.exceptions import TwilioRestException
 from twilio.rest import Client as TwilioClient
+from urllib.parse import urlparse
+from urllib3.util.retry import Retry
 
 from .util import EAException
 from .util import elastalert_logger
+from .util import compile_es_key
 from .util import lookup_es_key
 from .util import pretty_ts
 from .util import resolve_string
+from .util import TTLCache
 from .util import ts_now
 from .util import ts_to_dt
 
@@ -49,6 +59,165 @@ class DateTimeEncoder(json.JSONEncoder):
             return json.JSONEncoder.default(self, obj)
 
 
+class AlertTemplate(object):
+    """ A format string, such as alert_text or alert_subject, whose arguments are looked up in each match.
+    The lookups are compiled once, by get_alert_template, and reused for every match rendered with it.
+
+    :param text: The format string.
+    :param args: A list of the fields filling its positional arguments, or None.
+    :param kw: A tuple of (field, keyword) pairs filling its keyword arguments, or None.
+    """
+
+    def __init__(self, text, args=None, kw=None):
+        self.text = text
+        self.args = args
+        self.kw = kw
+        self.arg_lookups = [(arg, compile_es_key(arg)) for arg in args or []]
+        self.kw_lookups = [(name, kw_name, compile_es_key(name)) for name, kw_name in kw or []]
+
+    def render(self, match, rule, missing='<MISSING VALUE>'):
+        # Support referencing other top-level rule properties
+        # This technically may not work if there is a top-level rule property with the same name
+        # as an es result key, since it would have been matched in the lookup above
+        if self.args is not None:
+            values = []
+            for arg, lookup in self.arg_lookups:
+                value = lookup(match)
+                if value is None:
+                    value = rule.get(arg) or None
+                values.append(missing if value is None else value)
+            return self.text.format(*values)
+        if self.kw is not None:
+            kw = {}
+            for name, kw_name, lookup in self.kw_lookups:
+                value = lookup(match)
+                if value is None:
+                    value = rule.get(name)
+                kw[kw_name] = missing if value is None else value
+            return self.text.format(**kw)
+        return self.text
+
+
+@functools.lru_cache(maxsize=1024)
+def _get_alert_template(text, args, kw):
+    return AlertTemplate(text, args, kw)
+
+
+def get_alert_template(text, args=None, kw=None):
+    """ Returns the compiled AlertTemplate for a format string and its argument fields, shared by every rule using it. """
+    return _get_alert_template(str(text), tuple(args) if args is not None else None,
+                               tuple(kw.items()) if kw is not None else None)
+
+
+def pretty_print_json(blob, level=0):
+    """ Returns the same string as json.dumps(blob, cls=DateTimeEncoder, sort_keys=True, indent=4, ensure_ascii=False)
+    for JSON types and dates, without the overhead of the pure Python encoder json.dumps uses when indenting.
+    Raises TypeError for other types. """
+    if isinstance(blob, str):
+        return encode_basestring(blob)
+    if blob is None:
+        return 'null'
+    if blob is True:
+        return 'true'
+    if blob is False:
+        return 'false'
+    if isinstance(blob, int):
+        return int.__repr__(blob)
+    if isinstance(blob, float):
+        if blob != blob:
+            return 'NaN'
+        if blob in (float('inf'), float('-inf')):
+            return 'Infinity' if blob > 0 else '-Infinity'
+        return float.__repr__(blob)
+    if isinstance(blob, (list, tuple)):
+        if not blob:
+            return '[]'
+        indent = '\n' + '    ' * (level + 1)
+        return '[' + indent + (',' + indent).join([pretty_print_json(value, level + 1) for value in blob]) + \
+            '\n' + '    ' * level + ']'
+    if isinstance(blob, dict):
+        if not blob:
+            return '{}'
+        if not all(isinstance(key, str) for key in blob):
+            raise TypeError('Keys must be strings')
+        indent = '\n' + '    ' * (level + 1)
+        items = [encode_basestring(key) + ': ' + pretty_print_json(value, level + 1) for key, value in sorted(blob.items())]
+        return '{' + indent + (',' + indent).join(items) + '\n' + '    ' * level + '}'
+    if hasattr(blob, 'isoformat'):
+        return encode_basestring(blob.isoformat())
+    raise TypeError('Object of type %s is not JSON serializable' % (type(blob).__name__))
+
+
+class AggregationSummary(object):
+    """ Counts the matches of an aggregated alert by their values of summary_table_fields, and renders them as a table.
+
+    Matches can be added as they are aggregated, and the table is rendered once for each width and shared by the alerters.
+    At most max_rows distinct values are kept, matches with other values are counted in a last row of <OTHER>.
+
+    :param fields: The summary_table_fields of the rule.
+    :param max_rows: The maximum number of rows, or None for no limit.
+    :param written: If true, dates are shown as they are written to the writeback index, for matches which are
+        added as they are aggregated, so that they look the same as those read back from it.
+    """
+
+    # The summary_table_max_rows of rules which do not set it
+    default_max_rows = 1000
+
+    def __init__(self, fields, max_rows=None, written=False):
+        self.fields = fields
+        self.max_rows = max_rows
+        self.written = written
+        self.lookups = [compile_es_key(field) for field in fields]
+        self.counts = {}
+        self.other = 0
+        self.total = 0
+        self.alert_time = None
+        self.tables = {}
+
+    @classmethod
+    def from_rule(cls, rule, written=False):
+        fields = rule['summary_table_fields']
+        if not isinstance(fields, list):
+            fields = [fields]
+        return cls(fields, rule.get('summary_table_max_rows', cls.default_max_rows), written)
+
+    def add(self, match):
+        """ Counts a match. """
+        values = [lookup(match) for lookup in self.lookups]
+        if self.written:
+            values = [value.isoformat() if isinstance(value, datetime.datetime) else value for value in values]
+        key_tuple = tuple([str(value) for value in values])
+        if key_tuple in self.counts:
+            self.counts[key_tuple] += 1
+        elif self.max_rows is None or len(self.counts) < self.max_rows:
+            self.counts[key_tuple] = 1
+        else:
+            self.other += 1
+        self.total += 1
+        self.tables.clear()
+
+    def add_matches(self, matches):
+        for match in matches:
+            self.add(match)
+        return self
+
+    def render(self, max_width):
+        """ Returns the table, drawn at most max_width characters wide. """
+        if max_width not in self.tables:
+            # Include a count aggregation so that we can see at a glance how many of each aggregation_key were encountered
+            fields_with_count = self.fields + ['count']
+            text_table = Texttable(max_width=max_width)
+            text_table.header(fields_with_count)
+            # Format all fields as 'text' to avoid long numbers being shown as scientific notation
+            text_table.set_cols_dtype(['t' for i in fields_with_count])
+            for keys, count in self.counts.items():
+                text_table.add_row([key for key in keys] + [count])
+            if self.other:
+                text_table.add_row(['<OTHER>' for field in self.fields] + [self.other])
+            self.tables[max_width] = text_table.draw()
+        return self.tables[max_width]
+
+
 class BasicMatchString(object):
     """ Creates a string containing fields in match for the given rule. """
 
@@ -56,89 +225,69 @@ class BasicMatchString(object):
         self.rule = rule
         self.match = match
 
+    def _write(self, text):
+        self.parts.append(text)
+
     def _ensure_new_line(self):
-        while self.text[-2:] != '\n\n':
-            self.text += '\n'
+        tail = ''
+        for part in reversed(self.parts):
+            tail = part + tail
+            if len(tail) >= 2:
+                break
+        tail = tail[-2:]
+        while tail != '\n\n':
+            self._write('\n')
+            tail = (tail + '\n')[-2:]
 
     def _add_custom_alert_text(self):
         missing = self.rule.get('alert_missing_value', '<MISSING VALUE>')
-        alert_text = str(self.rule.get('alert_text', ''))
-        if 'alert_text_args' in self.rule:
-            alert_text_args = self.rule.get('alert_text_args')
-            alert_text_values = [lookup_es_key(self.match, arg) for arg in alert_text_args]
-
-            # Support referencing other top-level rule properties
-            # This technically may not work if there is a top-level rule property with the same name
-            # as an es result key, since it would have been matched in the lookup_es_key call above
-            for i, text_value in enumerate(alert_text_values):
-                if text_value is None:
-                    alert_value = self.rule.get(alert_text_args[i])
-                    if alert_value:
-                        alert_text_values[i] = alert_value
-
-            alert_text_values = [missing if val is None else val for val in alert_text_values]
-            alert_text = alert_text.format(*alert_text_values)
-        elif 'alert_text_kw' in self.rule:
-            kw = {}
-            for name, kw_name in list(self.rule.get('alert_text_kw').items()):
-                val = lookup_es_key(self.match, name)
-
-                # Support referencing other top-level rule properties
-                # This technically may not work if there is a top-level rule property with the same name
-                # as an es result key, since it would have been matched in the lookup_es_key call above
-                if val is None:
-                    val = self.rule.get(name)
-
-                kw[kw_name] = missing if val is None else val
-            alert_text = alert_text.format(**kw)
-
-        self.text += alert_text
+        template = get_alert_template(self.rule.get('alert_text', ''), self.rule.get('alert_text_args'),
+                                      self.rule.get('alert_text_kw') if 'alert_text_args' not in self.rule else None)
+        self._write(template.render(self.match, self.rule, missing))
 
     def _add_rule_text(self):
-        self.text += self.rule['type'].get_match_str(self.match)
+        self._write(self.rule['type'].get_match_str(self.match))
 
     def _add_top_counts(self):
         for key, counts in list(self.match.items()):
             if key.startswith('top_events_'):
-                self.text += '%s:\n' % (key[11:])
+                self._write('%s:\n' % (key[11:]))
                 top_events = list(counts.items())
 
                 if not top_events:
-                    self.text += 'No events found.\n'
+                    self._write('No events found.\n')
                 else:
                     top_events.sort(key=lambda x: x[1], reverse=True)
                     for term, count in top_events:
-                        self.text += '%s: %s\n' % (term, count)
+                        self._write('%s: %s\n' % (term, count))
 
-                self.text += '\n'
+                self._write('\n')
 
     def _add_match_items(self):
-        match_items = list(self.match.items())
-        match_items.sort(key=lambda x: x[0])
-        for key, value in match_items:
+        for key, value in sorted(self.match.items(), key=operator.itemgetter(0)):
             if key.startswith('top_events_'):
                 continue
-            value_str = str(value)
-            value_str.replace('\\n', '\n')
             if type(value) in [list, dict]:
                 try:
                     value_str = self._pretty_print_as_json(value)
                 except TypeError:
                     # Non serializable object, fallback to str
-                    pass
-            self.text += '%s: %s\n' % (key, value_str)
+                    value_str = str(value)
+            else:
+                value_str = str(value)
+            self._write('%s: %s\n' % (key, value_str))
 
     def _pretty_print_as_json(self, blob):
         try:
+            return pretty_print_json(blob)
+        except (TypeError, ValueError, RecursionError):
+            # Let json report the error, or handle the types it supports which pretty_print_json does not
             return json.dumps(blob, cls=DateTimeEncoder, sort_keys=True, indent=4, ensure_ascii=False)
-        except UnicodeDecodeError:
-            # This blob contains non-unicode, so lets pretend it's Latin-1 to show something
-            return json.dumps(blob, cls=DateTimeEncoder, sort_keys=True, indent=4, encoding='Latin-1', ensure_ascii=False)
 
     def __str__(self):
-        self.text = ''
+        self.parts = []
         if 'alert_text' not in self.rule:
-            self.text += self.rule['name'] + '\n\n'
+            self._write(self.rule['name'] + '\n\n')
 
         self._add_custom_alert_text()
         self._ensure_new_line()
@@ -149,7 +298,7 @@ class BasicMatchString(object):
                 self._add_top_counts()
             if self.rule.get('alert_text_type') != 'exclude_fields':
                 self._add_match_items()
-        return self.text
+        return ''.join(self.parts)
 
 
 class JiraFormattedMatchString(BasicMatchString):
@@ -157,7 +306,32 @@ class JiraFormattedMatchString(BasicMatchString):
         match_items = dict([(x, y) for x, y in list(self.match.items()) if not x.startswith('top_events_')])
         json_blob = self._pretty_print_as_json(match_items)
         preformatted_text = '{{code}}{0}{{code}}'.format(json_blob)
-        self.text += preformatted_text
+        self._write(preformatted_text)
+
+
+class HTTPSession(requests.Session):
+    """ A requests session which keeps connections to an endpoint alive and retries failed connections.
+    Requests which do not set a timeout use the session's, and cookies are not kept between requests.
+
+    :param timeout: The default (connect, read) timeout.
+    :param pool_maxsize: The maximum number of connections kept alive.
+    :param retries: The number of times to retry a failed connection.
+    """
+
+    def __init__(self, timeout, pool_maxsize=10, retries=3):
+        super(HTTPSession, self).__init__()
+        self.timeout = timeout
+        self.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        # Only idempotent requests are retried after the request was sent, so alerts are not sent twice
+        retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504))
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, max_retries=retry)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super(HTTPSession, self).request(method, url, **kwargs)
 
 
 class Alerter(object):
@@ -166,6 +340,11 @@ class Alerter(object):
     :param rule: The rule configuration.
     """
     required_options = frozenset([])
+    # Alerters which store values in the pipeline for the alerters after them
+    writes_pipeline = False
+    # HTTP sessions shared by every alerter, by endpoint and options
+    http_sessions = {}
+    http_sessions_lock = threading.Lock()
 
     def __init__(self, rule):
         self.rule = rule
@@ -213,6 +392,26 @@ class Alerter(object):
         a field type corresponding to the type of Alerter. """
         return {'type': 'Unknown'}
 
+    def close(self):
+        """ Sends what the alerter still holds, such as batched values, when ElastAlert stops. """
+        pass
+
+    def get_http_session(self, url):
+        """ Returns the HTTP session used to send requests to url, so that connections to it are reused. """
+        endpoint = urlparse(url)
+        timeout = (self.rule.get('http_connect_timeout', 10), self.rule.get('http_read_timeout', 30))
+        pool_maxsize = self.rule.get('http_pool_maxsize', 10)
+        retries = self.rule.get('http_retries', 3)
+        key = (endpoint.scheme, endpoint.netloc, timeout, pool_maxsize, retries)
+        with self.http_sessions_lock:
+            if key not in self.http_sessions:
+                self.http_sessions[key] = HTTPSession(timeout, pool_maxsize, retries)
+            return self.http_sessions[key]
+
+    def http_post(self, url, *args, **kwargs):
+        """ Sends a POST request to url with its HTTP session, taking the same arguments as requests.post. """
+        return self.get_http_session(url).post(url, *args, **kwargs)
+
     def create_title(self, matches):
         """ Creates custom alert title to be used, e.g. as an e-mail subject or JIRA issue summary.
 
@@ -224,25 +423,10 @@ class Alerter(object):
         return self.create_default_title(matches)
 
     def create_custom_title(self, matches):
-        alert_subject = str(self.rule['alert_subject'])
         alert_subject_max_len = int(self.rule.get('alert_subject_max_len', 2048))
-
-        if 'alert_subject_args' in self.rule:
-            alert_subject_args = self.rule['alert_subject_args']
-            alert_subject_values = [lookup_es_key(matches[0], arg) for arg in alert_subject_args]
-
-            # Support referencing other top-level rule properties
-            # This technically may not work if there is a top-level rule property with the same name
-            # as an es result key, since it would have been matched in the lookup_es_key call above
-            for i, subject_value in enumerate(alert_subject_values):
-                if subject_value is None:
-                    alert_value = self.rule.get(alert_subject_args[i])
-                    if alert_value:
-                        alert_subject_values[i] = alert_value
-
-            missing = self.rule.get('alert_missing_value', '<MISSING VALUE>')
-            alert_subject_values = [missing if val is None else val for val in alert_subject_values]
-            alert_subject = alert_subject.format(*alert_subject_values)
+        missing = self.rule.get('alert_missing_value', '<MISSING VALUE>')
+        template = get_alert_template(self.rule['alert_subject'], self.rule.get('alert_subject_args'))
+        alert_subject = template.render(matches[0], self.rule, missing)
 
         if len(alert_subject) > alert_subject_max_len:
             alert_subject = alert_subject[:alert_subject_max_len]
@@ -250,47 +434,38 @@ class Alerter(object):
         return alert_subject
 
     def create_alert_body(self, matches):
-        body = self.get_aggregation_summary_text(matches)
+        body = [self.get_aggregation_summary_text(matches)]
         if self.rule.get('alert_text_type') != 'aggregation_summary_only':
             for match in matches:
-                body += str(BasicMatchString(self.rule, match))
+                body.append(str(BasicMatchString(self.rule, match)))
                 # Separate text of aggregated alerts with dashes
                 if len(matches) > 1:
-                    body += '\n----------------------------------------\n'
-        return body
+                    body.append('\n----------------------------------------\n')
+        return ''.join(body)
 
     def get_aggregation_summary_text__maximum_width(self):
         """Get maximum width allowed for summary text."""
         return 80
 
+    def get_aggregation_summary(self, matches):
+        """ Returns the AggregationSummary of matches, shared with the other alerters through the pipeline.
+        It is only counted here if it was not maintained as the matches were aggregated. """
+        summary = self.pipeline.get('aggregation_summary') if self.pipeline is not None else None
+        if summary is None or summary.total != len(matches):
+            summary = AggregationSummary.from_rule(self.rule).add_matches(matches)
+            if self.pipeline is not None:
+                self.pipeline['aggregation_summary'] = summary
+        return summary
+
     def get_aggregation_summary_text(self, matches):
         text = ''
         if 'aggregation' in self.rule and 'summary_table_fields' in self.rule:
             text = self.rule.get('summary_prefix', '')
-            summary_table_fields = self.rule['summary_table_fields']
-            if not isinstance(summary_table_fields, list):
-                summary_table_fields = [summary_table_fields]
-            # Include a count aggregation so that we can see at a glance how many of each aggregation_key were encountered
-            summary_table_fields_with_count = summary_table_fields + ['count']
+            summary = self.get_aggregation_summary(matches)
             text += "Aggregation resulted in the following data for summary_table_fields ==> {0}:\n\n".format(
-                summary_table_fields_with_count
+                summary.fields + ['count']
             )
-            text_table = Texttable(max_width=self.get_aggregation_summary_text__maximum_width())
-            text_table.header(summary_table_fields_with_count)
-            # Format all fields as 'text' to avoid long numbers being shown as scientific notation
-            text_table.set_cols_dtype(['t' for i in summary_table_fields_with_count])
-            match_aggregation = {}
-
-            # Maintain an aggregate count for each unique key encountered in the aggregation period
-            for match in matches:
-                key_tuple = tuple([str(lookup_es_key(match, key)) for key in summary_table_fields])
-                if key_tuple not in match_aggregation:
-                    match_aggregation[key_tuple] = 1
-                else:
-                    match_aggregation[key_tuple] = match_aggregation[key_tuple] + 1
-            for keys, count in match_aggregation.items():
-                text_table.add_row([key for key in keys] + [count])
-            text += text_table.draw() + '\n\n'
+            text += summary.render(self.get_aggregation_summary_text__maximum_width()) + '\n\n'
             text += self.rule.get('summary_prefix', '')
         return str(text)
 
@@ -318,6 +493,9 @@ class StompAlerter(Alerter):
     """ The stomp alerter publishes alerts via stomp to a broker. """
     required_options = frozenset(
         ['stomp_hostname', 'stomp_hostport', 'stomp_login', 'stomp_password'])
+    # Connections kept open with stomp_keepalive, with their locks, by broker and login
+    stomp_connections = {}
+    stomp_connections_lock = threading.Lock()
 
     def alert(self, matches):
         alerts = []
@@ -369,6 +547,10 @@ class StompAlerter(Alerter):
             'stomp_destination', '/queue/ALERT')
         self.stomp_ssl = self.rule.get('stomp_ssl', False)
 
+        if self.rule.get('stomp_keepalive'):
+            self.send_kept_alive(json.dumps(fullmessage))
+            return
+
         conn = stomp.Connection([(self.stomp_hostname, self.stomp_hostport)], use_ssl=self.stomp_ssl)
 
         conn.start()
@@ -378,6 +560,36 @@ class StompAlerter(Alerter):
         conn.send(self.stomp_destination, json.dumps(fullmessage))
         conn.disconnect()
 
+    def send_kept_alive(self, body):
+        """ Sends body on the connection kept open to the broker, shared by every rule with the same broker and login.
+        A connection which the broker dropped, or on which connecting or sending failed, is replaced by a new one,
+        as its receiver thread has exited. """
+        key = (self.stomp_hostname, self.stomp_hostport, self.stomp_ssl, self.stomp_login, self.stomp_password)
+        with self.stomp_connections_lock:
+            entry = self.stomp_connections.setdefault(key, {'conn': None, 'lock': threading.Lock()})
+        with entry['lock']:
+            conn = entry['conn']
+            try:
+                if conn is None or not conn.is_connected():
+                    self.close_stomp_connection(conn)
+                    conn = entry['conn'] = stomp.Connection([(self.stomp_hostname, self.stomp_hostport)], use_ssl=self.stomp_ssl)
+                    conn.start()
+                    conn.connect(self.stomp_login, self.stomp_password, wait=True)
+                conn.send(self.stomp_destination, body)
+            except Exception:
+                entry['conn'] = None
+                self.close_stomp_connection(conn)
+                raise
+
+    @staticmethod
+    def close_stomp_connection(conn):
+        if conn is None:
+            return
+        try:
+            conn.disconnect()
+        except Exception as e:
+            elastalert_logger.debug('Error closing stomp connection: %s' % (e))
+
     def get_info(self):
         return {'type': 'stomp'}
 
@@ -399,9 +611,59 @@ class DebugAlerter(Alerter):
         return {'type': 'debug'}
 
 
+class SMTPConnection(object):
+    """ An SMTP connection which is kept open and reused to send emails, one at a time.
+
+    The connection is checked with NOOP before it is reused if it has been idle for a while, closed if it has been idle
+    for longer than idle_timeout, and reopened if the server closed it.
+
+    :param connect: A function which returns a new, logged in SMTP connection.
+    :param idle_timeout: The number of seconds after which an unused connection is closed.
+    """
+
+    check_after = 10
+
+    def __init__(self, connect, idle_timeout=60):
+        self.connect = connect
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.smtp = None
+        self.last_used = 0
+
+    def sendmail(self, from_addr, to_addr, msg):
+        with self.lock:
+            idle = time.time() - self.last_used
+            if self.smtp is not None and (idle > self.idle_timeout or (idle > self.check_after and not self.is_alive())):
+                self.close()
+            if self.smtp is None:
+                self.smtp = self.connect()
+            try:
+                self.smtp.sendmail(from_addr, to_addr, msg)
+            except SMTPServerDisconnected:
+                self.smtp = self.connect()
+                self.smtp.sendmail(from_addr, to_addr, msg)
+            self.last_used = time.time()
+
+    def is_alive(self):
+        try:
+            return self.smtp.noop()[0] == 250
+        except (SMTPException, error):
+            return False
+
+    def close(self):
+        try:
+            self.smtp.quit()
+        except (SMTPException, error):
+            pass
+        self.smtp = None
+
+
 class EmailAlerter(Alerter):
     """ Sends an email alert """
     required_options = frozenset(['email'])
+    # Connections kept open with smtp_keepalive, by connection settings and account
+    smtp_connections = {}
+    smtp_connections_lock = threading.Lock()
 
     def __init__(self, *args):
         super(EmailAlerter, self).__init__(*args)
@@ -464,6 +726,17 @@ class EmailAlerter(Alerter):
         if self.rule.get('bcc'):
             to_addr = to_addr + self.rule['bcc']
 
+        if self.rule.get('smtp_keepalive'):
+            self.get_smtp_connection().sendmail(self.from_addr, to_addr, email_msg.as_string())
+        else:
+            self.smtp = self.connect()
+            self.smtp.sendmail(self.from_addr, to_addr, email_msg.as_string())
+            self.smtp.quit()
+
+        elastalert_logger.info("Sent email to %s" % (to_addr))
+
+    def connect(self):
+        """ Opens a connection to the SMTP host and logs in. """
         try:
             if self.smtp_ssl:
                 if self.smtp_port:
@@ -484,10 +757,18 @@ class EmailAlerter(Alerter):
             raise EAException("Error connecting to SMTP host: %s" % (e))
         except SMTPAuthenticationError as e:
             raise EAException("SMTP username/password rejected: %s" % (e))
-        self.smtp.sendmail(self.from_addr, to_addr, email_msg.as_string())
-        self.smtp.quit()
-
-        elastalert_logger.info("Sent email to %s" % (to_addr))
+        return self.smtp
+
+    def get_smtp_connection(self):
+        """ Returns the connection kept open to the SMTP host, shared by every rule which connects with the same settings
+        and account. """
+        auth_file = self.rule.get('smtp_auth_file')
+        key = (self.smtp_host, self.smtp_port, self.smtp_ssl, self.smtp_key_file, self.smtp_cert_file,
+               auth_file, auth_file and self.user, auth_file and self.password)
+        with self.smtp_connections_lock:
+            if key not in self.smtp_connections:
+                self.smtp_connections[key] = SMTPConnection(self.connect, self.rule.get('smtp_keepalive_timeout', 60))
+            return self.smtp_connections[key]
 
     def create_default_title(self, matches):
         subject = 'ElastAlert: %s' % (self.rule['name'])
@@ -508,6 +789,7 @@ class EmailAlerter(Alerter):
 class JiraAlerter(Alerter):
     """ Creates a Jira ticket for each alert """
     required_options = frozenset(['jira_server', 'jira_account_file', 'jira_project', 'jira_issuetype'])
+    writes_pipeline = True
 
     # Maintain a static set of built-in fields that we explicitly know how to set
     # For anything else, we will do best-effort and try to set a string value
@@ -527,8 +809,10 @@ class JiraAlerter(Alerter):
         'jira_label',
         'jira_labels',
         'jira_max_age',
+        'jira_metadata_cache_ttl',
         'jira_priority',
         'jira_project',
+        'jira_search_cache_ttl',
         'jira_server',
         'jira_transition_to',
         'jira_watchers',
@@ -577,6 +861,9 @@ class JiraAlerter(Alerter):
         self.transition = self.rule.get('jira_transition_to', False)
         self.watchers = self.rule.get('jira_watchers')
         self.client = None
+        # Field metadata, priorities and transitions rarely change, searches for existing tickets are only reused briefly
+        self.metadata_cache = TTLCache(self.rule.get('jira_metadata_cache_ttl', 3600))
+        self.search_cache = TTLCache(self.rule.get('jira_search_cache_ttl', 60))
 
         if self.bump_in_statuses and self.bump_not_in_statuses:
             msg = 'Both jira_bump_in_statuses (%s) and jira_bump_not_in_statuses (%s) are set.' % \
@@ -593,7 +880,7 @@ class JiraAlerter(Alerter):
         try:
             self.client = JIRA(self.server, basic_auth=(self.user, self.password))
             self.get_priorities()
-            self.jira_fields = self.client.fields()
+            self.jira_fields = self.get_fields()
             self.get_arbitrary_fields()
         except JIRAError as e:
             # JIRAError may contain HTML, pass along only first 1024 chars
@@ -696,9 +983,14 @@ class JiraAlerter(Alerter):
             else:
                 self.jira_args[arg_name] = {'name': value}
 
+    def get_fields(self):
+        """ Returns the field metadata of the Jira server. """
+        return self.metadata_cache.get_or_set('fields', self.client.fields)
+
     def get_arbitrary_fields(self):
         # Clear jira_args
         self.reset_jira_args()
+        self.jira_fields = self.get_fields()
 
         for jira_field, value in self.rule.items():
             # If we find a field that is not covered by the set that we are aware of, it means it is either:
@@ -711,7 +1003,7 @@ class JiraAlerter(Alerter):
 
     def get_priorities(self):
         """ Creates a mapping of priority index to id. """
-        priorities = self.client.priorities()
+        priorities = self.metadata_cache.get_or_set('priorities', self.client.priorities)
         self.priority_ids = {}
         for x in range(len(priorities)):
             self.priority_ids[x] = priorities[x].id
@@ -746,11 +1038,14 @@ class JiraAlerter(Alerter):
         if self.bump_not_in_statuses:
             jql = '%s and status not in (%s)' % (jql, ','.join(["\"%s\"" % status if ' ' in status else status
                                                                 for status in self.bump_not_in_statuses]))
-        try:
-            issues = self.client.search_issues(jql)
-        except JIRAError as e:
-            logging.exception("Error while searching for JIRA ticket using jql '%s': %s" % (jql, e))
-            return None
+        issues = self.search_cache.get(jql)
+        if issues is None:
+            try:
+                issues = self.client.search_issues(jql)
+            except JIRAError as e:
+                logging.exception("Error while searching for JIRA ticket using jql '%s': %s" % (jql, e))
+                return None
+            self.search_cache.set(jql, issues)
 
         if len(issues):
             return issues[0]
@@ -762,16 +1057,22 @@ class JiraAlerter(Alerter):
         self.client.add_comment(ticket, comment)
 
     def transition_ticket(self, ticket):
-        transitions = self.client.transitions(ticket)
+        # The transitions of a ticket are set by the workflow of its type for its status
+        key = ('transitions', ticket.fields.issuetype.name, ticket.fields.status.name)
+        transitions = self.metadata_cache.get_or_set(key, lambda: self.client.transitions(ticket))
         for t in transitions:
             if t['name'] == self.transition:
-                self.client.transition_issue(ticket, t['id'])
+                try:
+                    self.client.transition_issue(ticket, t['id'])
+                except JIRAError:
+                    self.metadata_cache.pop(key)
+                    raise
 
     def alert(self, matches):
         # Reset arbitrary fields to pick up changes
         self.get_arbitrary_fields()
         if len(self.deferred_settings) > 0:
-            fields = self.client.fields()
+            fields = self.get_fields()
             for jira_field in self.deferred_settings:
                 value = lookup_es_key(matches[0], self.rule[jira_field][1:])
                 self.set_jira_arg(jira_field, value, fields)
@@ -788,6 +1089,8 @@ class JiraAlerter(Alerter):
                         self.pipeline['jira_server'] = self.server
                     return None
                 elastalert_logger.info('Commenting on existing ticket %s' % (ticket.key))
+                # Commenting updates the ticket, so searches found before are stale
+                self.search_cache.clear()
                 for match in matches:
                     try:
                         self.comment_on_ticket(ticket, match)
@@ -818,6 +1121,7 @@ class JiraAlerter(Alerter):
 
         try:
             self.issue = self.client.create_issue(**self.jira_args)
+            self.search_cache.clear()
 
             # You can not add watchers on initial creation. Only as a follow-up action
             if self.watchers:
@@ -842,14 +1146,13 @@ class JiraAlerter(Alerter):
             self.pipeline['jira_server'] = self.server
 
     def create_alert_body(self, matches):
-        body = self.description + '\n'
-        body += self.get_aggregation_summary_text(matches)
+        body = [self.description + '\n', self.get_aggregation_summary_text(matches)]
         if self.rule.get('alert_text_type') != 'aggregation_summary_only':
             for match in matches:
-                body += str(JiraFormattedMatchString(self.rule, match))
+                body.append(str(JiraFormattedMatchString(self.rule, match)))
                 if len(matches) > 1:
-                    body += '\n----------------------------------------\n'
-        return body
+                    body.append('\n----------------------------------------\n')
+        return ''.join(body)
 
     def get_aggregation_summary_text(self, matches):
         text = super(JiraAlerter, self).get_aggregation_summary_text(matches)
@@ -1030,16 +1333,16 @@ class HipChatAlerter(Alerter):
                 )
                 ping_msg['message_format'] = "text"
 
-                response = requests.post(
+                response = self.http_post(
                     self.url,
                     data=json.dumps(ping_msg, cls=DateTimeEncoder),
                     headers=headers,
                     verify=not self.hipchat_ignore_ssl_errors,
                     proxies=proxies)
 
-            response = requests.post(self.url, data=json.dumps(payload, cls=DateTimeEncoder), headers=headers,
-                                     verify=not self.hipchat_ignore_ssl_errors,
-                                     proxies=proxies)
+            response = self.http_post(self.url, data=json.dumps(payload, cls=DateTimeEncoder), headers=headers,
+                                      verify=not self.hipchat_ignore_ssl_errors,
+                                      proxies=proxies)
             warnings.resetwarnings()
             response.raise_for_status()
         except RequestException as e:
@@ -1091,7 +1394,7 @@ class MsTeamsAlerter(Alerter):
 
         for url in self.ms_teams_webhook_url:
             try:
-                response = requests.post(url, data=json.dumps(payload, cls=DateTimeEncoder), headers=headers, proxies=proxies)
+                response = self.http_post(url, data=json.dumps(payload, cls=DateTimeEncoder), headers=headers, proxies=proxies)
                 response.raise_for_status()
             except RequestException as e:
                 raise EAException("Error posting to ms teams: %s" % e)
@@ -1211,7 +1514,7 @@ class SlackAlerter(Alerter):
                     if self.slack_ignore_ssl_errors:
                         requests.packages.urllib3.disable_warnings()
                     payload['channel'] = channel_override
-                    response = requests.post(
+                    response = self.http_post(
                         url, data=json.dumps(payload, cls=DateTimeEncoder),
                         headers=headers, verify=verify,
                         proxies=proxies,
@@ -1319,7 +1622,7 @@ class MattermostAlerter(Alerter):
                 if self.mattermost_ignore_ssl_errors:
                     requests.urllib3.disable_warnings()
 
-                response = requests.post(
+                response = self.http_post(
                     url, data=json.dumps(payload, cls=DateTimeEncoder),
                     headers=headers, verify=not self.mattermost_ignore_ssl_errors,
                     proxies=proxies)
@@ -1414,7 +1717,7 @@ class PagerDutyAlerter(Alerter):
         # set https proxy, if it was provided
         proxies = {'https': self.pagerduty_proxy} if self.pagerduty_proxy else None
         try:
-            response = requests.post(
+            response = self.http_post(
                 self.url,
                 data=json.dumps(payload, cls=DateTimeEncoder, ensure_ascii=False),
                 headers=headers,
@@ -1492,7 +1795,7 @@ class PagerTreeAlerter(Alerter):
         }
 
         try:
-            response = requests.post(self.url, data=json.dumps(payload, cls=DateTimeEncoder), headers=headers, proxies=proxies)
+            response = self.http_post(self.url, data=json.dumps(payload, cls=DateTimeEncoder), headers=headers, proxies=proxies)
             response.raise_for_status()
         except RequestException as e:
             raise EAException("Error posting to PagerTree: %s" % e)
@@ -1590,7 +1893,7 @@ class VictorOpsAlerter(Alerter):
             payload["entity_id"] = self.victorops_entity_id
 
         try:
-            response = requests.post(self.url, data=json.dumps(payload, cls=DateTimeEncoder), headers=headers, proxies=proxies)
+            response = self.http_post(self.url, data=json.dumps(payload, cls=DateTimeEncoder), headers=headers, proxies=proxies)
             response.raise_for_status()
         except RequestException as e:
             raise EAException("Error posting to VictorOps: %s" % e)
@@ -1638,7 +1941,7 @@ class TelegramAlerter(Alerter):
         }
 
         try:
-            response = requests.post(self.url, data=json.dumps(payload, cls=DateTimeEncoder), headers=headers, proxies=proxies, auth=auth)
+            response = self.http_post(self.url, data=json.dumps(payload, cls=DateTimeEncoder), headers=headers, proxies=proxies, auth=auth)
             warnings.resetwarnings()
             response.raise_for_status()
         except RequestException as e:
@@ -1730,7 +2033,7 @@ class GoogleChatAlerter(Alerter):
         headers = {'content-type': 'application/json'}
         for url in self.googlechat_webhook_url:
             try:
-                response = requests.post(url, data=json.dumps(message), headers=headers)
+                response = self.http_post(url, data=json.dumps(message), headers=headers)
                 response.raise_for_status()
             except RequestException as e:
                 raise EAException("Error posting to google chat: {}".format(e))
@@ -1764,7 +2067,7 @@ class GitterAlerter(Alerter):
         }
 
         try:
-            response = requests.post(self.gitter_webhook_url, json.dumps(payload, cls=DateTimeEncoder), headers=headers, proxies=proxies)
+            response = self.http_post(self.gitter_webhook_url, json.dumps(payload, cls=DateTimeEncoder), headers=headers, proxies=proxies)
             response.raise_for_status()
         except RequestException as e:
             raise EAException("Error posting to Gitter: %s" % e)
@@ -1817,7 +2120,7 @@ class ServiceNowAlerter(Alerter):
             "caller_id": self.rule["caller_id"]
         }
         try:
-            response = requests.post(
+            response = self.http_post(
                 self.servicenow_rest_url,
                 auth=(self.rule['username'], self.rule['password']),
                 headers=headers,
@@ -1877,7 +2180,7 @@ class AlertaAlerter(Alerter):
         alerta_payload = self.get_json_payload(matches[0])
 
         try:
-            response = requests.post(self.url, data=alerta_payload, headers=headers, verify=self.verify_ssl)
+            response = self.http_post(self.url, data=alerta_payload, headers=headers, verify=self.verify_ssl)
             response.raise_for_status()
         except RequestException as e:
             raise EAException("Error posting to Alerta: %s" % e)
@@ -1975,8 +2278,8 @@ class HTTPPostAlerter(Alerter):
             proxies = {'https': self.post_proxy} if self.post_proxy else None
             for url in self.post_url:
                 try:
-                    response = requests.post(url, data=json.dumps(payload, cls=DateTimeEncoder),
-                                             headers=headers, proxies=proxies, timeout=self.timeout)
+                    response = self.http_post(url, data=json.dumps(payload, cls=DateTimeEncoder),
+                                              headers=headers, proxies=proxies, timeout=self.timeout)
                     response.raise_for_status()
                 except RequestException as e:
                     raise EAException("Error posting HTTP Post alert: %s" % e)
@@ -2063,7 +2366,7 @@ class StrideAlerter(Alerter):
         try:
             if self.stride_ignore_ssl_errors:
                 requests.packages.urllib3.disable_warnings()
-            response = requests.post(
+            response = self.http_post(
                 self.url, data=json.dumps(payload, cls=DateTimeEncoder),
                 headers=headers, verify=not self.stride_ignore_ssl_errors,
                 proxies=proxies)
@@ -2099,7 +2402,7 @@ class LineNotifyAlerter(Alerter):
             "message": body
         }
         try:
-            response = requests.post("https://notify-api.line.me/api/notify", data=payload, headers=headers)
+            response = self.http_post("https://notify-api.line.me/api/notify", data=payload, headers=headers)
             response.raise_for_status()
         except RequestException as e:
             raise EAException("Error posting to Line Notify: %s" % e)
@@ -2173,7 +2476,7 @@ class HiveAlerter(Alerter):
             headers = {'Content-Type': 'application/json', 'Authorization': 'Bearer {}'.format(connection_details.get('hive_apikey', ''))}
             proxies = connection_details.get('hive_proxies', {'http': '', 'https': ''})
             verify = connection_details.get('hive_verify', False)
-            response = requests.post(req, headers=headers, data=alert_body, proxies=proxies, verify=verify)
+            response = self.http_post(req, headers=headers, data=alert_body, proxies=proxies, verify=verify)
 
             if response.status_code != 201:
                 raise Exception('alert not successfully created in TheHive\n{}'.format(response.text))
@@ -88,6 +88,8 @@ def load_conf(args, defaults=None, overwrites=None):
             conf['old_query_limit'] = datetime.timedelta(**conf['old_query_limit'])
         else:
             conf['old_query_limit'] = datetime.timedelta(weeks=1)
+        if 'pending_alert_sweep_interval' in conf:
+            conf['pending_alert_sweep_interval'] = datetime.timedelta(**conf['pending_alert_sweep_interval'])
     except (KeyError, TypeError) as e:
         raise EAException('Invalid time format used: %s' % e)
 
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+from .util import elastalert_logger
+
+
+class AlertDispatcher(object):
+    """ Sends alerts from a pool of worker threads, so that slow alerters do not hold up rule execution.
+
+    The alerters of one alert are sent concurrently, except for those which write to the shared pipeline,
+    which are sent first, in order, so that the others can use what they wrote. Each alerter instance
+    sends one alert at a time, at most alerter_concurrency alerters of the same type send at once, and
+    failed alerts are retried up to retries times, waiting retry_backoff seconds, doubled on each retry.
+
+    :param workers: The number of worker threads.
+    :param alerter_concurrency: The maximum number of concurrent alerts per alerter type.
+    :param retries: The number of times to retry a failed alert.
+    :param retry_backoff: The number of seconds to wait before the first retry.
+    """
+
+    def __init__(self, workers=4, alerter_concurrency=2, retries=2, retry_backoff=5):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='alert_dispatch')
+        self.alerter_concurrency = alerter_concurrency
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.lock = threading.Lock()
+        self.type_semaphores = {}
+        self.alerter_locks = weakref.WeakKeyDictionary()
+
+    def dispatch(self, alerters, matches, pipeline, on_complete):
+        """ Queues matches to be sent by each alerter.
+
+        :param alerters: The alerters of the rule.
+        :param matches: A list of matches.
+        :param pipeline: The pipeline shared by the alerters.
+        :param on_complete: Called from a worker thread with a list of (alerter, exception or None) once every alerter is done.
+        """
+        if not alerters:
+            on_complete([])
+            return
+        results = []
+
+        def record(alerter, error):
+            with self.lock:
+                results.append((alerter, error))
+                done = len(results) == len(alerters)
+            if done:
+                try:
+                    on_complete(results)
+                except Exception:
+                    elastalert_logger.exception('Error while handling the outcome of an alert')
+
+        def send_and_record(alerter):
+            record(alerter, self.send(alerter, matches, pipeline))
+
+        def send_pipeline_writers():
+            for alerter in writers:
+                send_and_record(alerter)
+            for alerter in others:
+                self.executor.submit(send_and_record, alerter)
+
+        writers = [alerter for alerter in alerters if alerter.writes_pipeline]
+        others = [alerter for alerter in alerters if not alerter.writes_pipeline]
+        if writers:
+            self.executor.submit(send_pipeline_writers)
+        else:
+            for alerter in others:
+                self.executor.submit(send_and_record, alerter)
+
+    def send(self, alerter, matches, pipeline):
+        """ Sends matches with alerter, retrying with exponential backoff.
+        Returns None on success, or the exception of the last attempt. """
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.retry_backoff * 2 ** (attempt - 1))
+            with self.get_type_semaphore(alerter), self.get_alerter_lock(alerter):
+                alerter.pipeline = pipeline
+                try:
+                    alerter.alert(matches)
+                except Exception as e:
+                    error = e
+                    elastalert_logger.warning('Error while running alert %s (attempt %d of %d): %s' % (
+                        alerter.get_info()['type'], attempt + 1, self.retries + 1, e))
+                else:
+                    return None
+        return error
+
+    def get_type_semaphore(self, alerter):
+        alerter_type = type(alerter)
+        with self.lock:
+            if alerter_type not in self.type_semaphores:
+                self.type_semaphores[alerter_type] = threading.BoundedSemaphore(self.alerter_concurrency)
+            return self.type_semaphores[alerter_type]
+
+    def get_alerter_lock(self, alerter):
+        # Alerters keep state between calls to alert, such as the pipeline, so each sends one alert at a time
+        with self.lock:
+            if alerter not in self.alerter_locks:
+                self.alerter_locks[alerter] = threading.Lock()
+            return self.alerter_locks[alerter]
+
+    def shutdown(self, wait=True):
+        """ Stops accepting alerts. If wait is true, blocks until queued alerts have been sent. """
+        self.executor.shutdown(wait=wait)
@@ -2,11 +2,13 @@
 import argparse
 import copy
 import datetime
+import heapq
 import json
 import logging
 import os
 import random
 import signal
+import sqlite3
 import sys
 import threading
 import time
@@ -27,11 +29,18 @@ from elasticsearch.exceptions import NotFoundError
 from elasticsearch.exceptions import TransportError
 
 from . import kibana
+from .aggregation import AggregationBuffer
+from .alerts import AggregationSummary
 from .alerts import DebugAlerter
 from .config import load_conf
+from .dispatcher import AlertDispatcher
 from .enhancements import DropMatchException
 from .kibana_discover import generate_kibana_discover_url
+from .outbox import AlertOutbox
 from .ruletypes import FlatlineRule
+from .ruletypes import MetricAggregationRule
+from .topcounts import get_top_count_retention
+from .topcounts import TopCountWindow
 from .util import add_raw_postfix
 from .util import cronite_datetime_to_timestamp
 from .util import dt_to_ts
@@ -52,7 +61,11 @@ from .util import total_seconds
 from .util import ts_add
 from .util import ts_now
 from .util import ts_to_dt
+from .util import TTLCache
 from .util import unix_to_dt
+from .writeback import ElasticsearchWriteback
+from .writeback import SQLiteWriteback
+from .writeback import WritebackMirror
 
 
 class ElastAlerter(object):
@@ -69,6 +82,14 @@ class ElastAlerter(object):
     by config.py:load_rules instead. """
 
     thread_data = threading.local()
+    # The maximum number of top counts searches sent in one msearch
+    top_count_msearch_size = 100
+    # The number of documents fetched from the writeback index per page
+    writeback_page_size = 1000
+    # How long after an aggregation is due its alert is sent, so that it is not found to be due just before it is
+    aggregation_flush_delay = datetime.timedelta(seconds=1)
+    # How long to wait before retrying an alert which failed to send, without an outbox
+    pending_alert_retry_interval = datetime.timedelta(seconds=60)
 
     def parse_args(self, args):
         parser = argparse.ArgumentParser()
@@ -166,14 +187,56 @@ class ElastAlerter(object):
         self.string_multi_field_name = self.conf.get('string_multi_field_name', False)
         self.add_metadata_alert = self.conf.get('add_metadata_alert', False)
         self.show_disabled_rules = self.conf.get('show_disabled_rules', True)
+        self.combine_aggregation_queries = self.conf.get('combine_aggregation_queries', False)
+        self.alert_dispatcher = None
+        if self.conf.get('alert_dispatch_workers'):
+            self.alert_dispatcher = AlertDispatcher(self.conf['alert_dispatch_workers'],
+                                                    self.conf.get('alert_dispatch_concurrency', 2),
+                                                    self.conf.get('alert_dispatch_retries', 2),
+                                                    self.conf.get('alert_dispatch_retry_backoff', 5))
+        self.alert_outbox = None
+        if self.conf.get('alert_outbox_file') and not self.debug:
+            self.alert_outbox = AlertOutbox(self.conf['alert_outbox_file'], self.alert_time_limit,
+                                            self.conf.get('alert_outbox_retry_backoff', 30),
+                                            self.conf.get('alert_outbox_max_backoff', 3600),
+                                            self.write_expired_alert)
+        self.pending_alerts_scanned = False
+        self.pending_alerts_lock = threading.Lock()
+        self.pending_alert_sweep_interval = self.conf.get('pending_alert_sweep_interval', datetime.timedelta(minutes=10))
+        self.aggregation_deadlines = []
+        self.aggregation_deadlines_lock = threading.Lock()
+        self.next_aggregation_flush = None
+        self.running = False
+        self.preload_pending_aggregates = self.conf.get('preload_pending_aggregates', True)
+        self.aggregation_buffer_size = self.conf.get('aggregation_buffer_size', 10000)
+        self.aggregation_spill_dir = self.conf.get('aggregation_spill_dir')
+        self.pending_aggregates = None
+        self.pending_aggregates_lock = threading.Lock()
+        self.top_counts_cache = TTLCache(self.conf.get('top_count_cache_ttl', 60))
+        self.aggregation_group_endtimes = {}
+        self.aggregation_results = {}
+        self.aggregation_lock = threading.Lock()
+        self.rules_lock = threading.RLock()
+        # Alerts sent by the dispatcher since the last run of their rule, by rule name
+        self.dispatched_alerts_sent = {}
+        self.dispatched_alerts_sent_lock = threading.Lock()
 
         self.writeback_es = elasticsearch_client(self.conf)
-
-        remove = []
-        for rule in self.rules:
-            if not self.init_rule(rule):
-                remove.append(rule)
-        list(map(self.rules.remove, remove))
+        self.writeback_store = ElasticsearchWriteback(self.writeback_es, self.writeback_index)
+        if self.conf.get('writeback_sqlite_file') and not self.debug:
+            mirror = None
+            if self.conf.get('writeback_mirror_es'):
+                mirror = WritebackMirror(self.writeback_es, self.writeback_index)
+            # Nothing older than these limits is read back
+            retention = max(self.old_query_limit, self.alert_time_limit)
+            self.writeback_store = SQLiteWriteback(self.conf['writeback_sqlite_file'], mirror, retention)
+
+        with self.rules_lock:
+            remove = []
+            for rule in self.rules:
+                if not self.init_rule(rule):
+                    remove.append(rule)
+            list(map(self.rules.remove, remove))
 
         if self.args.silence:
             self.silence()
@@ -277,6 +340,82 @@ class ElastAlerter(object):
             aggs_query['aggs'] = aggs_element
         return aggs_query
 
+    def get_composite_aggregation_query(self, query, rule, query_key, page_size, timestamp_field='@timestamp'):
+        """ Takes a query generated by get_query and outputs an aggregation query where the query_key buckets
+        come from a composite aggregation, which can be paged through with its 'after' key """
+        aggs_query = self.get_aggregation_query(query, rule, None, None, timestamp_field)
+        sources = [{key: {'terms': {'field': key}}} for key in query_key.split(',')]
+        aggs_query['aggs'] = {'bucket_aggs': {'composite': {'size': page_size, 'sources': sources},
+                                              'aggs': aggs_query['aggs']}}
+        return aggs_query
+
+    @staticmethod
+    def composite_to_term_buckets(buckets, keys):
+        """ Nests the buckets of a composite aggregation over keys the same way as the nested terms aggregations
+        of get_aggregation_query, so that rule types can handle both. Composite buckets are sorted by their keys,
+        so buckets sharing a parent key are consecutive. """
+        root = []
+        for bucket in buckets:
+            level = root
+            for key in keys[:-1]:
+                value = bucket['key'][key]
+                if not level or level[-1]['key'] != value:
+                    level.append({'key': value, 'bucket_aggs': {'buckets': []}})
+                level = level[-1]['bucket_aggs']['buckets']
+            leaf = dict(bucket)
+            leaf['key'] = bucket['key'][keys[-1]]
+            level.append(leaf)
+        return {'bucket_aggs': {'buckets': root}}
+
+    def run_composite_aggregation_query(self, rule, starttime, endtime, index, query_key):
+        """ Pages through a composite aggregation over query_key, passing each page to the rule type
+        as it arrives, so that all buckets are seen without holding them all at once.
+
+        :return: True on success and False on failure.
+        """
+        rule_filter = copy.copy(rule['filter'])
+        base_query = self.get_query(
+            rule_filter,
+            starttime,
+            endtime,
+            timestamp_field=rule['timestamp_field'],
+            sort=False,
+            to_ts_func=rule['dt_to_ts'],
+            five=rule['five']
+        )
+        query = self.get_composite_aggregation_query(base_query, rule, query_key, rule.get('aggregation_page_size', 1000),
+                                                     rule['timestamp_field'])
+        keys = query_key.split(',')
+        first_page = True
+        while True:
+            try:
+                res = self.thread_data.current_es.deprecated_search(index=index, doc_type=rule.get('doc_type'),
+                                                                    body=query, size=0, ignore_unavailable=True)
+            except ElasticsearchException as e:
+                if len(str(e)) > 1024:
+                    e = str(e)[:1024] + '... (%d characters removed)' % (len(str(e)) - 1024)
+                self.handle_error('Error running query: %s' % (e), {'rule': rule['name']})
+                return False
+            if 'aggregations' not in res:
+                return True
+
+            if first_page:
+                first_page = False
+                if self.thread_data.current_es.is_atleastseven():
+                    self.thread_data.num_hits += res['hits']['total']['value']
+                else:
+                    self.thread_data.num_hits += res['hits']['total']
+
+            composite = res['aggregations']['bucket_aggs']
+            # Composite aggregations have no min_doc_count, apply it here instead
+            buckets = [bucket for bucket in composite['buckets'] if bucket['doc_count'] >= rule.get('min_doc_count', 1)]
+            if buckets:
+                rule['type'].add_aggregation_data({endtime: self.composite_to_term_buckets(buckets, keys)})
+            if len(composite['buckets']) < query['aggs']['bucket_aggs']['composite']['size']:
+                return True
+            # Before Elasticsearch 6.3, responses have no after_key, the next page starts after the last bucket instead
+            query['aggs']['bucket_aggs']['composite']['after'] = composite.get('after_key') or composite['buckets'][-1]['key']
+
     def get_index_start(self, index, timestamp_field='@timestamp'):
         """ Query for one result sorted by timestamp to find the beginning of the index.
 
@@ -469,7 +608,8 @@ class ElastAlerter(object):
         )
         return {endtime: res['count']}
 
-    def get_hits_terms(self, rule, starttime, endtime, index, key, qk=None, size=None):
+    def get_qk_filter(self, rule, qk, key):
+        """ Returns the rule's filter, restricted to the events whose query_key value is qk, if qk is set. """
         rule_filter = copy.copy(rule['filter'])
         if qk:
             qk_list = qk.split(",")
@@ -492,7 +632,10 @@ class ElastAlerter(object):
                     if rule.get('raw_count_keys', True) and not key.endswith(end):
                         key_with_postfix = add_raw_postfix(key_with_postfix, rule['five'])
                     rule_filter.extend([{'term': {key_with_postfix: qk_list[i]}}])
+        return rule_filter
 
+    def get_hits_terms(self, rule, starttime, endtime, index, key, qk=None, size=None):
+        rule_filter = self.get_qk_filter(rule, qk, key)
         base_query = self.get_query(
             rule_filter,
             starttime,
@@ -552,24 +695,39 @@ class ElastAlerter(object):
         )
         if term_size is None:
             term_size = rule.get('terms_size', 50)
-        query = self.get_aggregation_query(base_query, rule, query_key, term_size, rule['timestamp_field'])
-        try:
-            if not rule['five']:
-                res = self.thread_data.current_es.deprecated_search(
-                    index=index,
-                    doc_type=rule.get('doc_type'),
-                    body=query,
-                    search_type='count',
-                    ignore_unavailable=True
-                )
-            else:
-                res = self.thread_data.current_es.deprecated_search(index=index, doc_type=rule.get('doc_type'),
-                                                                    body=query, size=0, ignore_unavailable=True)
-        except ElasticsearchException as e:
-            if len(str(e)) > 1024:
-                e = str(e)[:1024] + '... (%d characters removed)' % (len(str(e)) - 1024)
-            self.handle_error('Error running query: %s' % (e), {'rule': rule['name']})
-            return None
+        signature = rule.get('aggregation_signature')
+        res = None
+        if signature:
+            # Another rule with the same signature may already have run the combined query for this window
+            with self.aggregation_lock:
+                cached = self.aggregation_results.get(signature)
+            if cached and cached[0] == (index, starttime, endtime, term_size) and \
+                    set(rule['aggregation_query_element']).issubset(cached[1]):
+                res = cached[2]
+        if res is None:
+            query_rule = self.get_combined_aggregation_rule(rule) if signature else rule
+            query = self.get_aggregation_query(base_query, query_rule, query_key, term_size, rule['timestamp_field'])
+            try:
+                if not rule['five']:
+                    res = self.thread_data.current_es.deprecated_search(
+                        index=index,
+                        doc_type=rule.get('doc_type'),
+                        body=query,
+                        search_type='count',
+                        ignore_unavailable=True
+                    )
+                else:
+                    res = self.thread_data.current_es.deprecated_search(index=index, doc_type=rule.get('doc_type'),
+                                                                        body=query, size=0, ignore_unavailable=True)
+            except ElasticsearchException as e:
+                if len(str(e)) > 1024:
+                    e = str(e)[:1024] + '... (%d characters removed)' % (len(str(e)) - 1024)
+                self.handle_error('Error running query: %s' % (e), {'rule': rule['name']})
+                return None
+            if signature:
+                with self.aggregation_lock:
+                    self.aggregation_results[signature] = ((index, starttime, endtime, term_size),
+                                                           query_rule['aggregation_query_element'], res)
         if 'aggregations' not in res:
             return {}
         if not rule['five']:
@@ -625,10 +783,17 @@ class ElastAlerter(object):
         rule_inst = rule['type']
         rule['scrolling_cycle'] = rule.get('scrolling_cycle', 0) + 1
         index = self.get_index(rule, start, end)
+        num_hits = self.thread_data.num_hits
         if rule.get('use_count_query'):
             data = self.get_hits_count(rule, start, end, index)
         elif rule.get('use_terms_query'):
             data = self.get_hits_terms(rule, start, end, index, rule['query_key'])
+        elif (rule.get('aggregation_query_element') and rule.get('use_composite_aggregation') and rule.get('query_key') and
+              self.thread_data.current_es.is_atleastsixtwo()):
+            # Pages of buckets are passed to the rule type as they arrive
+            if not self.run_composite_aggregation_query(rule, start, end, index, rule['query_key']):
+                return False
+            data = {}
         elif rule.get('aggregation_query_element'):
             data = self.get_hits_aggregation(rule, start, end, index, rule.get('query_key', None))
         else:
@@ -637,6 +802,8 @@ class ElastAlerter(object):
                 old_len = len(data)
                 data = self.remove_duplicate_events(data, rule)
                 self.thread_data.num_dupes += old_len - len(data)
+                if 'top_count_window' in rule:
+                    rule['top_count_window'].add_hits(data, rule['timestamp_field'])
 
         # There was an exception while querying
         if data is None:
@@ -666,6 +833,11 @@ class ElastAlerter(object):
             except NotFoundError:
                 pass
 
+        if 'top_count_window' in rule and not scroll and isinstance(data, list):
+            # Scrolling may have stopped before every hit was fetched
+            complete = self.thread_data.num_hits - num_hits >= self.thread_data.total_hits
+            rule['top_count_window'].extend(start, end, complete)
+
         return True
 
     def get_starttime(self, rule):
@@ -674,34 +846,17 @@ class ElastAlerter(object):
         :param rule: The rule configuration.
         :return: A timestamp or None.
         """
-        sort = {'sort': {'@timestamp': {'order': 'desc'}}}
-        query = {'filter': {'term': {'rule_name': '%s' % (rule['name'])}}}
-        if self.writeback_es.is_atleastfive():
-            query = {'query': {'bool': query}}
-        query.update(sort)
-
         try:
-            doc_type = 'elastalert_status'
-            index = self.writeback_es.resolve_writeback_index(self.writeback_index, doc_type)
-            if self.writeback_es.is_atleastsixtwo():
-                if self.writeback_es.is_atleastsixsix():
-                    res = self.writeback_es.search(index=index, size=1, body=query,
-                                                   _source_includes=['endtime', 'rule_name'])
-                else:
-                    res = self.writeback_es.search(index=index, size=1, body=query,
-                                                   _source_include=['endtime', 'rule_name'])
-            else:
-                res = self.writeback_es.deprecated_search(index=index, doc_type=doc_type,
-                                                          size=1, body=query, _source_include=['endtime', 'rule_name'])
-            if res['hits']['hits']:
-                endtime = ts_to_dt(res['hits']['hits'][0]['_source']['endtime'])
+            status = self.writeback_store.get_last_status(rule['name'])
+            if status:
+                endtime = ts_to_dt(status['endtime'])
 
                 if ts_now() - endtime < self.old_query_limit:
                     return endtime
                 else:
                     elastalert_logger.info("Found expired previous run for %s at %s" % (rule['name'], endtime))
                     return None
-        except (ElasticsearchException, KeyError) as e:
+        except (ElasticsearchException, KeyError, sqlite3.Error) as e:
             self.handle_error('Error querying for last run: %s' % (e), {'rule': rule['name']})
 
     def set_starttime(self, rule, endtime):
@@ -813,8 +968,9 @@ class ElastAlerter(object):
 
     def enhance_filter(self, rule):
         """ If there is a blacklist or whitelist in rule then we add it to the filter.
-        It adds it as a query_string. If there is already an query string its is appended
-        with blacklist or whitelist.
+        By default, it adds it as a query_string. If there is already an query string its is appended
+        with blacklist or whitelist. With filter_by_list_type set to terms or terms_lookup, literal
+        entries are added as a terms filter instead, and regular expressions as a separate query_string.
 
         :param rule:
         :return:
@@ -829,6 +985,13 @@ class ElastAlerter(object):
             return
 
         filters = rule['filter']
+        if rule.get('filter_by_list_type', 'query_string') != 'query_string':
+            list_filter = self.get_list_terms_filter(rule, listname)
+            if list_filter:
+                filters.append(list_filter)
+                logging.debug("Enhanced filter with {} terms filter on {}".format(listname, rule['compare_key']))
+            return
+
         additional_terms = []
         for term in rule[listname]:
             if not term.startswith('/') or not term.endswith('/'):
@@ -836,6 +999,9 @@ class ElastAlerter(object):
             else:
                 # These are regular expressions and won't work if they are quoted
                 additional_terms.append(rule['compare_key'] + ':' + term)
+        if not additional_terms:
+            # An empty query string is rejected by Elasticsearch
+            return
         if listname == 'whitelist':
             query = "NOT " + " AND NOT ".join(additional_terms)
         else:
@@ -847,6 +1013,94 @@ class ElastAlerter(object):
             filters.append({'query': query_str_filter})
         logging.debug("Enhanced filter with {} terms: {}".format(listname, str(query_str_filter)))
 
+    def get_list_terms_filter(self, rule, listname):
+        """ Builds a filter matching the blacklist, or excluding the whitelist, of a rule. Literal entries
+        become terms filters of at most filter_by_list_max_terms entries each, inline or as terms lookups, and
+        regular expressions a query_string.
+
+        :param rule: The rule configuration.
+        :param listname: blacklist or whitelist.
+        :return: The filter, or None if the list is empty.
+        """
+        literals = []
+        regexes = []
+        for term in rule[listname]:
+            if term.startswith('/') and term.endswith('/'):
+                regexes.append(rule['compare_key'] + ':' + term)
+            else:
+                literals.append(term)
+
+        clauses = []
+        if literals:
+            terms_key = rule['compare_key']
+            if rule.get('filter_by_list_raw', True):
+                terms_key = add_raw_postfix(terms_key, rule['five'])
+            # A terms filter may hold at most index.max_terms_count entries
+            max_terms = rule.get('filter_by_list_max_terms', 65536)
+            terms = sorted(literals)
+            chunks = [terms[i:i + max_terms] for i in range(0, len(terms), max_terms)]
+            if rule['filter_by_list_type'] == 'terms_lookup':
+                chunks = self.sync_list_lookup(rule, listname, chunks)
+            clauses.extend({'terms': {terms_key: chunk}} for chunk in chunks)
+        if regexes:
+            query_str_filter = {'query_string': {'query': " OR ".join(regexes)}}
+            if self.writeback_es.is_atleastfive():
+                clauses.append(query_str_filter)
+            else:
+                clauses.append({'query': query_str_filter})
+
+        if not clauses:
+            return None
+        if listname == 'whitelist':
+            return {'bool': {'must_not': clauses}}
+        if len(clauses) == 1:
+            return clauses[0]
+        return {'bool': {'should': clauses}}
+
+    def sync_list_lookup(self, rule, listname, chunks):
+        """ Writes the literal list entries of a rule to a document in filter_by_list_index, on the
+        cluster the rule queries, one field per chunk, and returns a terms lookup for each chunk. If the
+        document cannot be written, the chunks are returned to be used inline instead.
+
+        :param rule: The rule configuration.
+        :param listname: blacklist or whitelist.
+        :param chunks: Lists of the sorted literal entries.
+        :return: A list of terms lookup dictionaries, or chunks.
+        """
+        if self.debug:
+            elastalert_logger.info("Skipping writing %s of %s to ES, using it inline" % (listname, rule['name']))
+            return chunks
+
+        index = rule.get('filter_by_list_index', self.writeback_index + '_lists')
+        doc_id = '%s_%s' % (rule['name'], listname)
+        paths = ['terms'] + ['terms_%d' % (i) for i in range(1, len(chunks))]
+        body = {'rule_name': rule['name'], 'list': listname, '@timestamp': dt_to_ts(ts_now())}
+        body.update(zip(paths, chunks))
+        rule_es = elasticsearch_client(rule)
+        try:
+            if rule_es.is_atleastsixtwo():
+                rule_es.index(index=index, id=doc_id, body=body)
+            else:
+                rule_es.index(index=index, doc_type='list', id=doc_id, body=body)
+        except ElasticsearchException as e:
+            self.handle_error("Error writing %s of %s to %s, using it inline: %s" % (listname, rule['name'], index, e),
+                              {'rule': rule['name']})
+            return chunks
+
+        lookups = []
+        for path in paths:
+            lookup = {'index': index, 'id': doc_id, 'path': path}
+            if not rule_es.is_atleastseven():
+                lookup['type'] = '_doc' if rule_es.is_atleastsixtwo() else 'list'
+            lookups.append(lookup)
+        return lookups
+
+    def get_rule_es(self, rule):
+        """ Returns the Elasticsearch client of a rule, creating it on first use. """
+        if rule['name'] not in self.es_clients:
+            self.es_clients[rule['name']] = elasticsearch_client(rule)
+        return self.es_clients[rule['name']]
+
     def run_rule(self, rule, endtime, starttime=None):
         """ Run a rule for a given time period, including querying and alerting on results.
 
@@ -856,12 +1110,10 @@ class ElastAlerter(object):
         :return: The number of matches that the rule produced.
         """
         run_start = time.time()
-        self.thread_data.current_es = self.es_clients.setdefault(rule['name'], elasticsearch_client(rule))
+        self.thread_data.current_es = self.get_rule_es(rule)
 
-        # If there are pending aggregate matches, try processing them
-        for x in range(len(rule['agg_matches'])):
-            match = rule['agg_matches'].pop()
-            self.add_aggregated_alert(match, rule)
+        # If there are pending aggregate matches, try processing them, until writing one fails again
+        rule['agg_matches'].drain(lambda match: self.add_aggregated_alert(match, rule))
 
         # Start from provided time if it's given
         if starttime:
@@ -954,6 +1206,10 @@ class ElastAlerter(object):
         # Mark this endtime for next run's start
         rule['previous_endtime'] = endtime
 
+        # Count the alerts the dispatcher has sent since the last run
+        with self.dispatched_alerts_sent_lock:
+            self.thread_data.alerts_sent += self.dispatched_alerts_sent.pop(rule['name'], 0)
+
         time_taken = time.time() - run_start
         # Write to ES that we've run this rule against this time period
         body = {'rule_name': rule['name'],
@@ -961,6 +1217,7 @@ class ElastAlerter(object):
                 'starttime': rule['original_starttime'],
                 'matches': num_matches,
                 'hits': max(self.thread_data.num_hits, self.thread_data.cumulative_hits),
+                'alerts_sent': self.thread_data.alerts_sent,
                 '@timestamp': ts_now(),
                 'time_taken': time_taken}
         self.writeback('elastalert_status', body)
@@ -982,6 +1239,7 @@ class ElastAlerter(object):
 
         self.enhance_filter(new_rule)
 
+        top_count_fields = list(new_rule.get('top_count_keys', []))
         # Change top_count_keys to .raw
         if 'top_count_keys' in new_rule and new_rule.get('raw_count_keys', True):
             if self.string_multi_field_name:
@@ -995,6 +1253,11 @@ class ElastAlerter(object):
                 if not key.endswith(string_multi_field_name):
                     new_rule['top_count_keys'][i] += string_multi_field_name
 
+        if new_rule.get('top_count_local') and 'top_count_keys' in new_rule:
+            capacity = new_rule.get('top_count_local_capacity', max(100, 10 * new_rule.get('top_count_number', 5)))
+            new_rule['top_count_window'] = TopCountWindow(top_count_fields, new_rule['top_count_keys'], new_rule.get('query_key'),
+                                                          get_top_count_retention(new_rule, self.buffer_time), capacity)
+
         if 'download_dashboard' in new_rule['filter']:
             # Download filters from Kibana and set the rules filters to them
             db_filters = self.filters_from_kibana(new_rule, new_rule['filter']['download_dashboard'])
@@ -1003,7 +1266,10 @@ class ElastAlerter(object):
             else:
                 raise EAException("Could not download filters from %s" % (new_rule['filter']['download_dashboard']))
 
-        blank_rule = {'agg_matches': [],
+        if self.combine_aggregation_queries:
+            new_rule['aggregation_signature'] = self.get_aggregation_signature(new_rule)
+
+        blank_rule = {'agg_matches': AggregationBuffer(self.aggregation_buffer_size, self.aggregation_spill_dir),
                       'aggregate_alert_time': {},
                       'current_aggregate_id': {},
                       'processed_hits': {},
@@ -1020,6 +1286,7 @@ class ElastAlerter(object):
                 rule = blank_rule
 
         copy_properties = ['agg_matches',
+                           'aggregation_summaries',
                            'current_aggregate_id',
                            'aggregate_alert_time',
                            'processed_hits',
@@ -1039,8 +1306,77 @@ class ElastAlerter(object):
                                      jitter=5)
         job.modify(next_run_time=datetime.datetime.now() + datetime.timedelta(seconds=random.randint(0, 15)))
 
+        if new_rule.get('background_warmup'):
+            self.start_rule_warmup(new_rule)
+
         return new_rule
 
+    def start_rule_warmup(self, rule):
+        """ Runs the warmup of a rule's RuleType in a background thread. Until it has finished,
+        handle_rule_execution will skip the rule while every other rule runs normally. """
+        rule['warmup_status'] = 'warming_up'
+        thread = threading.Thread(target=self.run_rule_warmup, args=(rule,), name='warmup_%s' % (rule['name']))
+        thread.daemon = True
+        thread.start()
+
+    def run_rule_warmup(self, rule):
+        elastalert_logger.info('Warming up rule %s in the background' % (rule['name']))
+        warmup_start = time.time()
+        try:
+            rule['type'].warmup()
+        except Exception as e:
+            # A rule that failed to warm up would run with incomplete state, so always disable it
+            rule['warmup_status'] = 'failed'
+            self.handle_error('Error warming up rule %s: %s' % (rule['name'], e), {'rule': rule['name']})
+            with self.rules_lock:
+                # The rule may have been reloaded or removed while it was warming up
+                if not any(running_rule is rule for running_rule in self.rules):
+                    return
+                self.rules = [running_rule for running_rule in self.rules if running_rule['name'] != rule['name']]
+                self.disabled_rules.append(rule)
+                self.scheduler.pause_job(job_id=rule['name'])
+            elastalert_logger.info('Rule %s disabled', rule['name'])
+            if self.notify_email:
+                self.send_notification_email(exception=e, rule=rule)
+            return
+        rule['warmup_status'] = 'ready'
+        elastalert_logger.info('Rule %s finished warming up in %.1f seconds' % (rule['name'], time.time() - warmup_start))
+
+    @staticmethod
+    def get_aggregation_signature(rule):
+        """ Returns a key which is the same for metric aggregation rules whose queries differ only in their
+        metric aggregation, so that one query can answer all of them, or None if the rule can't be combined. """
+        if not isinstance(rule['type'], MetricAggregationRule) or rule.get('use_composite_aggregation'):
+            return None
+        shape_options = ['es_host', 'es_port', 'es_url_prefix', 'index', 'doc_type', 'five', 'filter', 'query_key',
+                         'timestamp_field', 'bucket_interval_period', 'bucket_offset_delta', 'sync_bucket_interval',
+                         'terms_size', 'min_doc_count', 'run_every', 'buffer_time', 'query_delay',
+                         'use_run_every_query_size', 'allow_buffer_time_overlap']
+        shape = [(option, rule.get(option)) for option in shape_options]
+        return json.dumps(shape, sort_keys=True, default=str)
+
+    def get_aggregation_group_endtime(self, rule, endtime):
+        """ Rules with the same aggregation_signature use the endtime of the first of them to run in each run_every
+        period, so that their query windows line up and a single combined query answers all of them. """
+        with self.aggregation_lock:
+            group_endtime = self.aggregation_group_endtimes.get(rule['aggregation_signature'])
+            previous_endtime = rule.get('previous_endtime')
+            if group_endtime and endtime - group_endtime < rule['run_every'] and \
+                    (previous_endtime is None or group_endtime > previous_endtime):
+                return group_endtime
+            self.aggregation_group_endtimes[rule['aggregation_signature']] = endtime
+            return endtime
+
+    def get_combined_aggregation_rule(self, rule):
+        """ Returns a copy of rule whose aggregation_query_element includes the uniquely named metric
+        aggregations of every running rule with the same aggregation_signature """
+        aggregation_query_element = {}
+        for other_rule in self.rules:
+            if other_rule.get('aggregation_signature') == rule['aggregation_signature']:
+                aggregation_query_element.update(other_rule['aggregation_query_element'])
+        aggregation_query_element.update(rule['aggregation_query_element'])
+        return dict(rule, aggregation_query_element=aggregation_query_element)
+
     @staticmethod
     def modify_rule_for_ES5(new_rule):
         # Get ES version per rule
@@ -1063,83 +1399,85 @@ class ElastAlerter(object):
     def load_rule_changes(self):
         """ Using the modification times of rule config files, syncs the running rules
             to match the files in rules_folder by removing, adding or reloading rules. """
-        new_rule_hashes = self.rules_loader.get_hashes(self.conf, self.args.rule)
-
-        # Check each current rule for changes
-        for rule_file, hash_value in self.rule_hashes.items():
-            if rule_file not in new_rule_hashes:
-                # Rule file was deleted
-                elastalert_logger.info('Rule file %s not found, stopping rule execution' % (rule_file))
-                for rule in self.rules:
-                    if rule['rule_file'] == rule_file:
-                        break
-                else:
-                    continue
-                self.scheduler.remove_job(job_id=rule['name'])
-                self.rules.remove(rule)
-                continue
-            if hash_value != new_rule_hashes[rule_file]:
-                # Rule file was changed, reload rule
-                try:
-                    new_rule = self.rules_loader.load_configuration(rule_file, self.conf)
-                    if not new_rule:
-                        logging.error('Invalid rule file skipped: %s' % rule_file)
-                        continue
-                    if 'is_enabled' in new_rule and not new_rule['is_enabled']:
-                        elastalert_logger.info('Rule file %s is now disabled.' % (rule_file))
-                        # Remove this rule if it's been disabled
-                        self.rules = [rule for rule in self.rules if rule['rule_file'] != rule_file]
+        # A rule whose background warmup fails is disabled under the same lock, so a reload can't re-add it
+        with self.rules_lock:
+            new_rule_hashes = self.rules_loader.get_hashes(self.conf, self.args.rule)
+
+            # Check each current rule for changes
+            for rule_file, hash_value in self.rule_hashes.items():
+                if rule_file not in new_rule_hashes:
+                    # Rule file was deleted
+                    elastalert_logger.info('Rule file %s not found, stopping rule execution' % (rule_file))
+                    for rule in self.rules:
+                        if rule['rule_file'] == rule_file:
+                            break
+                    else:
                         continue
-                except EAException as e:
-                    message = 'Could not load rule %s: %s' % (rule_file, e)
-                    self.handle_error(message)
-                    # Want to send email to address specified in the rule. Try and load the YAML to find it.
+                    self.scheduler.remove_job(job_id=rule['name'])
+                    self.rules.remove(rule)
+                    continue
+                if hash_value != new_rule_hashes[rule_file]:
+                    # Rule file was changed, reload rule
                     try:
-                        rule_yaml = self.rules_loader.load_yaml(rule_file)
-                    except EAException:
-                        self.send_notification_email(exception=e)
-                        continue
+                        new_rule = self.rules_loader.load_configuration(rule_file, self.conf)
+                        if not new_rule:
+                            logging.error('Invalid rule file skipped: %s' % rule_file)
+                            continue
+                        if 'is_enabled' in new_rule and not new_rule['is_enabled']:
+                            elastalert_logger.info('Rule file %s is now disabled.' % (rule_file))
+                            # Remove this rule if it's been disabled
+                            self.rules = [rule for rule in self.rules if rule['rule_file'] != rule_file]
+                            continue
+                    except EAException as e:
+                        message = 'Could not load rule %s: %s' % (rule_file, e)
+                        self.handle_error(message)
+                        # Want to send email to address specified in the rule. Try and load the YAML to find it.
+                        try:
+                            rule_yaml = self.rules_loader.load_yaml(rule_file)
+                        except EAException:
+                            self.send_notification_email(exception=e)
+                            continue
 
-                    self.send_notification_email(exception=e, rule=rule_yaml)
-                    continue
-                elastalert_logger.info("Reloading configuration for rule %s" % (rule_file))
-
-                # Re-enable if rule had been disabled
-                for disabled_rule in self.disabled_rules:
-                    if disabled_rule['name'] == new_rule['name']:
-                        self.rules.append(disabled_rule)
-                        self.disabled_rules.remove(disabled_rule)
-                        break
-
-                # Initialize the rule that matches rule_file
-                new_rule = self.init_rule(new_rule, False)
-                self.rules = [rule for rule in self.rules if rule['rule_file'] != rule_file]
-                if new_rule:
-                    self.rules.append(new_rule)
-
-        # Load new rules
-        if not self.args.rule:
-            for rule_file in set(new_rule_hashes.keys()) - set(self.rule_hashes.keys()):
-                try:
-                    new_rule = self.rules_loader.load_configuration(rule_file, self.conf)
-                    if not new_rule:
-                        logging.error('Invalid rule file skipped: %s' % rule_file)
+                        self.send_notification_email(exception=e, rule=rule_yaml)
                         continue
-                    if 'is_enabled' in new_rule and not new_rule['is_enabled']:
+                    elastalert_logger.info("Reloading configuration for rule %s" % (rule_file))
+
+                    # Re-enable if rule had been disabled
+                    for disabled_rule in self.disabled_rules:
+                        if disabled_rule['name'] == new_rule['name']:
+                            self.rules.append(disabled_rule)
+                            self.disabled_rules.remove(disabled_rule)
+                            break
+
+                    # Initialize the rule that matches rule_file
+                    new_rule = self.init_rule(new_rule, False)
+                    self.rules = [rule for rule in self.rules if rule['rule_file'] != rule_file]
+                    if new_rule:
+                        self.rules.append(new_rule)
+
+            # Load new rules
+            if not self.args.rule:
+                for rule_file in set(new_rule_hashes.keys()) - set(self.rule_hashes.keys()):
+                    try:
+                        new_rule = self.rules_loader.load_configuration(rule_file, self.conf)
+                        if not new_rule:
+                            logging.error('Invalid rule file skipped: %s' % rule_file)
+                            continue
+                        if 'is_enabled' in new_rule and not new_rule['is_enabled']:
+                            continue
+                        if new_rule['name'] in [rule['name'] for rule in self.rules]:
+                            raise EAException("A rule with the name %s already exists" % (new_rule['name']))
+                    except EAException as e:
+                        self.handle_error('Could not load rule %s: %s' % (rule_file, e))
+                        self.send_notification_email(exception=e, rule_file=rule_file)
                         continue
-                    if new_rule['name'] in [rule['name'] for rule in self.rules]:
-                        raise EAException("A rule with the name %s already exists" % (new_rule['name']))
-                except EAException as e:
-                    self.handle_error('Could not load rule %s: %s' % (rule_file, e))
-                    self.send_notification_email(exception=e, rule_file=rule_file)
-                    continue
-                if self.init_rule(new_rule):
-                    elastalert_logger.info('Loaded new rule %s' % (rule_file))
-                    if new_rule['name'] in self.es_clients:
-                        self.es_clients.pop(new_rule['name'])
-                    self.rules.append(new_rule)
+                    if self.init_rule(new_rule):
+                        elastalert_logger.info('Loaded new rule %s' % (rule_file))
+                        if new_rule['name'] in self.es_clients:
+                            self.es_clients.pop(new_rule['name'])
+                        self.rules.append(new_rule)
 
-        self.rule_hashes = new_rule_hashes
+            self.rule_hashes = new_rule_hashes
 
     def start(self):
         """ Periodically go through each rule and run it """
@@ -1158,12 +1496,22 @@ class ElastAlerter(object):
         self.wait_until_responsive(timeout=self.args.timeout)
         self.running = True
         elastalert_logger.info("Starting up")
-        # TODO: the seconds parameter needs to be configurable
+        # Pending alerts are sent when they are due, which is tracked in aggregation_deadlines. The sweep, which
+        # also runs at startup, sends those which were not tracked, such as those of another ElastAlert process.
         self.scheduler.add_job(self.handle_pending_alerts, 'interval',
-                               seconds=60, id='_internal_handle_pending_alerts')
+                               seconds=self.pending_alert_sweep_interval.total_seconds(), id='_internal_handle_pending_alerts',
+                               next_run_time=datetime.datetime.now(dateutil.tz.tzutc()))
         self.scheduler.add_job(self.handle_config_change, 'interval',
                                seconds=self.run_every.total_seconds(), id='_internal_handle_config_change')
         self.scheduler.start()
+        if self.preload_pending_aggregates and self.pending_aggregates is None:
+            self.load_pending_aggregates()
+        if self.alert_outbox:
+            # Alerts left in the outbox when ElastAlert stopped
+            for next_try in self.alert_outbox.next_try_times():
+                self.add_aggregation_deadline(next_try)
+        with self.aggregation_deadlines_lock:
+            self.schedule_aggregation_flush()
         while self.running:
             next_run = datetime.datetime.utcnow() + self.run_every
 
@@ -1172,6 +1520,9 @@ class ElastAlerter(object):
                 endtime = ts_to_dt(self.args.end)
 
                 if next_run.replace(tzinfo=dateutil.tz.tzutc()) > endtime:
+                    if self.alert_dispatcher:
+                        self.alert_dispatcher.shutdown()
+                    self.close()
                     exit(0)
 
             if next_run < datetime.datetime.utcnow():
@@ -1181,6 +1532,10 @@ class ElastAlerter(object):
             if self.show_disabled_rules:
                 elastalert_logger.info("Disabled rules are: %s" % (str(self.get_disabled_rules())))
 
+            warming_up_rules = self.get_warming_up_rules()
+            if warming_up_rules:
+                elastalert_logger.info("Rules still warming up are: %s" % (str(warming_up_rules)))
+
             # Wait before querying again
             sleep_duration = total_seconds(next_run - datetime.datetime.utcnow())
             self.sleep_for(sleep_duration)
@@ -1230,10 +1585,43 @@ class ElastAlerter(object):
 
     def handle_pending_alerts(self):
         self.thread_data.alerts_sent = 0
-        self.send_pending_alerts()
+        # The sweep and the aggregation flush must not send the same alerts
+        with self.pending_alerts_lock:
+            self.send_pending_alerts()
         elastalert_logger.info("Background alerts thread %s pending alerts sent at %s" % (self.thread_data.alerts_sent,
                                                                                           pretty_ts(ts_now())))
 
+    def handle_aggregation_deadlines(self):
+        """ Sends the pending alerts once the earliest aggregation deadline is due, and schedules the next flush. """
+        now = ts_now()
+        with self.aggregation_deadlines_lock:
+            while self.aggregation_deadlines and self.aggregation_deadlines[0] <= now:
+                heapq.heappop(self.aggregation_deadlines)
+            self.next_aggregation_flush = None
+        self.handle_pending_alerts()
+        with self.aggregation_deadlines_lock:
+            self.schedule_aggregation_flush()
+
+    def add_aggregation_deadline(self, alert_time):
+        """ Tracks the time at which a pending alert is due, and sends the pending alerts then if it is earlier
+        than the next flush. """
+        if not isinstance(alert_time, datetime.datetime):
+            # The cron schedule of the aggregation could not be parsed
+            return
+        with self.aggregation_deadlines_lock:
+            heapq.heappush(self.aggregation_deadlines, alert_time)
+            if self.next_aggregation_flush is None or alert_time < self.next_aggregation_flush:
+                self.schedule_aggregation_flush()
+
+    def schedule_aggregation_flush(self):
+        """ Schedules handle_aggregation_deadlines for the earliest deadline. Must hold aggregation_deadlines_lock. """
+        if not self.running or not self.aggregation_deadlines:
+            return
+        self.next_aggregation_flush = self.aggregation_deadlines[0]
+        run_date = max(self.next_aggregation_flush + self.aggregation_flush_delay, ts_now())
+        self.scheduler.add_job(self.handle_aggregation_deadlines, 'date', run_date=run_date,
+                               id='_internal_flush_aggregations', replace_existing=True, misfire_grace_time=None)
+
     def handle_config_change(self):
         if not self.args.pin_rules:
             self.load_rule_changes()
@@ -1241,6 +1629,9 @@ class ElastAlerter(object):
 
     def handle_rule_execution(self, rule):
         self.thread_data.alerts_sent = 0
+        if rule.get('warmup_status') == 'warming_up':
+            elastalert_logger.info('Rule %s is still warming up, skipping this run' % (rule['name']))
+            return
         next_run = datetime.datetime.utcnow() + rule['run_every']
         # Set endtime based on the rule's delay
         delay = rule.get('query_delay')
@@ -1250,6 +1641,8 @@ class ElastAlerter(object):
             endtime = ts_now() - delay
         else:
             endtime = ts_now()
+        if rule.get('aggregation_signature') and not (hasattr(self.args, 'end') and self.args.end):
+            endtime = self.get_aggregation_group_endtime(rule, endtime)
 
         # Apply rules based on execution time limits
         if rule.get('limit_execution'):
@@ -1314,11 +1707,40 @@ class ElastAlerter(object):
     def stop(self):
         """ Stop an ElastAlert runner that's been started """
         self.running = False
+        self.close()
+
+    def close(self):
+        """ Sends what the alerters still hold, such as batched Zabbix values, and the writes which are still to be
+        mirrored, before ElastAlert exits. """
+        with self.rules_lock:
+            rules = self.rules + self.disabled_rules
+        for rule in rules:
+            for alerter in rule.get('alert', []):
+                try:
+                    alerter.close()
+                except Exception as e:
+                    elastalert_logger.warning('Error closing alerter %s: %s' % (alerter.get_info()['type'], e))
+        self.writeback_store.close()
+
+    @property
+    def writeback_es(self):
+        """ The writeback Elasticsearch client. """
+        return self._writeback_es
+
+    @writeback_es.setter
+    def writeback_es(self, writeback_es):
+        self._writeback_es = writeback_es
+        if isinstance(getattr(self, 'writeback_store', None), ElasticsearchWriteback):
+            self.writeback_store.writeback_es = writeback_es
 
     def get_disabled_rules(self):
         """ Return disabled rules """
         return [rule['name'] for rule in self.disabled_rules]
 
+    def get_warming_up_rules(self):
+        """ Return rules whose background warmup has not finished yet """
+        return [rule['name'] for rule in self.rules if rule.get('warmup_status') == 'warming_up']
+
     def sleep_for(self, duration):
         """ Sleep for a set duration """
         elastalert_logger.info("Sleeping for %s seconds" % (duration))
@@ -1448,18 +1870,19 @@ class ElastAlerter(object):
             return None
         return filters
 
-    def alert(self, matches, rule, alert_time=None, retried=False):
+    def alert(self, matches, rule, alert_time=None, retried=False, aggregation_summary=None):
         """ Wraps alerting, Kibana linking and enhancements in an exception handler """
         try:
-            return self.send_alert(matches, rule, alert_time=alert_time, retried=retried)
+            return self.send_alert(matches, rule, alert_time=alert_time, retried=retried, aggregation_summary=aggregation_summary)
         except Exception as e:
             self.handle_uncaught_exception(e, rule)
 
-    def send_alert(self, matches, rule, alert_time=None, retried=False):
+    def send_alert(self, matches, rule, alert_time=None, retried=False, aggregation_summary=None):
         """ Send out an alert.
 
         :param matches: A list of matches.
         :param rule: A rule configuration.
+        :param aggregation_summary: The AggregationSummary counted as the matches were aggregated, if any.
         """
         if not matches:
             return
@@ -1469,6 +1892,7 @@ class ElastAlerter(object):
 
         # Compute top count keys
         if rule.get('top_count_keys'):
+            lookups = []
             for match in matches:
                 if 'query_key' in rule:
                     qk = lookup_es_key(match, rule['query_key'])
@@ -1485,8 +1909,9 @@ class ElastAlerter(object):
 
                 start = ts_to_dt(lookup_es_key(match, rule['timestamp_field'])) - timeframe
                 end = ts_to_dt(lookup_es_key(match, rule['timestamp_field'])) + datetime.timedelta(minutes=10)
-                keys = rule.get('top_count_keys')
-                counts = self.get_top_counts(rule, start, end, keys, qk=qk)
+                lookups.append((start, end, qk))
+            all_counts = self.get_top_counts_batch(rule, lookups, rule['top_count_keys'])
+            for match, counts in zip(matches, all_counts):
                 match.update(counts)
 
         # Generate a kibana3 dashboard for the first match
@@ -1516,6 +1941,9 @@ class ElastAlerter(object):
         # run_enhancements_first is set or
         # retried==True, which means this is a retry of a failed alert
         if not rule.get('run_enhancements_first') and not retried:
+            if rule['match_enhancements']:
+                # The enhancements may change the values of the summary table
+                aggregation_summary = None
             for enhancement in rule['match_enhancements']:
                 valid_matches = []
                 for match in matches:
@@ -1548,24 +1976,87 @@ class ElastAlerter(object):
             alerter.alert(matches)
             return None
 
-        # Run the alerts
-        alert_sent = False
-        alert_exception = None
+        outbox_id = None
+        if self.alert_outbox:
+            # Record the alert before sending it, so that it is retried even if ElastAlert stops
+            outbox_id = self.alert_outbox.add(rule['name'], matches, alert_time)
+        try:
+            self.deliver_alert(matches, rule, alert_time, outbox_id, aggregation_summary)
+        except Exception:
+            if outbox_id:
+                self.alert_outbox.release(outbox_id)
+            raise
+
+    def deliver_alert(self, matches, rule, alert_time, outbox_id=None, aggregation_summary=None):
+        """ Sends matches with each alerter of the rule and records the outcome.
+
+        :param matches: A list of matches.
+        :param rule: A rule configuration.
+        :param alert_time: The alert time.
+        :param outbox_id: The id of the alert in the outbox, if any.
+        :param aggregation_summary: The AggregationSummary of the matches, if any.
+        """
         # Alert.pipeline is a single object shared between every alerter
         # This allows alerters to pass objects and data between themselves
         alert_pipeline = {"alert_time": alert_time}
+        if aggregation_summary:
+            alert_pipeline['aggregation_summary'] = aggregation_summary
+
+        # Hand the alerts to the dispatcher, which writes them to ES once they have been sent
+        if self.alert_dispatcher:
+            self.alert_dispatcher.dispatch(rule['alert'], matches, alert_pipeline,
+                                           lambda results: self.handle_alert_results(matches, rule, alert_time, results, outbox_id))
+            return
+
+        # Run the alerts
+        results = []
         for alert in rule['alert']:
             alert.pipeline = alert_pipeline
             try:
                 alert.alert(matches)
             except EAException as e:
-                self.handle_error('Error while running alert %s: %s' % (alert.get_info()['type'], e), {'rule': rule['name']})
-                alert_exception = str(e)
+                results.append((alert, e))
             else:
-                self.thread_data.alerts_sent += 1
+                results.append((alert, None))
+        self.handle_alert_results(matches, rule, alert_time, results, outbox_id)
+
+    def handle_alert_results(self, matches, rule, alert_time, results, outbox_id=None):
+        """ Reports the errors of the alerters and writes the alert(s) to ES.
+
+        :param matches: A list of matches.
+        :param rule: A rule configuration.
+        :param alert_time: The alert time.
+        :param results: A list of (alerter, exception or None) for each alerter of the rule.
+        :param outbox_id: The id of the alert in the outbox, if any.
+        """
+        alert_sent = False
+        alert_exception = None
+        for alert, exception in results:
+            if exception is None:
                 alert_sent = True
+                self.count_alert_sent(rule)
+            else:
+                self.handle_error('Error while running alert %s: %s' % (alert.get_info()['type'], exception), {'rule': rule['name']})
+                alert_exception = str(exception)
+
+        if outbox_id:
+            if alert_sent:
+                self.alert_outbox.complete(outbox_id)
+            else:
+                # The alert is written to ES once the outbox has sent it, or by write_expired_alert once it has given up
+                if self.alert_outbox.retry(outbox_id, alert_exception):
+                    for next_try in self.alert_outbox.next_try_times([outbox_id]):
+                        self.add_aggregation_deadline(next_try)
+                return
+
+        if not alert_sent:
+            # The alert is written to ES as pending, retry it then
+            self.add_aggregation_deadline(ts_now() + self.pending_alert_retry_interval)
+
+        self.write_alert(matches, rule, alert_sent, alert_time, alert_exception)
 
-        # Write the alert(s) to ES
+    def write_alert(self, matches, rule, alert_sent, alert_time, alert_exception=None):
+        """ Writes the alert(s) to ES, with every match after the first aggregated to the first one. """
         agg_id = None
         for match in matches:
             alert_body = self.get_alert_body(match, rule, alert_sent, alert_time, alert_exception)
@@ -1576,6 +2067,40 @@ class ElastAlerter(object):
             if res and not agg_id:
                 agg_id = res['_id']
 
+    def write_expired_alert(self, entry):
+        """ Writes an alert which the outbox dropped, because it could not be sent within alert_time_limit,
+        to ES as unsent, with its last error. """
+        with self.rules_lock:
+            rule = next((rule for rule in self.rules if rule['name'] == entry['rule_name']), None)
+        if rule is not None:
+            self.write_alert(entry['matches'], rule, False, entry['alert_time'], entry['error'])
+            return
+
+        # The original rule is missing, record what the outbox knows about the alert
+        agg_id = None
+        for match in entry['matches']:
+            alert_body = {
+                'match_body': match,
+                'rule_name': entry['rule_name'],
+                'alert_sent': False,
+                'alert_time': entry['alert_time'],
+                'alert_exception': entry['error'],
+            }
+            if agg_id:
+                alert_body['aggregate_id'] = agg_id
+            res = self.writeback('elastalert', alert_body)
+            if res and not agg_id:
+                agg_id = res['_id']
+
+    def count_alert_sent(self, rule):
+        """ Counts an alert which was sent, in the current run of the rule, or in its next run for alerts sent by
+        the dispatcher's worker threads. """
+        if self.alert_dispatcher:
+            with self.dispatched_alerts_sent_lock:
+                self.dispatched_alerts_sent[rule['name']] = self.dispatched_alerts_sent.get(rule['name'], 0) + 1
+        else:
+            self.thread_data.alerts_sent += 1
+
     def get_alert_body(self, match, rule, alert_sent, alert_time, alert_exception=None):
         body = {
             'match_body': match,
@@ -1625,46 +2150,63 @@ class ElastAlerter(object):
             writeback_body['@timestamp'] = dt_to_ts(ts_now())
 
         try:
-            index = self.writeback_es.resolve_writeback_index(self.writeback_index, doc_type)
-            if self.writeback_es.is_atleastsixtwo():
-                res = self.writeback_es.index(index=index, body=body)
-            else:
-                res = self.writeback_es.index(index=index, doc_type=doc_type, body=body)
-            return res
-        except ElasticsearchException as e:
-            logging.exception("Error writing alert info to Elasticsearch: %s" % (e))
+            return self.writeback_store.index(doc_type, writeback_body)
+        except (ElasticsearchException, sqlite3.Error) as e:
+            logging.exception("Error writing alert info to %s: %s" % (self.writeback_store.name, e))
 
     def find_recent_pending_alerts(self, time_limit):
-        """ Queries writeback_es to find alerts that did not send
-        and are newer than time_limit """
-
-        # XXX only fetches 1000 results. If limit is reached, next loop will catch them
-        # unless there is constantly more than 1000 alerts to send.
+        """ Queries the writeback store to find alerts that did not send
+        and are newer than time_limit. Yields them one page at a time. """
 
         # Fetch recent, unsent alerts that aren't part of an aggregate, earlier alerts first.
-        inner_query = {'query_string': {'query': '!_exists_:aggregate_id AND alert_sent:false'}}
-        time_filter = {'range': {'alert_time': {'from': dt_to_ts(ts_now() - time_limit),
-                                                'to': dt_to_ts(ts_now())}}}
-        sort = {'sort': {'alert_time': {'order': 'asc'}}}
-        if self.writeback_es.is_atleastfive():
-            query = {'query': {'bool': {'must': inner_query, 'filter': time_filter}}}
-        else:
-            query = {'query': inner_query, 'filter': time_filter}
-        query.update(sort)
+        starttime = ts_now() - time_limit
         try:
-            if self.writeback_es.is_atleastsixtwo():
-                res = self.writeback_es.search(index=self.writeback_index, body=query, size=1000)
-            else:
-                res = self.writeback_es.deprecated_search(index=self.writeback_index,
-                                                          doc_type='elastalert', body=query, size=1000)
-            if res['hits']['hits']:
-                return res['hits']['hits']
-        except ElasticsearchException as e:
-            logging.exception("Error finding recent pending alerts: %s %s" % (e, query))
-        return []
+            # XXX Before Elasticsearch 5, only 1000 results are fetched. If the limit is reached, the next loop
+            # will catch them, unless there are constantly more than 1000 alerts to send.
+            for hits in self.writeback_store.find_pending_alerts(starttime, ts_now(), self.writeback_page_size, 1000):
+                yield hits
+        except (ElasticsearchException, sqlite3.Error) as e:
+            logging.exception("Error finding recent pending alerts since %s: %s" % (pretty_ts(starttime), e))
 
     def send_pending_alerts(self):
-        pending_alerts = self.find_recent_pending_alerts(self.alert_time_limit)
+        if self.alert_outbox:
+            self.send_outbox_alerts()
+
+        # With an outbox, failed alerts are not left pending in ES, only aggregated alerts and those from before it was enabled
+        pending_alerts = []
+        if not self.alert_outbox or not self.pending_alerts_scanned or any(rule.get('aggregation') for rule in self.rules):
+            pending_alerts = self.find_recent_pending_alerts(self.alert_time_limit)
+            self.pending_alerts_scanned = True
+        rules_by_name = dict((rule['name'], rule) for rule in self.rules)
+        for page in pending_alerts:
+            sent_ids = []
+            try:
+                self.send_writeback_alerts(page, rules_by_name, sent_ids)
+            finally:
+                # Delete the sent alerts from the index
+                try:
+                    self.delete_writeback_docs(sent_ids)
+                except ElasticsearchException as e:
+                    self.handle_error("Failed to delete sent alerts: %s" % (e), {'ids': sent_ids})
+
+        # Drop the summaries of aggregations which are too old to be sent
+        expiry = ts_now() - self.alert_time_limit
+        for rule in self.rules:
+            summaries = rule.get('aggregation_summaries', {})
+            for summary_id, summary in list(summaries.items()):
+                if not isinstance(summary.alert_time, datetime.datetime) or summary.alert_time < expiry:
+                    summaries.pop(summary_id, None)
+
+        # Send in memory aggregated alerts
+        for rule in self.rules:
+            for aggregation_key_value in rule['agg_matches'].keys():
+                aggregate_alert_time = rule['aggregate_alert_time'].get(aggregation_key_value)
+                if aggregate_alert_time and ts_now() > aggregate_alert_time:
+                    self.alert(rule['agg_matches'].pop(aggregation_key_value), rule)
+
+    def send_writeback_alerts(self, pending_alerts, rules_by_name, sent_ids):
+        """ Sends the pending alerts found in the writeback index which are due, and appends the ids of those which
+        were sent to sent_ids. """
         for alert in pending_alerts:
             _id = alert['_id']
             alert = alert['_source']
@@ -1677,22 +2219,24 @@ class ElastAlerter(object):
                 continue
 
             # Find original rule
-            for rule in self.rules:
-                if rule['name'] == rule_name:
-                    break
-            else:
+            rule = rules_by_name.get(rule_name)
+            if rule is None:
                 # Original rule is missing, keep alert for later if rule reappears
                 continue
 
             # Set current_es for top_count_keys query
-            self.thread_data.current_es = elasticsearch_client(rule)
+            self.thread_data.current_es = self.get_rule_es(rule)
 
             # Send the alert unless it's a future alert
             if ts_now() > ts_to_dt(alert_time):
                 aggregated_matches = self.get_aggregated_matches(_id)
+                aggregation_summary = rule.get('aggregation_summaries', {}).pop(_id, None)
+                if aggregation_summary and aggregation_summary.total != len(aggregated_matches) + 1:
+                    # Some matches were dropped, or added by another process, count them again
+                    aggregation_summary = None
                 if aggregated_matches:
-                    matches = [match_body] + [agg_match['match_body'] for agg_match in aggregated_matches]
-                    self.alert(matches, rule, alert_time=alert_time)
+                    matches = [match_body] + [hit['_source']['match_body'] for hit in aggregated_matches]
+                    self.alert(matches, rule, alert_time=alert_time, aggregation_summary=aggregation_summary)
                 else:
                     # If this rule isn't using aggregation, this must be a retry of a failed alert
                     retried = False
@@ -1705,81 +2249,113 @@ class ElastAlerter(object):
                         if agg_id == _id:
                             rule['current_aggregate_id'].pop(qk)
                             break
+                self.remove_pending_aggregate(rule, _id)
 
-                # Delete it from the index
-                try:
-                    if self.writeback_es.is_atleastsixtwo():
-                        self.writeback_es.delete(index=self.writeback_index, id=_id)
-                    else:
-                        self.writeback_es.delete(index=self.writeback_index, doc_type='elastalert', id=_id)
-                except ElasticsearchException:  # TODO: Give this a more relevant exception, try:except: is evil.
-                    self.handle_error("Failed to delete alert %s at %s" % (_id, alert_time))
+                sent_ids.append(_id)
 
-        # Send in memory aggregated alerts
-        for rule in self.rules:
-            if rule['agg_matches']:
-                for aggregation_key_value, aggregate_alert_time in rule['aggregate_alert_time'].items():
-                    if ts_now() > aggregate_alert_time:
-                        alertable_matches = [
-                            agg_match
-                            for agg_match
-                            in rule['agg_matches']
-                            if self.get_aggregation_key_value(rule, agg_match) == aggregation_key_value
-                        ]
-                        self.alert(alertable_matches, rule)
-                        rule['agg_matches'] = [
-                            agg_match
-                            for agg_match
-                            in rule['agg_matches']
-                            if self.get_aggregation_key_value(rule, agg_match) != aggregation_key_value
-                        ]
+    def send_outbox_alerts(self):
+        """ Retries the alerts in the outbox which are due. """
+        rules_by_name = dict((rule['name'], rule) for rule in self.rules)
+        for entry in self.alert_outbox.due():
+            # Find original rule
+            rule = rules_by_name.get(entry['rule_name'])
+            if rule is None:
+                # Original rule is missing, keep alert for later if rule reappears
+                self.alert_outbox.release(entry['id'])
+                continue
 
-    def get_aggregated_matches(self, _id):
-        """ Removes and returns all matches from writeback_es that have aggregate_id == _id """
+            try:
+                self.deliver_alert(entry['matches'], rule, entry['alert_time'], entry['id'])
+            except Exception as e:
+                self.alert_outbox.release(entry['id'])
+                self.handle_uncaught_exception(e, rule)
 
-        # XXX if there are more than self.max_aggregation matches, you have big alerts and we will leave entries in ES.
-        query = {'query': {'query_string': {'query': 'aggregate_id:%s' % (_id)}}, 'sort': {'@timestamp': 'asc'}}
+    def get_aggregated_matches(self, _id):
+        """ Removes all matches from the writeback store that have aggregate_id == _id, one page at a time,
+        and returns the hits of the earliest max_aggregation of them. """
         matches = []
+        dropped = 0
         try:
-            if self.writeback_es.is_atleastsixtwo():
-                res = self.writeback_es.search(index=self.writeback_index, body=query,
-                                               size=self.max_aggregation)
-            else:
-                res = self.writeback_es.deprecated_search(index=self.writeback_index, doc_type='elastalert',
-                                                          body=query, size=self.max_aggregation)
-            for match in res['hits']['hits']:
-                matches.append(match['_source'])
-                if self.writeback_es.is_atleastsixtwo():
-                    self.writeback_es.delete(index=self.writeback_index, id=match['_id'])
-                else:
-                    self.writeback_es.delete(index=self.writeback_index, doc_type='elastalert', id=match['_id'])
-        except (KeyError, ElasticsearchException) as e:
+            for hits in self.writeback_store.get_aggregated_matches(_id, self.writeback_page_size, self.max_aggregation):
+                kept = max(self.max_aggregation - len(matches), 0)
+                matches.extend(hits[:kept])
+                dropped += len(hits[kept:])
+                self.delete_writeback_docs([match['_id'] for match in hits])
+        except (KeyError, ElasticsearchException, sqlite3.Error) as e:
             self.handle_error("Error fetching aggregated matches: %s" % (e), {'id': _id})
+        if dropped:
+            elastalert_logger.warning('Dropped %d matches from aggregate %s, over max_aggregation' % (dropped, _id))
         return matches
 
+    def delete_writeback_docs(self, ids):
+        """ Deletes documents from the writeback store. """
+        failed = self.writeback_store.delete(ids)
+        if failed:
+            self.handle_error("Failed to delete %d documents: %s" % (len(failed), failed[0].get('error')),
+                              {'ids': [item['_id'] for item in failed]})
+
+    def load_pending_aggregates(self):
+        """ Loads the pending aggregations of every rule with a single paginated query, so that
+        find_pending_aggregate_alert does not need to query the writeback index for each aggregation key.
+        Returns False if they could not be loaded. """
+        pending_aggregates = {}
+        deadlines = []
+        try:
+            # XXX Before Elasticsearch 5, only the first 10000 pending aggregations are loaded
+            for hits in self.writeback_store.find_pending_alerts(ts_now(), None, self.writeback_page_size, 10000):
+                for hit in hits:
+                    # Later alerts replace earlier ones, as find_pending_aggregate_alert returns the latest
+                    pending = {'_id': hit['_id'], '_source': {'alert_time': hit['_source']['alert_time']}}
+                    rule_aggregates = pending_aggregates.setdefault(hit['_source']['rule_name'], {})
+                    rule_aggregates[hit['_source'].get('aggregation_key')] = pending
+                    deadlines.append(ts_to_dt(hit['_source']['alert_time']))
+        except (KeyError, ElasticsearchException, sqlite3.Error) as e:
+            self.handle_error("Error loading pending aggregations: %s" % (e))
+            return False
+        with self.pending_aggregates_lock:
+            self.pending_aggregates = pending_aggregates
+        for alert_time in deadlines:
+            self.add_aggregation_deadline(alert_time)
+        elastalert_logger.info('Loaded %d pending aggregations' % (sum(map(len, pending_aggregates.values()))))
+        return True
+
+    def set_pending_aggregate(self, rule, aggregation_key_value, _id, alert_time):
+        """ Records a new pending aggregation in the index loaded by load_pending_aggregates. """
+        with self.pending_aggregates_lock:
+            if self.pending_aggregates is not None:
+                pending = {'_id': _id, '_source': {'alert_time': dt_to_ts(alert_time)}}
+                self.pending_aggregates.setdefault(rule['name'], {})[aggregation_key_value] = pending
+
+    def remove_pending_aggregate(self, rule, _id):
+        """ Removes an aggregation which was sent from the index loaded by load_pending_aggregates. """
+        with self.pending_aggregates_lock:
+            rule_aggregates = (self.pending_aggregates or {}).get(rule['name'], {})
+            for aggregation_key_value, pending in list(rule_aggregates.items()):
+                if pending['_id'] == _id:
+                    del rule_aggregates[aggregation_key_value]
+
     def find_pending_aggregate_alert(self, rule, aggregation_key_value=None):
-        query = {'filter': {'bool': {'must': [{'term': {'rule_name': rule['name']}},
-                                              {'range': {'alert_time': {'gt': ts_now()}}},
-                                              {'term': {'alert_sent': 'false'}}],
-                                     'must_not': [{'exists': {'field': 'aggregate_id'}}]}}}
-        if aggregation_key_value:
-            query['filter']['bool']['must'].append({'term': {'aggregation_key': aggregation_key_value}})
-        if self.writeback_es.is_atleastfive():
-            query = {'query': {'bool': query}}
-        query['sort'] = {'alert_time': {'order': 'desc'}}
+        if self.preload_pending_aggregates:
+            if self.pending_aggregates is None:
+                self.load_pending_aggregates()
+            with self.pending_aggregates_lock:
+                if self.pending_aggregates is not None:
+                    rule_aggregates = self.pending_aggregates.get(rule['name'], {})
+                    if aggregation_key_value:
+                        candidates = [rule_aggregates.get(aggregation_key_value)]
+                    else:
+                        # Like the query below, without an aggregation key any aggregation of the rule matches
+                        candidates = list(rule_aggregates.values())
+                    now = ts_now()
+                    candidates = [pending for pending in candidates if pending and ts_to_dt(pending['_source']['alert_time']) > now]
+                    return max(candidates, key=lambda pending: ts_to_dt(pending['_source']['alert_time'])) if candidates else None
+
         try:
-            if self.writeback_es.is_atleastsixtwo():
-                res = self.writeback_es.search(index=self.writeback_index, body=query, size=1)
-            else:
-                res = self.writeback_es.deprecated_search(index=self.writeback_index, doc_type='elastalert', body=query, size=1)
-            if len(res['hits']['hits']) == 0:
-                return None
-        except (KeyError, ElasticsearchException) as e:
+            return self.writeback_store.find_pending_aggregate_alert(rule['name'], ts_now(), aggregation_key_value)
+        except (KeyError, ElasticsearchException, sqlite3.Error) as e:
             self.handle_error("Error searching for pending aggregated matches: %s" % (e), {'rule_name': rule['name']})
             return None
 
-        return res['hits']['hits'][0]
-
     def add_aggregated_alert(self, match, rule):
         """ Save a match as a pending aggregate alert to Elasticsearch. """
 
@@ -1795,6 +2371,7 @@ class ElastAlerter(object):
             if pending_alert:
                 alert_time = ts_to_dt(pending_alert['_source']['alert_time'])
                 rule['aggregate_alert_time'][aggregation_key_value] = alert_time
+                self.add_aggregation_deadline(alert_time)
                 agg_id = pending_alert['_id']
                 rule['current_aggregate_id'] = {aggregation_key_value: agg_id}
                 elastalert_logger.info(
@@ -1823,6 +2400,7 @@ class ElastAlerter(object):
                         alert_time = ts_now() + rule['aggregation']
 
                 rule['aggregate_alert_time'][aggregation_key_value] = alert_time
+                self.add_aggregation_deadline(alert_time)
                 agg_id = None
                 elastalert_logger.info(
                     'New aggregation for %s, aggregation_key: %s. next alert at %s.' % (rule['name'], aggregation_key_value, alert_time)
@@ -1850,10 +2428,20 @@ class ElastAlerter(object):
         # If new aggregation, save _id
         if res and not agg_id:
             rule['current_aggregate_id'][aggregation_key_value] = res['_id']
+            self.set_pending_aggregate(rule, aggregation_key_value, res['_id'], alert_time)
+
+        # Count the match in the summary table of its aggregation, so that it is not counted again when the alert is sent
+        if res and 'summary_table_fields' in rule:
+            summaries = rule.setdefault('aggregation_summaries', {})
+            summary_id = agg_id or res['_id']
+            if summary_id not in summaries:
+                summaries[summary_id] = AggregationSummary.from_rule(rule, written=True)
+                summaries[summary_id].alert_time = alert_time
+            summaries[summary_id].add(match)
 
         # Couldn't write the match to ES, save it in memory for now
         if not res:
-            rule['agg_matches'].append(match)
+            rule['agg_matches'].add(aggregation_key_value, match)
 
         return res
 
@@ -1901,34 +2489,15 @@ class ElastAlerter(object):
 
         if self.debug:
             return False
-        query = {'term': {'rule_name': rule_name}}
-        sort = {'sort': {'until': {'order': 'desc'}}}
-        if self.writeback_es.is_atleastfive():
-            query = {'query': query}
-        else:
-            query = {'filter': query}
-        query.update(sort)
-
         try:
-            doc_type = 'silence'
-            index = self.writeback_es.resolve_writeback_index(self.writeback_index, doc_type)
-            if self.writeback_es.is_atleastsixtwo():
-                if self.writeback_es.is_atleastsixsix():
-                    res = self.writeback_es.search(index=index, size=1, body=query,
-                                                   _source_includes=['until', 'exponent'])
-                else:
-                    res = self.writeback_es.search(index=index, size=1, body=query,
-                                                   _source_include=['until', 'exponent'])
-            else:
-                res = self.writeback_es.deprecated_search(index=index, doc_type=doc_type,
-                                                          size=1, body=query, _source_include=['until', 'exponent'])
-        except ElasticsearchException as e:
+            silence = self.writeback_store.get_silence(rule_name)
+        except (ElasticsearchException, sqlite3.Error) as e:
             self.handle_error("Error while querying for alert silence status: %s" % (e), {'rule': rule_name})
 
             return False
-        if res['hits']['hits']:
-            until_ts = res['hits']['hits'][0]['_source']['until']
-            exponent = res['hits']['hits'][0]['_source'].get('exponent', 0)
+        if silence:
+            until_ts = silence['until']
+            exponent = silence.get('exponent', 0)
             if rule_name not in list(self.silence_cache.keys()):
                 self.silence_cache[rule_name] = (ts_to_dt(until_ts), exponent)
             else:
@@ -1952,9 +2521,10 @@ class ElastAlerter(object):
         logging.error(traceback.format_exc())
         self.handle_error('Uncaught exception running rule %s: %s' % (rule['name'], exception), {'rule': rule['name']})
         if self.disable_rules_on_error:
-            self.rules = [running_rule for running_rule in self.rules if running_rule['name'] != rule['name']]
-            self.disabled_rules.append(rule)
-            self.scheduler.pause_job(job_id=rule['name'])
+            with self.rules_lock:
+                self.rules = [running_rule for running_rule in self.rules if running_rule['name'] != rule['name']]
+                self.disabled_rules.append(rule)
+                self.scheduler.pause_job(job_id=rule['name'])
             elastalert_logger.info('Rule %s disabled', rule['name'])
         if self.notify_email:
             self.send_notification_email(exception=exception, rule=rule)
@@ -2026,6 +2596,123 @@ class ElastAlerter(object):
 
         return all_counts
 
+    def get_top_counts_batch(self, rule, lookups, keys, number=None):
+        """ Counts the number of events for each unique value for each key field, for several windows at once.
+        Each distinct window and query_key value is counted with a single search, with one terms aggregation per key,
+        and the searches are sent together with msearch. Counts are cached for top_count_cache_ttl seconds.
+
+        :param rule: The rule configuration dictionary.
+        :param lookups: A list of (starttime, endtime, query_key value or None) tuples.
+        :param keys: The fields to count.
+        :return: A list of dictionaries with top_events_<key> mapped to the top counts for each key, one per lookup.
+        """
+        if not number:
+            number = rule.get('top_count_number', 5)
+        self.top_counts_cache.expire()
+        results = {}
+        searches = []
+        for starttime, endtime, qk in lookups:
+            lookup = self.round_top_count_lookup(rule, starttime, endtime, qk, keys, number)
+            if lookup in results:
+                continue
+            if 'top_count_window' in rule:
+                # Count the events already fetched by the rule, if they cover the window
+                results[lookup] = rule['top_count_window'].get_counts(starttime, endtime, qk, number)
+                if results[lookup] is not None:
+                    continue
+            results[lookup] = self.top_counts_cache.get(lookup)
+            if results[lookup] is None:
+                searches.append(lookup)
+
+        for i in range(0, len(searches), self.top_count_msearch_size):
+            chunk = searches[i:i + self.top_count_msearch_size]
+            for lookup, counts in zip(chunk, self.msearch_top_counts(rule, chunk)):
+                results[lookup] = counts
+
+        empty = dict(('top_events_%s' % (key), {}) for key in keys)
+        return [results[self.round_top_count_lookup(rule, starttime, endtime, qk, keys, number)] or empty
+                for starttime, endtime, qk in lookups]
+
+    def round_top_count_lookup(self, rule, starttime, endtime, qk, keys, number):
+        # Round the window to whole minutes so that the matches of an aggregation share cached counts
+        starttime = starttime.replace(second=0, microsecond=0)
+        endtime = endtime.replace(second=0, microsecond=0)
+        return (rule['name'], starttime, endtime, qk, tuple(keys), number)
+
+    def msearch_top_counts(self, rule, lookups):
+        """ Runs the top counts searches of lookups with a single msearch.
+        Returns a list of counts dictionaries, or None for the searches which failed. """
+        body = []
+        key_groups = []
+        for _, starttime, endtime, qk, keys, number in lookups:
+            # The query_key filter may depend on the key, keys which share a filter share a search
+            groups = {}
+            for key in keys:
+                rule_filter = self.get_qk_filter(rule, qk, key)
+                groups.setdefault(json.dumps(rule_filter, sort_keys=True, default=str), (rule_filter, []))[1].append(key)
+            key_groups.append(list(groups.values()))
+            for rule_filter, group_keys in groups.values():
+                header, query = self.get_top_counts_query(rule, starttime, endtime, rule_filter, group_keys, number)
+                body.extend([header, query])
+
+        try:
+            responses = self.thread_data.current_es.msearch(body=body)['responses']
+        except ElasticsearchException as e:
+            if len(str(e)) > 1024:
+                e = str(e)[:1024] + '... (%d characters removed)' % (len(str(e)) - 1024)
+            self.handle_error('Error running top counts query: %s' % (e), {'rule': rule['name']})
+            return [None] * len(lookups)
+
+        all_counts = []
+        responses = iter(responses)
+        for lookup, groups in zip(lookups, key_groups):
+            number = lookup[5]
+            counts = {}
+            for _, group_keys in groups:
+                res = next(responses)
+                if 'error' in res:
+                    self.handle_error('Error running top counts query: %s' % (str(res['error'])[:1024]), {'rule': rule['name']})
+                    counts = None
+                    continue
+                aggregations = res.get('aggregations', {})
+                if not rule['five'] and aggregations:
+                    aggregations = aggregations['filtered']
+                for i, key in enumerate(group_keys):
+                    buckets = aggregations.get('counts_%d' % (i), {}).get('buckets', [])
+                    terms = sorted(((bucket['key'], bucket['doc_count']) for bucket in buckets), key=lambda x: x[1], reverse=True)
+                    if counts is not None:
+                        counts['top_events_%s' % (key)] = dict(terms[:number])
+            if counts is not None and self.top_counts_cache.ttl:
+                self.top_counts_cache.set(lookup, counts)
+            all_counts.append(counts)
+        return all_counts
+
+    def get_top_counts_query(self, rule, starttime, endtime, rule_filter, keys, number):
+        """ Returns an msearch header and a query counting the top values of each of keys. """
+        base_query = self.get_query(
+            rule_filter,
+            starttime,
+            endtime,
+            timestamp_field=rule['timestamp_field'],
+            sort=False,
+            to_ts_func=rule['dt_to_ts'],
+            five=rule['five']
+        )
+        query = self.get_terms_query(base_query, rule, number, keys[0], rule['five'])
+        aggs = query['aggs'] if rule['five'] else query['aggs']['filtered']['aggs']
+        terms = aggs.pop('counts')['terms']
+        for i, key in enumerate(keys):
+            aggs['counts_%d' % (i)] = {'terms': dict(terms, field=key)}
+
+        header = {'index': self.get_index(rule, starttime, endtime), 'ignore_unavailable': True}
+        if not self.thread_data.current_es.is_atleastseven():
+            header['type'] = rule['doc_type']
+        if rule['five']:
+            query['size'] = 0
+        else:
+            header['search_type'] = 'count'
+        return header, query
+
     def next_alert_time(self, rule, name, timestamp):
         """ Calculate an 'until' time and exponent based on how much past the last 'until' we are. """
         if name in self.silence_cache:
@@ -2052,8 +2739,10 @@ class ElastAlerter(object):
         return timestamp + wait, exponent
 
 
-def handle_signal(signal, frame):
+def handle_signal(signal, frame, client=None):
     elastalert_logger.info('SIGINT received, stopping ElastAlert...')
+    if client is not None:
+        client.close()
     # use os._exit to exit immediately and avoid someone catching SystemExit
     os._exit(0)
 
@@ -2063,6 +2752,7 @@ def main(args=None):
     if not args:
         args = sys.argv[1:]
     client = ElastAlerter(args)
+    signal.signal(signal.SIGINT, lambda signum, frame: handle_signal(signum, frame, client))
     if not client.args.silence:
         client.start()
 
@@ -2,7 +2,6 @@
 import json
 import logging
 import os.path
-import requests
 
 from .alerts import Alerter
 from .alerts import BasicMatchString
@@ -112,7 +111,7 @@ class OpsGenieAlerter(Alerter):
         proxies = {'https': self.opsgenie_proxy} if self.opsgenie_proxy else None
 
         try:
-            r = requests.post(self.to_addr, json=post, headers=headers, proxies=proxies)
+            r = self.http_post(self.to_addr, json=post, headers=headers, proxies=proxies)
 
             logging.debug('request response: {0}'.format(r))
             if r.status_code != 202:
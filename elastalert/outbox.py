@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+import collections
+import json
+import os
+import threading
+import time
+import uuid
+
+from .alerts import DateTimeEncoder
+from .util import dt_to_ts
+from .util import elastalert_logger
+from .util import ts_now
+from .util import ts_to_dt
+from .util import unix_to_dt
+
+
+class AlertOutbox(object):
+    """ A local, append-only log of the alerts which have not been sent yet.
+
+    Alerts are added before they are sent and checkpointed once they have been sent, so that an alert which
+    fails to send, or which was being sent when ElastAlert stopped, is retried without querying the writeback
+    index. Failed alerts are retried after retry_backoff seconds, doubled on each retry up to max_backoff,
+    until they are older than time_limit. The log is rewritten with only the pending alerts when it is opened
+    and whenever most of its records are stale.
+
+    :param path: The path of the log file.
+    :param time_limit: A timedelta after which an alert which could not be sent is dropped.
+    :param retry_backoff: The number of seconds to wait before the first retry.
+    :param max_backoff: The maximum number of seconds to wait between retries.
+    :param on_expired: A function called with each alert which is dropped, after the lock is released.
+    """
+
+    compact_threshold = 1000
+
+    def __init__(self, path, time_limit, retry_backoff=30, max_backoff=3600, on_expired=None):
+        self.path = path
+        self.time_limit = time_limit
+        self.retry_backoff = retry_backoff
+        self.max_backoff = max_backoff
+        self.on_expired = on_expired
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.in_flight = set()
+        self.records = 0
+        self.load()
+        self.compact()
+
+    def load(self):
+        """ Replays the log to find the pending alerts. """
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as log:
+            for line in log:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A partial record written when ElastAlert stopped, nothing follows it
+                    elastalert_logger.warning('Ignoring partial record in alert outbox %s' % (self.path))
+                    break
+                if record['op'] == 'add':
+                    self.entries[record['id']] = record
+                elif record['id'] in self.entries:
+                    if record['op'] == 'done':
+                        del self.entries[record['id']]
+                    else:
+                        self.entries[record['id']].update(attempts=record['attempts'], next_try=record['next_try'],
+                                                          error=record['error'])
+
+    def append(self, record):
+        with open(self.path, 'a') as log:
+            log.write(json.dumps(record, cls=DateTimeEncoder) + '\n')
+            log.flush()
+            os.fsync(log.fileno())
+        self.records += 1
+
+    def compact(self):
+        """ Rewrites the log with only the pending alerts. """
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as log:
+            for entry in self.entries.values():
+                log.write(json.dumps(entry, cls=DateTimeEncoder) + '\n')
+            log.flush()
+            os.fsync(log.fileno())
+        os.replace(tmp_path, self.path)
+        self.records = len(self.entries)
+
+    def add(self, rule_name, matches, alert_time):
+        """ Records an alert which is about to be sent and returns its id. """
+        entry = {
+            'op': 'add',
+            'id': uuid.uuid4().hex,
+            'rule_name': rule_name,
+            'alert_time': dt_to_ts(alert_time) if not isinstance(alert_time, str) else alert_time,
+            'matches': matches,
+            'attempts': 0,
+            'next_try': time.time(),
+            'error': None,
+        }
+        with self.lock:
+            self.append(entry)
+            self.entries[entry['id']] = entry
+            self.in_flight.add(entry['id'])
+        return entry['id']
+
+    def complete(self, entry_id):
+        """ Checkpoints an alert which has been sent. """
+        with self.lock:
+            self.in_flight.discard(entry_id)
+            if self.entries.pop(entry_id, None) is None:
+                return
+            self.append({'op': 'done', 'id': entry_id})
+            if self.records > self.compact_threshold + 2 * len(self.entries):
+                self.compact()
+
+    def retry(self, entry_id, error):
+        """ Schedules an alert which failed to send to be retried.
+        Returns False, and drops the alert, if it is too old to be retried. """
+        with self.lock:
+            entry = self.entries.get(entry_id)
+            if entry is None:
+                return False
+            self.in_flight.discard(entry_id)
+            entry['error'] = error
+            expired = self.expired(entry)
+            if expired:
+                self.drop(entry)
+            else:
+                entry['attempts'] += 1
+                entry['next_try'] = time.time() + min(self.retry_backoff * 2 ** (entry['attempts'] - 1), self.max_backoff)
+                self.append({'op': 'retry', 'id': entry_id, 'attempts': entry['attempts'], 'next_try': entry['next_try'],
+                             'error': error})
+        if expired:
+            self.report_expired([entry])
+            return False
+        return True
+
+    def next_try_times(self, entry_ids=None):
+        """ Returns the times at which the alerts entry_ids, or every pending alert, are next due to be retried. """
+        with self.lock:
+            if entry_ids is None:
+                entry_ids = list(self.entries)
+            return [unix_to_dt(self.entries[entry_id]['next_try']) for entry_id in entry_ids if entry_id in self.entries]
+
+    def expired(self, entry):
+        return ts_to_dt(entry['alert_time']) < ts_now() - self.time_limit
+
+    def drop(self, entry):
+        """ Removes an alert which is too old to be retried. Must be called with the lock held. """
+        elastalert_logger.warning('Dropping alert for rule %s from %s, which could not be sent: %s' % (
+            entry['rule_name'], entry['alert_time'], entry['error']))
+        del self.entries[entry['id']]
+        self.append({'op': 'done', 'id': entry['id']})
+
+    def report_expired(self, entries):
+        if self.on_expired:
+            for entry in entries:
+                self.on_expired(entry)
+
+    def due(self):
+        """ Returns the alerts which are due to be retried and marks them as being sent.
+        The alerts which are too old to be retried are dropped and passed to on_expired. """
+        now = time.time()
+        due = []
+        expired = []
+        with self.lock:
+            for entry_id, entry in list(self.entries.items()):
+                if entry_id in self.in_flight or entry['next_try'] > now:
+                    continue
+                if self.expired(entry):
+                    self.drop(entry)
+                    expired.append(entry)
+                    continue
+                self.in_flight.add(entry_id)
+                due.append(entry)
+        self.report_expired(expired)
+        return due
+
+    def release(self, entry_id):
+        """ Returns an alert taken by due which was not sent to the outbox, unchanged. """
+        with self.lock:
+            self.in_flight.discard(entry_id)
@@ -1,7 +1,21 @@
 # -*- coding: utf-8 -*-
 import copy
 import datetime
+import hashlib
+import heapq
+import itertools
+import logging
+import math
+import mmap
+import os
+import re
+import struct
 import sys
+import tempfile
+import threading
+import time
+from array import array
+from collections import OrderedDict
 
 from sortedcontainers import SortedKeyList as sortedlist
 
@@ -94,6 +108,141 @@ class RuleType(object):
         :param terms: A list of buckets with a key, corresponding to query_key, and the count """
         raise NotImplementedError()
 
+    def warmup(self):
+        """ Gets called once before the rule is first run, to build up any state the rule needs before it can
+        process data. If the rule has background_warmup set, ElastAlert calls this from a background thread and
+        will not run the rule until it returns. Rule types with an expensive warmup should skip it in __init__
+        when background_warmup is set. Raising an exception disables the rule.
+        """
+        pass
+
+
+class MappedList(object):
+    """ The unique lines of a list file, sorted and stored in a compact file in cache_dir which is memory mapped.
+    The mapped file is built once per list file and reused by every rule and process using the same cache_dir.
+    It is rebuilt when the list file's modification time or size changes, which is checked every refresh_interval
+    seconds. Lines written as /regex/ are kept apart and compiled into self.regex. """
+    header = struct.Struct('<8sdQQQ')
+    magic = b'EALIST01'
+    refresh_interval = 60
+
+    def __init__(self, filename, cache_dir=None):
+        self.filename = os.path.abspath(filename)
+        self.path = os.path.join(cache_dir or tempfile.gettempdir(),
+                                 'elastalert_list_%s' % (hashlib.sha1(self.filename.encode('utf-8')).hexdigest()))
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        source = os.stat(self.filename)
+        if not self.open_mapping(source):
+            self.build(source)
+            if not self.open_mapping(source):
+                raise EAException("Could not map list file %s from %s" % (self.filename, self.path))
+        self.next_check = time.time() + self.refresh_interval
+
+    def build(self, source):
+        elastalert_logger.info("Building mapped list %s from %s" % (self.path, self.filename))
+        entries = set()
+        regexes = set()
+        with open(self.filename, 'r') as f:
+            for line in f:
+                entry = line.rstrip()
+                if len(entry) > 1 and entry.startswith('/') and entry.endswith('/'):
+                    regexes.add(entry)
+                else:
+                    entries.add(entry.encode('utf-8'))
+        entries = sorted(entries)
+        regex_data = '\n'.join(sorted(regexes)).encode('utf-8')
+        offsets = array('Q', [0])
+        position = 0
+        for entry in entries:
+            position += len(entry)
+            offsets.append(position)
+
+        # Write to a temporary file first, so that other processes never map a partially written list
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(self.path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(self.header.pack(self.magic, source.st_mtime, source.st_size, len(entries), len(regex_data)))
+                f.write(regex_data)
+                f.write(b'\0' * (-(self.header.size + len(regex_data)) % 8))
+                offsets.tofile(f)
+                for entry in entries:
+                    f.write(entry)
+            os.replace(temp_path, self.path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+
+    def open_mapping(self, source):
+        """ Maps the list file built from source, returns False if there is none or it is outdated """
+        try:
+            with open(self.path, 'rb') as f:
+                header = f.read(self.header.size)
+                if len(header) < self.header.size:
+                    return False
+                magic, mtime, size, count, regex_length = self.header.unpack(header)
+                if magic != self.magic or mtime != source.st_mtime or size != source.st_size:
+                    return False
+                mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError):
+            return False
+        regex_end = self.header.size + regex_length
+        regexes = mapping[self.header.size:regex_end].decode('utf-8').split('\n') if regex_length else []
+        offsets_start = regex_end + (-regex_end % 8)
+        data_start = offsets_start + 8 * (count + 1)
+        offsets = memoryview(mapping)[offsets_start:data_start].cast('Q')
+        # Replaced as a whole, so that concurrent lookups see either the old or the new list
+        self.state = (mapping, offsets, data_start, count)
+        self.regex = CompareRule.compile_regex_entries(regexes)
+        return True
+
+    def refresh(self):
+        with self.lock:
+            if time.time() < self.next_check:
+                return
+            try:
+                self.load()
+            except (IOError, OSError) as e:
+                elastalert_logger.warning("Could not refresh list %s, using the previous version: %s" % (self.filename, e))
+                self.next_check = time.time() + self.refresh_interval
+
+    def __contains__(self, term):
+        if time.time() >= self.next_check:
+            self.refresh()
+        if not isinstance(term, str):
+            return False
+        key = term.encode('utf-8')
+        mapping, offsets, data_start, count = self.state
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            entry = mapping[data_start + offsets[middle]:data_start + offsets[middle + 1]]
+            if entry < key:
+                low = middle + 1
+            elif entry > key:
+                high = middle
+            else:
+                return True
+        return False
+
+    def __len__(self):
+        return self.state[3]
+
+
+mapped_lists = {}
+mapped_lists_lock = threading.Lock()
+
+
+def get_mapped_list(filename, cache_dir=None):
+    """ Returns the MappedList for filename, shared by all rules using it """
+    key = (os.path.abspath(filename), cache_dir)
+    with mapped_lists_lock:
+        if key not in mapped_lists:
+            mapped_lists[key] = MappedList(filename, cache_dir)
+        return mapped_lists[key]
+
 
 class CompareRule(RuleType):
     """ A base class for matching a specific term by passing it to a compare function """
@@ -101,18 +250,54 @@ class CompareRule(RuleType):
 
     def expand_entries(self, list_type):
         """ Expand entries specified in files using the '!file' directive, if there are
-        any, then add everything to a set.
+        any, then add everything to a set. Regular expression entries, written as /regex/,
+        are also compiled together into self.list_regex. With mmap_list_files, files are
+        kept in self.list_files as shared MappedLists instead.
         """
         entries_set = set()
+        self.list_files = []
         for entry in self.rules[list_type]:
             if entry.startswith("!file"):  # - "!file /path/to/list"
                 filename = entry.split()[1]
+                if self.rules.get('mmap_list_files'):
+                    self.list_files.append(get_mapped_list(filename, self.rules.get('list_cache_dir')))
+                    continue
                 with open(filename, 'r') as f:
                     for line in f:
                         entries_set.add(line.rstrip())
             else:
                 entries_set.add(entry)
         self.rules[list_type] = entries_set
+        self.list_regex = self.compile_regex_entries(entries_set)
+        if self.list_files:
+            # A query filter with only the inline entries would drop blacklisted events matching the files,
+            # and a whitelist made only of files would give an empty filter
+            self.rules['filter_by_list'] = False
+
+    @staticmethod
+    def compile_regex_entries(entries):
+        """ Compile all /regex/ entries into a single alternation, so that a term is checked against all of them
+        in one pass. Like Elasticsearch regexp queries, a pattern must match the whole term. """
+        patterns = sorted(entry[1:-1] for entry in entries if len(entry) > 1 and entry.startswith('/') and entry.endswith('/'))
+        if not patterns:
+            return None
+        try:
+            return re.compile('|'.join('(?:%s)' % (pattern) for pattern in patterns))
+        except re.error as e:
+            raise EAException("Invalid regular expression in list: %s" % (e))
+
+    def in_list(self, term, list_type):
+        """ Returns whether term is one of the entries of list_type or matches one of its regular expressions """
+        if term in self.rules[list_type]:
+            return True
+        if self.list_regex is not None and isinstance(term, str) and self.list_regex.fullmatch(term) is not None:
+            return True
+        for list_file in self.list_files:
+            if term in list_file:
+                return True
+            if list_file.regex is not None and isinstance(term, str) and list_file.regex.fullmatch(term) is not None:
+                return True
+        return False
 
     def compare(self, event):
         """ An event is a match if this returns true """
@@ -135,7 +320,7 @@ class BlacklistRule(CompareRule):
 
     def compare(self, event):
         term = lookup_es_key(event, self.rules['compare_key'])
-        if term in self.rules['blacklist']:
+        if self.in_list(term, 'blacklist'):
             return True
         return False
 
@@ -152,7 +337,7 @@ class WhitelistRule(CompareRule):
         term = lookup_es_key(event, self.rules['compare_key'])
         if term is None:
             return not self.rules['ignore_null']
-        if term not in self.rules['whitelist']:
+        if not self.in_list(term, 'whitelist'):
             return True
         return False
 
@@ -160,17 +345,28 @@ class WhitelistRule(CompareRule):
 class ChangeRule(CompareRule):
     """ A rule that will store values for a certain term and match if those values change """
     required_options = frozenset(['query_key', 'compound_compare_key', 'ignore_null'])
-    change_map = {}
-    occurrence_time = {}
+    default_max_query_keys = 100000
+
+    def __init__(self, *args):
+        super(ChangeRule, self).__init__(*args)
+        # Query keys are kept in least recently seen order so that keys which have been quiet
+        # for longer than timeframe, or beyond max_query_keys, can be dropped from the front
+        self.occurrences = OrderedDict()
+        self.occurrence_time = {}
+        self.change_map = {}
+        self.max_query_keys = self.rules.get('max_query_keys', self.default_max_query_keys)
 
     def compare(self, event):
         key = hashable(lookup_es_key(event, self.rules['query_key']))
         values = []
-        elastalert_logger.debug(" Previous Values of compare keys  " + str(self.occurrences))
+        debug = elastalert_logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            elastalert_logger.debug(" Previous Values of compare keys  %s" % (self.occurrences.get(key)))
         for val in self.rules['compound_compare_key']:
             lookup_value = lookup_es_key(event, val)
             values.append(lookup_value)
-        elastalert_logger.debug(" Current Values of compare keys   " + str(values))
+        if debug:
+            elastalert_logger.debug(" Current Values of compare keys   %s" % (values))
 
         changed = False
         for val in values:
@@ -179,7 +375,8 @@ class ChangeRule(CompareRule):
         # If we have seen this key before, compare it to the new value
         if key in self.occurrences:
             for idx, previous_values in enumerate(self.occurrences[key]):
-                elastalert_logger.debug(" " + str(previous_values) + " " + str(values[idx]))
+                if debug:
+                    elastalert_logger.debug(" %s %s" % (previous_values, values[idx]))
                 changed = previous_values != values[idx]
                 if changed:
                     break
@@ -190,13 +387,30 @@ class ChangeRule(CompareRule):
                     changed = event[self.rules['timestamp_field']] - self.occurrence_time[key] <= self.rules['timeframe']
 
         # Update the current value and time
-        elastalert_logger.debug(" Setting current value of compare keys values " + str(values))
+        if debug:
+            elastalert_logger.debug(" Setting current value of compare keys values %s" % (values))
         self.occurrences[key] = values
+        self.occurrences.move_to_end(key)
         if 'timeframe' in self.rules:
             self.occurrence_time[key] = event[self.rules['timestamp_field']]
-        elastalert_logger.debug("Final result of comparision between previous and current values " + str(changed))
+        self.expire_keys(event[self.rules['timestamp_field']] if 'timeframe' in self.rules else None)
+        if debug:
+            elastalert_logger.debug("Final result of comparision between previous and current values %s" % (changed))
         return changed
 
+    def expire_keys(self, timestamp):
+        """ Forget the least recently seen query keys which were last seen more than timeframe before timestamp,
+        or which exceed max_query_keys. A forgotten key cannot match on its next event, which is also the case
+        for a key whose last event is older than timeframe. """
+        while self.occurrences:
+            oldest_key = next(iter(self.occurrences))
+            expired = timestamp is not None and timestamp - self.occurrence_time[oldest_key] > self.rules['timeframe']
+            if not expired and len(self.occurrences) <= self.max_query_keys:
+                break
+            self.occurrences.popitem(last=False)
+            self.occurrence_time.pop(oldest_key, None)
+            self.change_map.pop(oldest_key, None)
+
     def add_match(self, match):
         # TODO this is not technically correct
         # if the term changes multiple times before an alert is sent
@@ -206,7 +420,8 @@ class ChangeRule(CompareRule):
         if change:
             extra = {'old_value': change[0],
                      'new_value': change[1]}
-            elastalert_logger.debug("Description of the changed records  " + str(dict(list(match.items()) + list(extra.items()))))
+            if elastalert_logger.isEnabledFor(logging.DEBUG):
+                elastalert_logger.debug("Description of the changed records  %s" % (dict(list(match.items()) + list(extra.items()))))
         super(ChangeRule, self).add_match(dict(list(match.items()) + list(extra.items())))
 
 
@@ -647,8 +862,14 @@ class NewTermsRule(RuleType):
                 if self.rules.get('use_keyword_postfix', True):
                     elastalert_logger.warn('Warning: If query_key is a non-keyword field, you must set '
                                            'use_keyword_postfix to false, or add .keyword/.raw to your query_key.')
+        self.args = args
+        # With background_warmup, ElastAlert downloads the existing terms from a separate thread
+        if not self.rules.get('background_warmup'):
+            self.warmup()
+
+    def warmup(self):
         try:
-            self.get_all_terms(args)
+            self.get_all_terms(self.args)
         except Exception as e:
             # Refuse to start if we cannot get existing terms
             raise EAException('Error searching for existing terms: %s' % (repr(e))).with_traceback(sys.exc_info()[2])
@@ -668,7 +889,9 @@ class NewTermsRule(RuleType):
         start = end - window_size
         step = datetime.timedelta(**self.rules.get('window_step_size', {'days': 1}))
 
-        for field in self.fields:
+        for field_num, field in enumerate(self.fields, 1):
+            elastalert_logger.info('Searching for existing terms of %s for rule %s (field %s of %s)' % (
+                field, self.rules.get('name'), field_num, len(self.fields)))
             tmp_start = start
             tmp_end = min(start + step, end)
 
@@ -895,6 +1118,113 @@ class NewTermsRule(RuleType):
         return int(version[0]) >= 5
 
 
+class HyperLogLog(object):
+    """ A HyperLogLog sketch estimating the number of distinct values added to it using 2 ** precision
+    one byte registers. The standard error of the estimate is about 1.04 / sqrt(2 ** precision). """
+
+    def __init__(self, precision):
+        if not 4 <= precision <= 16:
+            raise EAException("HyperLogLog precision must be between 4 and 16")
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(self.size)
+        # Register sum (of 2 ** -register, scaled by 2 ** 64 to stay exact) and empty register count
+        # are kept up to date on every change so that count() is O(1)
+        self.inverse_sum = self.size << 64
+        self.zeros = self.size
+        if self.size == 16:
+            self.alpha = 0.673
+        elif self.size == 32:
+            self.alpha = 0.697
+        elif self.size == 64:
+            self.alpha = 0.709
+        else:
+            self.alpha = 0.7213 / (1 + 1.079 / self.size)
+
+    def add(self, value):
+        """ Add a value to the sketch. Returns True if this changed the sketch. """
+        return self.set_register(*self.position(value))
+
+    def position(self, value):
+        """ Returns the register index and rank for a value. """
+        value_hash = int.from_bytes(hashlib.md5(str(value).encode('utf-8')).digest()[:8], 'big')
+        index = value_hash >> (64 - self.precision)
+        rest = value_hash & ((1 << (64 - self.precision)) - 1)
+        return index, 64 - self.precision - rest.bit_length() + 1
+
+    def set_register(self, index, rank):
+        old_rank = self.registers[index]
+        if rank <= old_rank:
+            return False
+        self.registers[index] = rank
+        self.inverse_sum += (1 << (64 - rank)) - (1 << (64 - old_rank))
+        if old_rank == 0:
+            self.zeros -= 1
+        return True
+
+    def merge(self, other):
+        """ Merge another sketch of the same precision into this one. """
+        for index, rank in enumerate(other.registers):
+            if rank:
+                self.set_register(index, rank)
+
+    def count(self):
+        """ Estimate the number of distinct values added to the sketch. """
+        estimate = self.alpha * self.size * self.size * (1 << 64) / self.inverse_sum
+        if estimate <= 2.5 * self.size and self.zeros:
+            # Small range correction
+            estimate = self.size * math.log(self.size / float(self.zeros))
+        return int(round(estimate))
+
+    def __len__(self):
+        return self.count()
+
+
+class SlidingHyperLogLog(object):
+    """ Distinct value estimate over a sliding timeframe. Values are added to one HyperLogLog per time slice,
+    and the union of all slices within the timeframe is kept merged. Slices are dropped whole once all of their
+    values are older than timeframe, so the window counted is up to one slice longer than timeframe. """
+
+    def __init__(self, timeframe, precision, slices):
+        self.precision = precision
+        self.timeframe = total_seconds(timeframe)
+        self.slice_width = self.timeframe / slices
+        self.sketches = {}
+        self.merged = HyperLogLog(precision)
+        self.start = None
+
+    def get_slice(self, timestamp):
+        """ Returns the index of the slice containing timestamp, counted from the first timestamp seen. """
+        if self.start is None:
+            self.start = timestamp
+        return int(total_seconds(timestamp - self.start) // self.slice_width)
+
+    def add(self, value, timestamp):
+        slice_index = self.get_slice(timestamp)
+        if slice_index not in self.sketches:
+            self.sketches[slice_index] = HyperLogLog(self.precision)
+        index, rank = self.merged.position(value)
+        if self.sketches[slice_index].set_register(index, rank):
+            self.merged.set_register(index, rank)
+
+    def expire(self, timestamp):
+        """ Drop all slices whose values are all older than timeframe before timestamp. """
+        if self.start is None:
+            return
+        oldest_slice = int((total_seconds(timestamp - self.start) - self.timeframe) // self.slice_width)
+        expired = [slice_index for slice_index in self.sketches if slice_index < oldest_slice]
+        if not expired:
+            return
+        for slice_index in expired:
+            del self.sketches[slice_index]
+        self.merged = HyperLogLog(self.precision)
+        for sketch in self.sketches.values():
+            self.merged.merge(sketch)
+
+    def __len__(self):
+        return self.merged.count()
+
+
 class CardinalityRule(RuleType):
     """ A rule that matches if cardinality of a field is above or below a threshold within a timeframe """
     required_options = frozenset(['timeframe', 'cardinality_field'])
@@ -908,6 +1238,15 @@ class CardinalityRule(RuleType):
         self.cardinality_cache = {}
         self.first_event = {}
         self.timeframe = self.rules['timeframe']
+        self.approximate = self.rules.get('cardinality_approximate', False)
+        self.precision = self.rules.get('cardinality_precision', 10)
+        self.slices = self.rules.get('cardinality_slices', 4)
+        if self.approximate and not 4 <= self.precision <= 16:
+            raise EAException("cardinality_precision must be between 4 and 16")
+        # Heap of (oldest term timestamp, sequence, query_key) with one entry per non-empty exact term cache.
+        # Each key's terms are kept in recency order, so garbage collection only touches expired terms.
+        self.expiry_index = []
+        self.expiry_sequence = itertools.count()
 
     def add_data(self, data):
         qk = self.rules.get('query_key')
@@ -917,12 +1256,24 @@ class CardinalityRule(RuleType):
             else:
                 # If no query_key, we use the key 'all' for all events
                 key = 'all'
-            self.cardinality_cache.setdefault(key, {})
+            if key not in self.cardinality_cache:
+                if self.approximate:
+                    self.cardinality_cache[key] = SlidingHyperLogLog(self.timeframe, self.precision, self.slices)
+                else:
+                    self.cardinality_cache[key] = OrderedDict()
             self.first_event.setdefault(key, lookup_es_key(event, self.ts_field))
             value = hashable(lookup_es_key(event, self.cardinality_field))
             if value is not None:
-                # Store this timestamp as most recent occurence of the term
-                self.cardinality_cache[key][value] = lookup_es_key(event, self.ts_field)
+                if self.approximate:
+                    self.cardinality_cache[key].add(value, lookup_es_key(event, self.ts_field))
+                else:
+                    # Store this timestamp as most recent occurence of the term
+                    terms = self.cardinality_cache[key]
+                    timestamp = lookup_es_key(event, self.ts_field)
+                    if not terms:
+                        heapq.heappush(self.expiry_index, (timestamp, next(self.expiry_sequence), key))
+                    terms[value] = timestamp
+                    terms.move_to_end(value)
                 self.check_for_match(key, event)
 
     def check_for_match(self, key, event, gc=True):
@@ -942,18 +1293,33 @@ class CardinalityRule(RuleType):
 
     def garbage_collect(self, timestamp):
         """ Remove all occurrence data that is beyond the timeframe away """
-        for qk, terms in list(self.cardinality_cache.items()):
-            for term, last_occurence in list(terms.items()):
-                if timestamp - last_occurence > self.rules['timeframe']:
-                    self.cardinality_cache[qk].pop(term)
+        if self.approximate:
+            for terms in self.cardinality_cache.values():
+                terms.expire(timestamp)
+        else:
+            self.expire_terms(timestamp)
 
-            # Create a placeholder event for if a min_cardinality match occured
-            if 'min_cardinality' in self.rules:
+        # Create a placeholder event for if a min_cardinality match occured
+        if 'min_cardinality' in self.rules:
+            for qk in list(self.cardinality_cache):
                 event = {self.ts_field: timestamp}
                 if 'query_key' in self.rules:
                     event.update({self.rules['query_key']: qk})
                 self.check_for_match(qk, event, False)
 
+    def expire_terms(self, timestamp):
+        """ Pop terms last seen more than timeframe before timestamp, visiting only the keys whose oldest term has expired """
+        while self.expiry_index and timestamp - self.expiry_index[0][0] > self.timeframe:
+            _, _, qk = heapq.heappop(self.expiry_index)
+            terms = self.cardinality_cache[qk]
+            while terms:
+                term, last_occurence = next(iter(terms.items()))
+                if timestamp - last_occurence <= self.timeframe:
+                    # Reindex the key by its oldest remaining term
+                    heapq.heappush(self.expiry_index, (last_occurence, next(self.expiry_sequence), qk))
+                    break
+                terms.popitem(last=False)
+
     def get_match_str(self, match):
         lt = self.rules.get('use_local_time')
         starttime = pretty_ts(dt_to_ts(ts_to_dt(lookup_es_key(match, self.ts_field)) - self.rules['timeframe']), lt)
@@ -230,6 +230,8 @@ class MockElastAlerter(object):
         # It is needed to prevent unnecessary initialization of unused alerters
         load_modules_args = argparse.Namespace()
         load_modules_args.debug = not args.alert
+        # Warm up in the foreground so the rule is ready before it is run
+        rule.pop('background_warmup', None)
         conf['rules_loader'].load_modules(rule, load_modules_args)
 
         # If using mock data, make sure it's sorted and find appropriate time range
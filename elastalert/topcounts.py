@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+import collections
+import datetime
+import threading
+
+from .util import lookup_es_key
+
+
+class SpaceSaving(object):
+    """ Approximately counts the most frequent values of a stream in bounded memory, with the Space-Saving algorithm.
+
+    At most capacity values are counted. When a value which is not counted arrives and every counter is in use,
+    it replaces the value with the smallest count and inherits that count, so counts may be overestimated by up
+    to the smallest count, but any value more frequent than total / capacity is always counted.
+
+    :param capacity: The maximum number of values to count.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+
+    def add(self, value, count=1):
+        if value in self.counts:
+            self.counts[value] += count
+        elif len(self.counts) < self.capacity:
+            self.counts[value] = count
+        else:
+            smallest = min(self.counts, key=self.counts.get)
+            self.counts[value] = self.counts.pop(smallest) + count
+
+
+class TopCountWindow(object):
+    """ Keeps the top values of the top_count_keys fields of the events queried by a rule, in one minute buckets,
+    so that top counts can be computed without querying Elasticsearch again.
+
+    The window covers the contiguous range of time queried since it was created or last reset, up to retention
+    before the latest query. Queries whose hits were not all fetched reset it.
+
+    :param fields: The fields to count, in the events' _source.
+    :param keys: The top_count_keys, named as in top_events_<key>, one per field.
+    :param query_key: The rule's query_key, or None.
+    :param retention: A timedelta for which to keep buckets.
+    :param capacity: The number of values counted per field, minute and query_key value.
+    """
+
+    def __init__(self, fields, keys, query_key, retention, capacity):
+        self.fields = list(zip(fields, keys))
+        self.query_key = query_key
+        self.retention = retention
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.buckets = collections.OrderedDict()
+        self.covered_start = None
+        self.covered_end = None
+
+    def add_hits(self, hits, timestamp_field):
+        """ Counts the values of hits. Hits must not be added more than once. """
+        with self.lock:
+            for hit in hits:
+                minute = lookup_es_key(hit, timestamp_field).replace(second=0, microsecond=0)
+                qk = lookup_es_key(hit, self.query_key) if self.query_key else None
+                bucket = self.buckets.get(minute)
+                if bucket is None:
+                    bucket = self.buckets[minute] = {}
+                counters = bucket.get(qk)
+                if counters is None:
+                    counters = bucket[qk] = [SpaceSaving(self.capacity) for _ in self.fields]
+                for counter, (field, _) in zip(counters, self.fields):
+                    values = lookup_es_key(hit, field)
+                    for value in values if isinstance(values, list) else [values]:
+                        if value is not None and not isinstance(value, dict):
+                            counter.add(value)
+
+    def extend(self, starttime, endtime, complete=True):
+        """ Marks starttime to endtime as queried, after its hits were added. If not complete, some of
+        the hits were not fetched and the window is reset. """
+        with self.lock:
+            if not complete:
+                self.reset()
+                return
+            if self.covered_end is None or starttime > self.covered_end:
+                # There is a gap since the last query, events before it may be missing
+                self.buckets = collections.OrderedDict((minute, bucket) for minute, bucket in self.buckets.items()
+                                                       if minute >= starttime)
+                self.covered_start = starttime
+            self.covered_end = max(endtime, self.covered_end or endtime)
+            oldest = (self.covered_end - self.retention).replace(second=0, microsecond=0)
+            if self.covered_start < oldest:
+                self.covered_start = oldest
+            # Buckets are mostly added in time order, so the oldest are almost always first
+            for minute in [minute for minute in self.buckets if minute < oldest]:
+                del self.buckets[minute]
+
+    def get_counts(self, starttime, endtime, qk, number):
+        """ Returns a dictionary with top_events_<key> mapped to the top number counts for each key, of the
+        events from starttime to endtime, both rounded down to the minute, or None if the window does not
+        cover starttime. Events after the latest query are not counted. """
+        starttime = starttime.replace(second=0, microsecond=0)
+        endtime = endtime.replace(second=0, microsecond=0)
+        with self.lock:
+            if self.covered_start is None or starttime < self.covered_start:
+                return None
+            totals = [collections.Counter() for _ in self.fields]
+            for minute, bucket in self.buckets.items():
+                if minute < starttime or minute >= endtime or qk not in bucket:
+                    continue
+                for total, counter in zip(totals, bucket[qk]):
+                    total.update(counter.counts)
+        return dict(('top_events_%s' % (key), dict(total.most_common(number)))
+                    for total, (_, key) in zip(totals, self.fields))
+
+
+def get_top_count_retention(rule, buffer_time):
+    """ Returns how long a rule's TopCountWindow should keep buckets to answer the top counts lookups of its alerts,
+    which span from timeframe (twice timeframe for flatline rules) before each match, and are made up to the
+    aggregation period after the match. """
+    retention = 2 * rule.get('timeframe', datetime.timedelta(minutes=10)) + rule.get('buffer_time', buffer_time)
+    if isinstance(rule.get('aggregation'), datetime.timedelta):
+        retention += rule['aggregation']
+    return retention
@@ -5,6 +5,8 @@ import logging
 import os
 import re
 import sys
+import threading
+import time
 
 import dateutil.parser
 import pytz
@@ -63,6 +65,24 @@ def _find_es_dict_by_key(lookup_dict, term):
     """
     if term in lookup_dict:
         return lookup_dict, term
+    return _find_es_dict_by_tokens(lookup_dict, _tokenize_es_key(term))
+
+
+def _tokenize_es_key(term):
+    """ Splits a search term into a list of (subkeys, array index or None, whether more of the term follows). """
+    tokens = []
+    while term:
+        split_results = re.split(r'\[(\d)\]', term, maxsplit=1)
+        if len(split_results) == 3:
+            sub_term, index, term = split_results
+            index = int(index)
+        else:
+            sub_term, index, term = split_results + [None, '']
+        tokens.append((sub_term.split('.'), index, bool(term)))
+    return tokens
+
+
+def _find_es_dict_by_tokens(lookup_dict, tokens):
     # If the term does not match immediately, perform iterative lookup:
     # 1. Split the search term into tokens
     # 2. Recurrently concatenate these together to traverse deeper into the dictionary,
@@ -76,17 +96,10 @@ def _find_es_dict_by_key(lookup_dict, term):
     # For example:
     #  {'foo.bar': {'bar': 'ray'}} to look up foo.bar will return {'bar': 'ray'}, not 'ray'
     dict_cursor = lookup_dict
+    subkey = None
 
-    while term:
-        split_results = re.split(r'\[(\d)\]', term, maxsplit=1)
-        if len(split_results) == 3:
-            sub_term, index, term = split_results
-            index = int(index)
-        else:
-            sub_term, index, term = split_results + [None, '']
-
-        subkeys = sub_term.split('.')
-
+    for subkeys, index, more in tokens:
+        subkeys = list(subkeys)
         subkey = ''
 
         while len(subkeys) > 0:
@@ -111,7 +124,7 @@ def _find_es_dict_by_key(lookup_dict, term):
             dict_cursor = dict_cursor[subkey]
             if type(dict_cursor) == list and len(dict_cursor) > index:
                 subkey = index
-                if term:
+                if more:
                     dict_cursor = dict_cursor[subkey]
             else:
                 return {}, None
@@ -140,6 +153,19 @@ def lookup_es_key(lookup_dict, term):
     return None if value_key is None else value_dict[value_key]
 
 
+def compile_es_key(term):
+    """ Returns a function which looks up term in a dictionary like lookup_es_key, with the term parsed once.
+    Use it when looking up the same term in many dictionaries. """
+    tokens = _tokenize_es_key(term)
+
+    def lookup(lookup_dict):
+        if term in lookup_dict:
+            return lookup_dict[term]
+        value_dict, value_key = _find_es_dict_by_tokens(lookup_dict, tokens)
+        return None if value_key is None else value_dict[value_key]
+    return lookup
+
+
 def ts_to_dt(timestamp):
     if isinstance(timestamp, datetime.datetime):
         return timestamp
@@ -245,6 +271,52 @@ class EAException(Exception):
     pass
 
 
+class TTLCache(object):
+    """ A thread safe dictionary whose entries expire ttl seconds after they were set. """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            if entry[0] < time.monotonic():
+                del self.entries[key]
+                return default
+            return entry[1]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+
+    def get_or_set(self, key, compute):
+        """ Returns the value of key, calling compute to set it if it is missing or expired. """
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.set(key, value)
+        return value
+
+    def pop(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def expire(self):
+        """ Removes the expired entries. """
+        now = time.monotonic()
+        with self.lock:
+            for key in [key for key, entry in self.entries.items() if entry[0] < now]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
 def seconds(td):
     return td.seconds + td.days * 24 * 3600
 
@@ -0,0 +1,411 @@
+# -*- coding: utf-8 -*-
+import json
+import queue
+import sqlite3
+import threading
+import uuid
+
+from elasticsearch.exceptions import ElasticsearchException
+
+from .alerts import DateTimeEncoder
+from .util import dt_to_ts
+from .util import elastalert_logger
+from .util import ts_now
+from .util import ts_to_dt
+
+
+def to_epoch(timestamp):
+    """ Converts a timestamp to seconds since the epoch, which unlike timestamp strings sort correctly. """
+    if timestamp is None or timestamp == '':
+        return None
+    return ts_to_dt(timestamp).timestamp()
+
+
+class WritebackStore(object):
+    """ Stores the documents ElastAlert writes back, such as run status, silences, pending and aggregated alerts
+    and errors, and finds them again.
+
+    Hits are returned in the same form as Elasticsearch hits, with _id and _source. Paged searches yield lists of
+    page_size hits. Stores which cannot paginate yield a single page of at most limit hits instead.
+    """
+
+    # Where the documents are stored, for log messages
+    name = None
+
+    def index(self, doc_type, body):
+        """ Stores a document and returns a response like that of Elasticsearch, with its _id. """
+        raise NotImplementedError()
+
+    def delete(self, ids):
+        """ Deletes documents. Returns a list of the bulk response items of those which could not be deleted. """
+        raise NotImplementedError()
+
+    def get_last_status(self, rule_name):
+        """ Returns the latest elastalert_status document of a rule, or None. """
+        raise NotImplementedError()
+
+    def get_silence(self, rule_name):
+        """ Returns the silence document of rule_name which lasts the longest, or None. """
+        raise NotImplementedError()
+
+    def find_pending_aggregate_alert(self, rule_name, now, aggregation_key_value=None):
+        """ Returns the latest unsent alert of a rule which is due after now and starts an aggregation, or None. """
+        raise NotImplementedError()
+
+    def find_pending_alerts(self, starttime, endtime, page_size, limit):
+        """ Yields the unsent alerts which are not part of an aggregation, due from starttime to endtime,
+        earliest first, one page at a time. If endtime is None, yields those due from starttime on. """
+        raise NotImplementedError()
+
+    def get_aggregated_matches(self, aggregate_id, page_size, limit):
+        """ Yields the matches added to the aggregation aggregate_id, earliest first, one page at a time. """
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class ElasticsearchWriteback(WritebackStore):
+    """ Stores the documents in the writeback index.
+
+    :param writeback_es: The writeback Elasticsearch client.
+    :param writeback_index: The writeback index.
+    """
+
+    name = 'Elasticsearch'
+    # The maximum number of documents deleted in one bulk request
+    bulk_delete_size = 1000
+    # How long the point in time of a paginated search is kept between pages
+    pit_keep_alive = '1m'
+
+    def __init__(self, writeback_es, writeback_index):
+        self.writeback_es = writeback_es
+        self.writeback_index = writeback_index
+
+    def index(self, doc_type, body):
+        index = self.writeback_es.resolve_writeback_index(self.writeback_index, doc_type)
+        if self.writeback_es.is_atleastsixtwo():
+            return self.writeback_es.index(index=index, body=body)
+        return self.writeback_es.index(index=index, doc_type=doc_type, body=body)
+
+    def delete(self, ids):
+        failed = []
+        for i in range(0, len(ids), self.bulk_delete_size):
+            actions = []
+            for doc_id in ids[i:i + self.bulk_delete_size]:
+                action = {'_index': self.writeback_index, '_id': doc_id}
+                if not self.writeback_es.is_atleastsixtwo():
+                    action['_type'] = 'elastalert'
+                elif not self.writeback_es.is_atleastseven():
+                    # Bulk requests need a type before Elasticsearch 7, the writeback indices use _doc from 6.2
+                    action['_type'] = '_doc'
+                actions.append({'delete': action})
+            res = self.writeback_es.bulk(body=actions)
+            if res.get('errors'):
+                # Documents which were already deleted are not errors
+                failed.extend(item['delete'] for item in res['items'] if item['delete'].get('status') not in (200, 404))
+        return failed
+
+    def get_last_status(self, rule_name):
+        query = {'filter': {'term': {'rule_name': '%s' % (rule_name)}}}
+        if self.writeback_es.is_atleastfive():
+            query = {'query': {'bool': query}}
+        query['sort'] = {'@timestamp': {'order': 'desc'}}
+        return self.search_latest('elastalert_status', query, ['endtime', 'rule_name'])
+
+    def get_silence(self, rule_name):
+        query = {'term': {'rule_name': rule_name}}
+        if self.writeback_es.is_atleastfive():
+            query = {'query': query}
+        else:
+            query = {'filter': query}
+        query['sort'] = {'until': {'order': 'desc'}}
+        return self.search_latest('silence', query, ['until', 'exponent'])
+
+    def search_latest(self, doc_type, query, fields):
+        """ Returns the fields of the first hit of a sorted query on the index of doc_type, or None. """
+        index = self.writeback_es.resolve_writeback_index(self.writeback_index, doc_type)
+        if self.writeback_es.is_atleastsixtwo():
+            if self.writeback_es.is_atleastsixsix():
+                res = self.writeback_es.search(index=index, size=1, body=query, _source_includes=fields)
+            else:
+                res = self.writeback_es.search(index=index, size=1, body=query, _source_include=fields)
+        else:
+            res = self.writeback_es.deprecated_search(index=index, doc_type=doc_type, size=1, body=query, _source_include=fields)
+        hits = res['hits']['hits']
+        return hits[0]['_source'] if hits else None
+
+    def find_pending_aggregate_alert(self, rule_name, now, aggregation_key_value=None):
+        query = {'filter': {'bool': {'must': [{'term': {'rule_name': rule_name}},
+                                              {'range': {'alert_time': {'gt': now}}},
+                                              {'term': {'alert_sent': 'false'}}],
+                                     'must_not': [{'exists': {'field': 'aggregate_id'}}]}}}
+        if aggregation_key_value:
+            query['filter']['bool']['must'].append({'term': {'aggregation_key': aggregation_key_value}})
+        if self.writeback_es.is_atleastfive():
+            query = {'query': {'bool': query}}
+        query['sort'] = {'alert_time': {'order': 'desc'}}
+        if self.writeback_es.is_atleastsixtwo():
+            res = self.writeback_es.search(index=self.writeback_index, body=query, size=1)
+        else:
+            res = self.writeback_es.deprecated_search(index=self.writeback_index, doc_type='elastalert', body=query, size=1)
+        hits = res['hits']['hits']
+        return hits[0] if hits else None
+
+    def find_pending_alerts(self, starttime, endtime, page_size, limit):
+        inner_query = {'query_string': {'query': '!_exists_:aggregate_id AND alert_sent:false'}}
+        time_range = {'from': dt_to_ts(starttime)}
+        if endtime is not None:
+            time_range['to'] = dt_to_ts(endtime)
+        time_filter = {'range': {'alert_time': time_range}}
+        if self.writeback_es.is_atleastfive():
+            query = {'query': {'bool': {'must': inner_query, 'filter': time_filter}}}
+        else:
+            query = {'query': inner_query, 'filter': time_filter}
+        query['sort'] = {'alert_time': {'order': 'asc'}}
+        return self.iter_pages(query, page_size, limit)
+
+    def get_aggregated_matches(self, aggregate_id, page_size, limit):
+        query = {'query': {'query_string': {'query': 'aggregate_id:%s' % (aggregate_id)}}, 'sort': {'@timestamp': 'asc'}}
+        return self.iter_pages(query, page_size, limit)
+
+    def iter_pages(self, query, page_size, limit):
+        """ Yields the hits of a sorted query on the writeback index, page_size at a time, paginated with
+        search_after. Before Elasticsearch 5, which has no search_after, yields a single page of limit hits.
+
+        From Elasticsearch 7.10, the pages are searched in a point in time. Ties are broken by _shard_doc from
+        Elasticsearch 7.12, which added it, and by _id before, or _uid before Elasticsearch 6. """
+        if self.writeback_es.is_atleastseventen():
+            pit = self.writeback_es.open_point_in_time(index=self.writeback_index, keep_alive=self.pit_keep_alive)
+            tiebreaker = '_shard_doc' if self.writeback_es.is_atleastseventwelve() else '_id'
+            query = dict(query, sort=[query['sort'], {tiebreaker: {'order': 'asc'}}])
+            try:
+                while True:
+                    # A search in a point in time must not name the index
+                    query['pit'] = {'id': pit['id'], 'keep_alive': self.pit_keep_alive}
+                    res = self.writeback_es.search(body=query, size=page_size)
+                    pit['id'] = res.get('pit_id', pit['id'])
+                    hits = res['hits']['hits']
+                    if hits:
+                        yield hits
+                    if len(hits) < page_size:
+                        return
+                    query = dict(query, search_after=hits[-1]['sort'])
+            finally:
+                try:
+                    self.writeback_es.close_point_in_time(body={'id': pit['id']})
+                except ElasticsearchException as e:
+                    elastalert_logger.warning('Failed to close point in time: %s' % (e))
+
+        paginate = self.writeback_es.is_atleastfive()
+        size = limit
+        if paginate:
+            # The sort values of the last hit must be unique to resume from it
+            tiebreaker = '_id' if self.writeback_es.is_atleastsix() else '_uid'
+            query = dict(query, sort=[query['sort'], {tiebreaker: {'order': 'asc'}}])
+            size = page_size
+        while True:
+            if self.writeback_es.is_atleastsixtwo():
+                res = self.writeback_es.search(index=self.writeback_index, body=query, size=size)
+            else:
+                res = self.writeback_es.deprecated_search(index=self.writeback_index, doc_type='elastalert',
+                                                          body=query, size=size)
+            hits = res['hits']['hits']
+            if hits:
+                yield hits
+            if not paginate or len(hits) < size:
+                return
+            query = dict(query, search_after=hits[-1]['sort'])
+
+
+class SQLiteWriteback(WritebackStore):
+    """ Stores the documents in a local SQLite database, so that reading them back does not need a request to
+    Elasticsearch. The fields ElastAlert searches on are indexed columns.
+
+    Documents which are no longer needed, such as the run status and errors, sent alerts and silences which
+    ended, are deleted once they are older than retention, but not from the mirror.
+
+    :param path: The path of the database file.
+    :param mirror: An optional WritebackMirror, to which every write and delete is also sent.
+    :param retention: An optional timedelta after which documents which are no longer needed are deleted.
+    """
+
+    # The number of documents written between deletions of those older than retention
+    prune_interval = 1000
+
+    def __init__(self, path, mirror=None, retention=None):
+        self.path = path
+        self.name = path
+        self.mirror = mirror
+        self.retention = retention
+        self.writes = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS writeback ('
+                            'id TEXT PRIMARY KEY, doc_type TEXT NOT NULL, rule_name TEXT, timestamp REAL, alert_time REAL, '
+                            'alert_sent INTEGER, aggregate_id TEXT, aggregation_key TEXT, until REAL, body TEXT NOT NULL)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS writeback_rule ON writeback (doc_type, rule_name, timestamp)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS writeback_silence ON writeback (doc_type, rule_name, until)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS writeback_pending ON writeback (doc_type, alert_sent, alert_time) '
+                            'WHERE aggregate_id IS NULL')
+            self.db.execute('CREATE INDEX IF NOT EXISTS writeback_aggregate ON writeback (aggregate_id, timestamp)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS writeback_time ON writeback (doc_type, timestamp)')
+
+    def query(self, sql, args):
+        with self.lock:
+            return [{'_id': row[0], '_source': json.loads(row[1])} for row in self.db.execute(sql, args)]
+
+    def index(self, doc_type, body):
+        doc_id = uuid.uuid4().hex
+        alert_sent = body.get('alert_sent')
+        row = (doc_id, doc_type, body.get('rule_name'), to_epoch(body.get('@timestamp')), to_epoch(body.get('alert_time')),
+               None if alert_sent is None else int(alert_sent), body.get('aggregate_id'), body.get('aggregation_key'),
+               to_epoch(body.get('until')), json.dumps(body, cls=DateTimeEncoder))
+        with self.lock, self.db:
+            self.db.execute('INSERT INTO writeback VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', row)
+            self.writes += 1
+            if self.retention is not None and self.writes % self.prune_interval == 0:
+                self.prune(ts_now() - self.retention)
+        if self.mirror:
+            self.mirror.index(doc_type, doc_id, body)
+        return {'_id': doc_id, 'created': True}
+
+    def prune(self, before):
+        """ Deletes the documents which are no longer needed and older than before. Must hold lock. """
+        before = to_epoch(before)
+        self.db.execute("DELETE FROM writeback WHERE doc_type IN ('elastalert_status', 'elastalert_error', 'past_elastalert') "
+                        "AND timestamp < ?", (before,))
+        self.db.execute("DELETE FROM writeback WHERE doc_type = 'silence' AND until < ?", (before,))
+        # Alerts which were sent, or are too old to be sent, and the matches aggregated with them
+        self.db.execute("DELETE FROM writeback WHERE doc_type = 'elastalert' AND timestamp < ? AND alert_time < ?",
+                        (before, before))
+
+    def delete(self, ids):
+        with self.lock, self.db:
+            self.db.executemany('DELETE FROM writeback WHERE id = ?', [(doc_id,) for doc_id in ids])
+        if self.mirror and ids:
+            self.mirror.delete(ids)
+        return []
+
+    def get_last_status(self, rule_name):
+        hits = self.query('SELECT id, body FROM writeback WHERE doc_type = ? AND rule_name = ? ORDER BY timestamp DESC LIMIT 1',
+                          ('elastalert_status', rule_name))
+        return hits[0]['_source'] if hits else None
+
+    def get_silence(self, rule_name):
+        hits = self.query('SELECT id, body FROM writeback WHERE doc_type = ? AND rule_name = ? ORDER BY until DESC LIMIT 1',
+                          ('silence', rule_name))
+        return hits[0]['_source'] if hits else None
+
+    def find_pending_aggregate_alert(self, rule_name, now, aggregation_key_value=None):
+        sql = ('SELECT id, body FROM writeback WHERE doc_type = ? AND rule_name = ? AND alert_time > ? AND alert_sent = 0 '
+               'AND aggregate_id IS NULL')
+        args = ['elastalert', rule_name, to_epoch(now)]
+        if aggregation_key_value:
+            sql += ' AND aggregation_key = ?'
+            args.append(aggregation_key_value)
+        hits = self.query(sql + ' ORDER BY alert_time DESC LIMIT 1', args)
+        return hits[0] if hits else None
+
+    def find_pending_alerts(self, starttime, endtime, page_size, limit=None):
+        sql = 'SELECT id, body, alert_time FROM writeback WHERE doc_type = ? AND alert_sent = 0 AND aggregate_id IS NULL'
+        args = ['elastalert']
+        if endtime is not None:
+            sql += ' AND alert_time <= ?'
+            args.append(to_epoch(endtime))
+        return self.iter_pages(sql, args, 'alert_time', to_epoch(starttime), page_size)
+
+    def get_aggregated_matches(self, aggregate_id, page_size, limit=None):
+        sql = 'SELECT id, body, timestamp FROM writeback WHERE aggregate_id = ?'
+        return self.iter_pages(sql, [aggregate_id], 'timestamp', float('-inf'), page_size)
+
+    def iter_pages(self, sql, args, column, start, page_size):
+        """ Yields the hits of sql, which selects id, body and column, from column == start on, ordered by column
+        and id, one page at a time. Each page resumes after the last row of the previous one. """
+        sql += ' AND (%s > ? OR (%s = ? AND id > ?)) ORDER BY %s, id LIMIT ?' % (column, column, column)
+        last = (start, '')
+        while True:
+            with self.lock:
+                rows = self.db.execute(sql, args + [last[0], last[0], last[1], page_size]).fetchall()
+            if rows:
+                yield [{'_id': row[0], '_source': json.loads(row[1])} for row in rows]
+            if len(rows) < page_size:
+                return
+            last = (rows[-1][2], rows[-1][0])
+
+    def close(self):
+        if self.mirror:
+            self.mirror.close()
+        with self.lock:
+            self.db.close()
+
+
+class WritebackMirror(object):
+    """ Copies writes and deletes made to a local writeback store to the writeback index, from a background
+    thread with bulk requests, so that the documents are still available to dashboards. Documents keep the
+    same ids. Operations which fail are logged and dropped.
+
+    :param writeback_es: The writeback Elasticsearch client.
+    :param writeback_index: The writeback index.
+    :param batch_size: The maximum number of operations per bulk request.
+    """
+
+    def __init__(self, writeback_es, writeback_index, batch_size=500):
+        self.writeback_es = writeback_es
+        self.writeback_index = writeback_index
+        self.batch_size = batch_size
+        self.operations = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name='writeback_mirror', daemon=True)
+        self.thread.start()
+
+    def index(self, doc_type, doc_id, body):
+        action = {'_index': self.writeback_es.resolve_writeback_index(self.writeback_index, doc_type), '_id': doc_id}
+        if not self.writeback_es.is_atleastsixtwo():
+            action['_type'] = doc_type
+        elif not self.writeback_es.is_atleastseven():
+            action['_type'] = '_doc'
+        self.operations.put([{'index': action}, body])
+
+    def delete(self, ids):
+        for doc_id in ids:
+            action = {'_index': self.writeback_index, '_id': doc_id}
+            if not self.writeback_es.is_atleastsixtwo():
+                action['_type'] = 'elastalert'
+            elif not self.writeback_es.is_atleastseven():
+                action['_type'] = '_doc'
+            self.operations.put([{'delete': action}])
+
+    def run(self):
+        while True:
+            operation = self.operations.get()
+            if operation is None:
+                return
+            body = list(operation)
+            count = 1
+            while count < self.batch_size:
+                try:
+                    operation = self.operations.get_nowait()
+                except queue.Empty:
+                    break
+                if operation is None:
+                    self.send(body, count)
+                    return
+                body.extend(operation)
+                count += 1
+            self.send(body, count)
+
+    def send(self, body, count):
+        try:
+            res = self.writeback_es.bulk(body=body)
+            if res.get('errors'):
+                elastalert_logger.warning('Failed to mirror some writeback documents to Elasticsearch')
+        except ElasticsearchException as e:
+            elastalert_logger.warning('Failed to mirror %d writeback operations to Elasticsearch: %s' % (count, e))
+
+    def close(self):
+        """ Sends the queued operations and stops the background thread. """
+        self.operations.put(None)
+        self.thread.join()
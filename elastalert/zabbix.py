@@ -1,39 +1,112 @@
-from alerts import Alerter  # , BasicMatchString
+from .alerts import Alerter  # , BasicMatchString
 import logging
+import threading
 from pyzabbix.api import ZabbixAPI
 from pyzabbix import ZabbixSender, ZabbixMetric
 from datetime import datetime
 
 
+class ZabbixMetricBatch(object):
+    """ Buffers metrics for a Zabbix server and sends them together, once chunk_size metrics are buffered
+    or every flush_interval seconds from a background thread, whichever comes first.
+
+    Delivery is best-effort: metrics are sent after the alert which added them has returned, and errors sending
+    them are logged. close sends the metrics which are still buffered. """
+
+    def __init__(self, sender, chunk_size=200, flush_interval=5):
+        self.sender = sender
+        self.chunk_size = chunk_size
+        self.flush_interval = flush_interval
+        self.metrics = []
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.stopped = threading.Event()
+        self.flush_thread = threading.Thread(target=self.run_flush, name='zabbix_flush', daemon=True)
+        self.flush_thread.start()
+
+    def add(self, metrics):
+        with self.lock:
+            self.metrics.extend(metrics)
+            if len(self.metrics) < self.chunk_size:
+                return
+            metrics, self.metrics = self.metrics, []
+        self.send(metrics)
+
+    def flush(self):
+        with self.lock:
+            metrics, self.metrics = self.metrics, []
+        if metrics:
+            self.send(metrics)
+
+    def send(self, metrics):
+        self.logger.info("Sending: %s metrics" % (len(metrics)))
+        try:
+            self.sender.send(metrics)
+        except Exception as e:
+            self.logger.exception(e)
+
+    def run_flush(self):
+        while not self.stopped.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        self.stopped.set()
+        self.flush_thread.join()
+        self.flush()
+
+
+# Senders shared by every client and alerter, by Zabbix server, and metric batches, by Zabbix server and batch settings
+zabbix_senders = {}
+metric_batches = {}
+zabbix_lock = threading.Lock()
+
+
+def get_zabbix_sender(host, port):
+    with zabbix_lock:
+        if (host, port) not in zabbix_senders:
+            zabbix_senders[(host, port)] = ZabbixSender(zabbix_server=host, zabbix_port=port)
+        return zabbix_senders[(host, port)]
+
+
+def close_metric_batches():
+    """ Sends the metrics which are still batched, and stops the batches. """
+    with zabbix_lock:
+        batches = list(metric_batches.values())
+        metric_batches.clear()
+    for batch in batches:
+        batch.close()
+
+
+def get_metric_batch(host, port, chunk_size=200, flush_interval=5):
+    sender = get_zabbix_sender(host, port)
+    key = (host, port, chunk_size, flush_interval)
+    with zabbix_lock:
+        if key not in metric_batches:
+            metric_batches[key] = ZabbixMetricBatch(sender, chunk_size, flush_interval)
+        return metric_batches[key]
+
+
 class ZabbixClient(ZabbixAPI):
 
     def __init__(self, url='http://localhost', use_authenticate=False, user='Admin', password='zabbix', sender_host='localhost',
-                 sender_port=10051):
+                 sender_port=10051, send_aggregated_metrics=False, flush_interval=5):
         self.url = url
         self.use_authenticate = use_authenticate
         self.sender_host = sender_host
         self.sender_port = sender_port
         self.metrics_chunk_size = 200
-        self.aggregated_metrics = []
+        self.send_aggregated_metrics = send_aggregated_metrics
+        self.flush_interval = flush_interval
         self.logger = logging.getLogger(self.__class__.__name__)
         super(ZabbixClient, self).__init__(url=self.url, use_authenticate=self.use_authenticate, user=user, password=password)
 
     def send_metric(self, hostname, key, data):
         zm = ZabbixMetric(hostname, key, data)
         if self.send_aggregated_metrics:
-
-            self.aggregated_metrics.append(zm)
-            if len(self.aggregated_metrics) > self.metrics_chunk_size:
-                self.logger.info("Sending: %s metrics" % (len(self.aggregated_metrics)))
-                try:
-                    ZabbixSender(zabbix_server=self.sender_host, zabbix_port=self.sender_port).send(self.aggregated_metrics)
-                    self.aggregated_metrics = []
-                except Exception as e:
-                    self.logger.exception(e)
-                    pass
+            get_metric_batch(self.sender_host, self.sender_port, self.metrics_chunk_size, self.flush_interval).add([zm])
         else:
             try:
-                ZabbixSender(zabbix_server=self.sender_host, zabbix_port=self.sender_port).send(zm)
+                get_zabbix_sender(self.sender_host, self.sender_port).send(zm)
             except Exception as e:
                 self.logger.exception(e)
                 pass
@@ -54,6 +127,9 @@ class ZabbixAlerter(Alerter):
         self.zbx_sender_port = self.rule.get('zbx_sender_port', 10051)
         self.zbx_host = self.rule.get('zbx_host')
         self.zbx_key = self.rule.get('zbx_key')
+        # Metrics are sent in batches by a background thread if zbx_flush_interval is set
+        self.zbx_flush_interval = self.rule.get('zbx_flush_interval')
+        self.zbx_batch_size = self.rule.get('zbx_batch_size', 200)
 
     # Alert is called
     def alert(self, matches):
@@ -66,7 +142,13 @@ class ZabbixAlerter(Alerter):
             ts_epoch = int(datetime.strptime(match['@timestamp'], "%Y-%m-%dT%H:%M:%S.%fZ").strftime('%s'))
             zm.append(ZabbixMetric(host=self.zbx_host, key=self.zbx_key, value=1, clock=ts_epoch))
 
-        ZabbixSender(zabbix_server=self.zbx_sender_host, zabbix_port=self.zbx_sender_port).send(zm)
+        if self.zbx_flush_interval:
+            get_metric_batch(self.zbx_sender_host, self.zbx_sender_port, self.zbx_batch_size, self.zbx_flush_interval).add(zm)
+        else:
+            get_zabbix_sender(self.zbx_sender_host, self.zbx_sender_port).send(zm)
+
+    def close(self):
+        close_metric_batches()
 
     # get_info is called after an alert is sent to get data that is written back
     # to Elasticsearch in the field "alert_info"
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+import datetime
+import os
+
+from elastalert.aggregation import AggregationBuffer
+
+
+def test_aggregation_buffer_by_key():
+    buffer = AggregationBuffer()
+    buffer.add('a', {'n': 1})
+    buffer.add(None, {'n': 2})
+    buffer.add('a', {'n': 3})
+    assert len(buffer) == 3
+    assert buffer.keys() == ['a', None]
+    assert buffer.pop('a') == [{'n': 1}, {'n': 3}]
+    assert buffer.pop('a') == []
+    assert buffer.pop(None) == [{'n': 2}]
+    assert len(buffer) == 0
+
+
+def test_aggregation_buffer_spill(tmpdir):
+    buffer = AggregationBuffer(max_matches=3, spill_dir=str(tmpdir))
+    timestamp = datetime.datetime(2014, 9, 26, 12, 34, 45)
+    for n in range(4):
+        buffer.add('a', {'n': n, '@timestamp': timestamp})
+    buffer.add('b', {'n': 4})
+    # The matches of the largest aggregation were spilled
+    assert buffer.in_memory == 1
+    assert len(buffer) == 5
+    assert len(tmpdir.listdir()) == 1
+
+    for n in range(5, 8):
+        buffer.add('a', {'n': n})
+    assert buffer.in_memory == 1
+    assert [match['n'] for match in buffer.pop('a')] == [0, 1, 2, 3, 5, 6, 7]
+    assert buffer.pop('b') == [{'n': 4}]
+    assert len(buffer) == 0
+    assert not os.listdir(str(tmpdir))
+
+
+def test_aggregation_buffer_drain(tmpdir):
+    buffer = AggregationBuffer(max_matches=2, spill_dir=str(tmpdir))
+    for n in range(5):
+        buffer.add('a', {'n': n})
+    buffer.add('b', {'n': 5})
+    assert buffer.in_memory == 1
+
+    # Writing stops at the first failure, which is buffered again by write, and the rest is kept spilled
+    written = []
+
+    def write(match):
+        if match['n'] == 1:
+            buffer.add('a', match)
+            return False
+        written.append(match['n'])
+        return True
+    buffer.drain(write)
+    assert written == [5, 0]
+    assert len(buffer) == 4
+    assert len(tmpdir.listdir()) == 1
+
+    buffer.drain(lambda match: written.append(match['n']) or True)
+    assert sorted(written) == [0, 1, 2, 3, 4, 5]
+    assert len(buffer) == 0
+    assert not os.listdir(str(tmpdir))
+
+
+def test_aggregation_buffer_restore_before_spilled(tmpdir):
+    """ Tests that matches kept by a failed drain stay ahead of matches spilled during the drain """
+    buffer = AggregationBuffer(max_matches=2, spill_dir=str(tmpdir))
+    buffer.add('a', {'n': 0})
+    buffer.add('a', {'n': 1})
+
+    def write(match):
+        for n in range(10, 13):
+            buffer.add('a', {'n': n})
+        return False
+    buffer.drain(write)
+    assert buffer.in_memory == 0
+    assert len(buffer) == 4
+    assert [match['n'] for match in buffer.pop('a')] == [1, 10, 11, 12]
+    assert not os.listdir(str(tmpdir))
@@ -2,16 +2,23 @@
 import base64
 import datetime
 import json
+import re
 import subprocess
+from smtplib import SMTPServerDisconnected
 
+import dateutil.tz
 import mock
 import pytest
 from jira.exceptions import JIRAError
 
+from elastalert.alerts import _get_alert_template
+from elastalert.alerts import AggregationSummary
 from elastalert.alerts import AlertaAlerter
 from elastalert.alerts import Alerter
+from elastalert.alerts import AlertTemplate
 from elastalert.alerts import BasicMatchString
 from elastalert.alerts import CommandAlerter
+from elastalert.alerts import DateTimeEncoder
 from elastalert.alerts import EmailAlerter
 from elastalert.alerts import HipChatAlerter
 from elastalert.alerts import HTTPPostAlerter
@@ -19,12 +26,18 @@ from elastalert.alerts import JiraAlerter
 from elastalert.alerts import JiraFormattedMatchString
 from elastalert.alerts import MsTeamsAlerter
 from elastalert.alerts import PagerDutyAlerter
+from elastalert.alerts import pretty_print_json
 from elastalert.alerts import SlackAlerter
+from elastalert.alerts import StompAlerter
 from elastalert.alerts import StrideAlerter
 from elastalert.loaders import FileRulesLoader
 from elastalert.opsgenie import OpsGenieAlerter
 from elastalert.util import ts_add
 from elastalert.util import ts_now
+from elastalert.zabbix import close_metric_batches
+from elastalert.zabbix import get_metric_batch
+from elastalert.zabbix import metric_batches
+from elastalert.zabbix import ZabbixMetricBatch
 
 
 class mock_rule:
@@ -117,6 +130,62 @@ def test_email():
         assert 'Subject: Test alert for test_value, owned by owner_value' in body
 
 
+def test_email_keepalive():
+    rule = {'name': 'test alert', 'email': ['testing@test.test'], 'from_addr': 'testfrom@test.test', 'type': mock_rule(),
+            'timestamp_field': '@timestamp', 'smtp_host': 'keepalive.test', 'smtp_keepalive': True}
+    EmailAlerter.smtp_connections.clear()
+    with mock.patch('elastalert.alerts.SMTP') as mock_smtp:
+        first = EmailAlerter(rule)
+        second = EmailAlerter(dict(rule, name='other rule'))
+        first.alert([{'test_term': 'test_value'}])
+        second.alert([{'test_term': 'test_value'}])
+        # Both rules send over one connection, which is left open
+        assert mock_smtp.call_count == 1
+        assert mock_smtp.return_value.sendmail.call_count == 2
+        assert not mock_smtp.return_value.quit.called
+
+        # A connection closed by the server is reopened
+        mock_smtp.return_value.sendmail.side_effect = [SMTPServerDisconnected(), None]
+        first.alert([{'test_term': 'test_value'}])
+        assert mock_smtp.call_count == 2
+        assert mock_smtp.return_value.sendmail.call_count == 4
+
+        # A connection which is idle for too long is closed and reopened
+        mock_smtp.return_value.sendmail.side_effect = None
+        connection = first.get_smtp_connection()
+        connection.last_used -= 120
+        first.alert([{'test_term': 'test_value'}])
+        assert mock_smtp.return_value.quit.call_count == 1
+        assert mock_smtp.call_count == 3
+    EmailAlerter.smtp_connections.clear()
+
+
+def test_email_keepalive_accounts():
+    rule = {'name': 'test alert', 'email': ['testing@test.test'], 'from_addr': 'testfrom@test.test', 'type': mock_rule(),
+            'timestamp_field': '@timestamp', 'smtp_host': 'keepalive.test', 'smtp_keepalive': True,
+            'smtp_auth_file': 'file.txt', 'rule_file': '/tmp/foo.yaml'}
+    EmailAlerter.smtp_connections.clear()
+    with mock.patch('elastalert.alerts.SMTP') as mock_smtp, \
+            mock.patch('elastalert.alerts.yaml_loader') as mock_open:
+        mock_open.return_value = {'user': 'someone', 'password': 'hunter2'}
+        first = EmailAlerter(rule)
+        same = EmailAlerter(dict(rule, name='same account'))
+        mock_open.return_value = {'user': 'someone', 'password': 'hunter3'}
+        other_password = EmailAlerter(dict(rule, name='other password'))
+        other_file = EmailAlerter(dict(rule, name='other file', smtp_auth_file='other.txt'))
+        mock_open.return_value = {'user': 'someone', 'password': 'hunter2'}
+        unauthenticated = EmailAlerter(dict([(key, value) for key, value in rule.items() if key != 'smtp_auth_file'],
+                                            name='no account'))
+        for alerter in [first, same, other_password, other_file, unauthenticated]:
+            alerter.alert([{'test_term': 'test_value'}])
+
+    # Only rules which log in with the same file, user and password share a connection
+    assert mock_smtp.call_count == 4
+    logins = [call[0] for call in mock_smtp.return_value.login.call_args_list]
+    assert logins == [('someone', 'hunter2'), ('someone', 'hunter3'), ('someone', 'hunter3')]
+    EmailAlerter.smtp_connections.clear()
+
+
 def test_email_from_field():
     rule = {'name': 'test alert', 'email': ['testing@test.test'], 'email_add_domain': 'example.com',
             'type': mock_rule(), 'timestamp_field': '@timestamp', 'email_from_field': 'data.user', 'owner': 'owner_value'}
@@ -376,7 +445,7 @@ def test_opsgenie_basic():
     rule = {'name': 'testOGalert', 'opsgenie_key': 'ogkey',
             'opsgenie_account': 'genies', 'opsgenie_addr': 'https://api.opsgenie.com/v2/alerts',
             'opsgenie_recipients': ['lytics'], 'type': mock_rule()}
-    with mock.patch('requests.post') as mock_post:
+    with mock.patch('requests.Session.post') as mock_post:
 
         alert = OpsGenieAlerter(rule)
         alert.alert([{'@timestamp': '2014-10-31T00:00:00'}])
@@ -399,7 +468,7 @@ def test_opsgenie_frequency():
             'opsgenie_recipients': ['lytics'], 'type': mock_rule(),
             'filter': [{'query': {'query_string': {'query': '*hihi*'}}}],
             'alert': 'opsgenie'}
-    with mock.patch('requests.post') as mock_post:
+    with mock.patch('requests.Session.post') as mock_post:
 
         alert = OpsGenieAlerter(rule)
         alert.alert([{'@timestamp': '2014-10-31T00:00:00'}])
@@ -428,7 +497,7 @@ def test_opsgenie_alert_routing():
             'filter': [{'query': {'query_string': {'query': '*hihi*'}}}],
             'alert': 'opsgenie',
             'opsgenie_teams': ['{TEAM_PREFIX}-Team'], 'opsgenie_teams_args': {'TEAM_PREFIX': 'team'}}
-    with mock.patch('requests.post'):
+    with mock.patch('requests.Session.post'):
 
         alert = OpsGenieAlerter(rule)
         alert.alert([{'@timestamp': '2014-10-31T00:00:00', 'team': "Test", 'recipient': "lytics"}])
@@ -447,7 +516,7 @@ def test_opsgenie_default_alert_routing():
             'opsgenie_teams': ['{TEAM_PREFIX}-Team'],
             'opsgenie_default_receipients': ["devops@test.com"], 'opsgenie_default_teams': ["Test"]
             }
-    with mock.patch('requests.post'):
+    with mock.patch('requests.Session.post'):
 
         alert = OpsGenieAlerter(rule)
         alert.alert([{'@timestamp': '2014-10-31T00:00:00', 'team': "Test"}])
@@ -469,7 +538,7 @@ def test_opsgenie_details_with_constant_value():
     }
     alert = OpsGenieAlerter(rule)
 
-    with mock.patch('requests.post') as mock_post_request:
+    with mock.patch('requests.Session.post') as mock_post_request:
         alert.alert([match])
 
     mock_post_request.assert_called_once_with(
@@ -509,7 +578,7 @@ def test_opsgenie_details_with_field():
     }
     alert = OpsGenieAlerter(rule)
 
-    with mock.patch('requests.post') as mock_post_request:
+    with mock.patch('requests.Session.post') as mock_post_request:
         alert.alert([match])
 
     mock_post_request.assert_called_once_with(
@@ -551,7 +620,7 @@ def test_opsgenie_details_with_nested_field():
     }
     alert = OpsGenieAlerter(rule)
 
-    with mock.patch('requests.post') as mock_post_request:
+    with mock.patch('requests.Session.post') as mock_post_request:
         alert.alert([match])
 
     mock_post_request.assert_called_once_with(
@@ -597,7 +666,7 @@ def test_opsgenie_details_with_non_string_field():
     }
     alert = OpsGenieAlerter(rule)
 
-    with mock.patch('requests.post') as mock_post_request:
+    with mock.patch('requests.Session.post') as mock_post_request:
         alert.alert([match])
 
     mock_post_request.assert_called_once_with(
@@ -643,7 +712,7 @@ def test_opsgenie_details_with_missing_field():
     }
     alert = OpsGenieAlerter(rule)
 
-    with mock.patch('requests.post') as mock_post_request:
+    with mock.patch('requests.Session.post') as mock_post_request:
         alert.alert([match])
 
     mock_post_request.assert_called_once_with(
@@ -685,7 +754,7 @@ def test_opsgenie_details_with_environment_variable_replacement(environ):
     }
     alert = OpsGenieAlerter(rule)
 
-    with mock.patch('requests.post') as mock_post_request:
+    with mock.patch('requests.Session.post') as mock_post_request:
         alert.alert([match])
 
     mock_post_request.assert_called_once_with(
@@ -873,7 +942,9 @@ def test_jira():
             mock_jira.return_value.priorities.return_value = [mock_priority]
             alert = JiraAlerter(rule)
             alert.alert([{'gmail.the_user': 'jdoe', '@timestamp': '2014-10-31T00:00:00'}])
-            assert mock_jira.mock_calls[4][2]['affected_user_id'] == "jdoe"
+            # The field metadata loaded at startup is reused for the deferred field
+            assert mock_jira.mock_calls[3] == mock.call().create_issue(**mock_jira.mock_calls[3][2])
+            assert mock_jira.mock_calls[3][2]['affected_user_id'] == "jdoe"
 
 
 def test_jira_arbitrary_field_support():
@@ -1144,7 +1215,7 @@ def test_ms_teams():
         '@timestamp': '2016-01-01T00:00:00',
         'somefield': 'foobarbaz'
     }
-    with mock.patch('requests.post') as mock_post_request:
+    with mock.patch('requests.Session.post') as mock_post_request:
         alert.alert([match])
 
     expected_data = {
@@ -1181,7 +1252,7 @@ def test_ms_teams_uses_color_and_fixed_width_text():
         '@timestamp': '2016-01-01T00:00:00',
         'somefield': 'foobarbaz'
     }
-    with mock.patch('requests.post') as mock_post_request:
+    with mock.patch('requests.Session.post') as mock_post_request:
         alert.alert([match])
     body = BasicMatchString(rule, match).__str__()
     body = body.replace('`', "'")
@@ -1218,7 +1289,7 @@ def test_slack_uses_custom_title():
         '@timestamp': '2016-01-01T00:00:00',
         'somefield': 'foobarbaz'
     }
-    with mock.patch('requests.post') as mock_post_request:
+    with mock.patch('requests.Session.post') as mock_post_request:
         alert.alert([match])
 
     expected_data = {
@@ -1264,7 +1335,7 @@ def test_slack_uses_custom_timeout():
         '@timestamp': '2016-01-01T00:00:00',
         'somefield': 'foobarbaz'
     }
-    with mock.patch('requests.post') as mock_post_request:
+    with mock.patch('requests.Session.post') as mock_post_request:
         alert.alert([match])
 
     expected_data = {
@@ -1308,7 +1379,7 @@ def test_slack_uses_rule_name_when_custom_title_is_not_provided():
         '@timestamp': '2016-01-01T00:00:00',
         'somefield': 'foobarbaz'
     }
-    with mock.patch('requests.post') as mock_post_request:
+    with mock.patch('requests.Session.post') as mock_post_request:
         alert.alert([match])
 
     expected_data = {
@@ -1353,7 +1424,7 @@ def test_slack_uses_custom_slack_channel():
         '@timestamp': '2016-01-01T00:00:00',
         'somefield': 'foobarbaz'
     }
-    with mock.patch('requests.post') as mock_post_request:
+    with mock.patch('requests.Session.post') as mock_post_request:
         alert.alert([match])
 
     expected_data = {
@@ -1398,7 +1469,7 @@ def test_slack_uses_list_of_custom_slack_channel():
         '@timestamp': '2016-01-01T00:00:00',
         'somefield': 'foobarbaz'
     }
-    with mock.patch('requests.post') as mock_post_request:
+    with mock.patch('requests.Session.post') as mock_post_request:
         alert.alert([match])
 
     expected_data1 = {
@@ -1460,7 +1531,7 @@ def test_slack_attach_kibana_discover_url_when_generated():
         '@timestamp': '2016-01-01T00:00:00',
         'kibana_discover_url': 'http://kibana#discover'
     }
-    with mock.patch('requests.post') as mock_post_request:
+    with mock.patch('requests.Session.post') as mock_post_request:
         alert.alert([match])
 
     expected_data = {
@@ -1510,7 +1581,7 @@ def test_slack_attach_kibana_discover_url_when_not_generated():
     match = {
         '@timestamp': '2016-01-01T00:00:00'
     }
-    with mock.patch('requests.post') as mock_post_request:
+    with mock.patch('requests.Session.post') as mock_post_request:
         alert.alert([match])
 
     expected_data = {
@@ -1557,7 +1628,7 @@ def test_slack_kibana_discover_title():
         '@timestamp': '2016-01-01T00:00:00',
         'kibana_discover_url': 'http://kibana#discover'
     }
-    with mock.patch('requests.post') as mock_post_request:
+    with mock.patch('requests.Session.post') as mock_post_request:
         alert.alert([match])
 
     expected_data = {
@@ -1609,7 +1680,7 @@ def test_slack_kibana_discover_color():
         '@timestamp': '2016-01-01T00:00:00',
         'kibana_discover_url': 'http://kibana#discover'
     }
-    with mock.patch('requests.post') as mock_post_request:
+    with mock.patch('requests.Session.post') as mock_post_request:
         alert.alert([match])
 
     expected_data = {
@@ -1661,7 +1732,7 @@ def test_http_alerter_with_payload():
         '@timestamp': '2017-01-01T00:00:00',
         'somefield': 'foobarbaz'
     }
-    with mock.patch('requests.post') as mock_post_request:
+    with mock.patch('requests.Session.post') as mock_post_request:
         alert.alert([match])
     expected_data = {
         'posted_name': 'foobarbaz',
@@ -1694,7 +1765,7 @@ def test_http_alerter_with_payload_all_values():
         '@timestamp': '2017-01-01T00:00:00',
         'somefield': 'foobarbaz'
     }
-    with mock.patch('requests.post') as mock_post_request:
+    with mock.patch('requests.Session.post') as mock_post_request:
         alert.alert([match])
     expected_data = {
         'posted_name': 'foobarbaz',
@@ -1727,7 +1798,7 @@ def test_http_alerter_without_payload():
         '@timestamp': '2017-01-01T00:00:00',
         'somefield': 'foobarbaz'
     }
-    with mock.patch('requests.post') as mock_post_request:
+    with mock.patch('requests.Session.post') as mock_post_request:
         alert.alert([match])
     expected_data = {
         '@timestamp': '2017-01-01T00:00:00',
@@ -1759,7 +1830,7 @@ def test_pagerduty_alerter():
         '@timestamp': '2017-01-01T00:00:00',
         'somefield': 'foobarbaz'
     }
-    with mock.patch('requests.post') as mock_post_request:
+    with mock.patch('requests.Session.post') as mock_post_request:
         alert.alert([match])
     expected_data = {
         'client': 'ponies inc.',
@@ -1797,7 +1868,7 @@ def test_pagerduty_alerter_v2():
         '@timestamp': '2017-01-01T00:00:00',
         'somefield': 'foobarbaz'
     }
-    with mock.patch('requests.post') as mock_post_request:
+    with mock.patch('requests.Session.post') as mock_post_request:
         alert.alert([match])
     expected_data = {
         'client': 'ponies inc.',
@@ -1838,7 +1909,7 @@ def test_pagerduty_alerter_custom_incident_key():
         '@timestamp': '2017-01-01T00:00:00',
         'somefield': 'foobarbaz'
     }
-    with mock.patch('requests.post') as mock_post_request:
+    with mock.patch('requests.Session.post') as mock_post_request:
         alert.alert([match])
     expected_data = {
         'client': 'ponies inc.',
@@ -1871,7 +1942,7 @@ def test_pagerduty_alerter_custom_incident_key_with_args():
         '@timestamp': '2017-01-01T00:00:00',
         'somefield': 'foobarbaz'
     }
-    with mock.patch('requests.post') as mock_post_request:
+    with mock.patch('requests.Session.post') as mock_post_request:
         alert.alert([match])
     expected_data = {
         'client': 'ponies inc.',
@@ -1905,7 +1976,7 @@ def test_pagerduty_alerter_custom_alert_subject():
         '@timestamp': '2017-01-01T00:00:00',
         'somefield': 'foobarbaz'
     }
-    with mock.patch('requests.post') as mock_post_request:
+    with mock.patch('requests.Session.post') as mock_post_request:
         alert.alert([match])
     expected_data = {
         'client': 'ponies inc.',
@@ -1941,7 +2012,7 @@ def test_pagerduty_alerter_custom_alert_subject_with_args():
         'somefield': 'Stinky',
         'someotherfield': 'foobarbaz'
     }
-    with mock.patch('requests.post') as mock_post_request:
+    with mock.patch('requests.Session.post') as mock_post_request:
         alert.alert([match])
     expected_data = {
         'client': 'ponies inc.',
@@ -1978,7 +2049,7 @@ def test_pagerduty_alerter_custom_alert_subject_with_args_specifying_trigger():
         'somefield': 'Stinkiest',
         'someotherfield': 'foobarbaz'
     }
-    with mock.patch('requests.post') as mock_post_request:
+    with mock.patch('requests.Session.post') as mock_post_request:
         alert.alert([match])
     expected_data = {
         'client': 'ponies inc.',
@@ -2103,7 +2174,7 @@ def test_stride_plain_text():
         '@timestamp': '2016-01-01T00:00:00',
         'somefield': 'foobarbaz'
     }
-    with mock.patch('requests.post') as mock_post_request:
+    with mock.patch('requests.Session.post') as mock_post_request:
         alert.alert([match])
 
     body = "{0}\n\n@timestamp: {1}\nsomefield: {2}".format(
@@ -2149,7 +2220,7 @@ def test_stride_underline_text():
         '@timestamp': '2016-01-01T00:00:00',
         'somefield': 'foobarbaz'
     }
-    with mock.patch('requests.post') as mock_post_request:
+    with mock.patch('requests.Session.post') as mock_post_request:
         alert.alert([match])
 
     body = "Underline Text"
@@ -2195,7 +2266,7 @@ def test_stride_bold_text():
         '@timestamp': '2016-01-01T00:00:00',
         'somefield': 'foobarbaz'
     }
-    with mock.patch('requests.post') as mock_post_request:
+    with mock.patch('requests.Session.post') as mock_post_request:
         alert.alert([match])
 
     body = "Bold Text"
@@ -2241,7 +2312,7 @@ def test_stride_strong_text():
         '@timestamp': '2016-01-01T00:00:00',
         'somefield': 'foobarbaz'
     }
-    with mock.patch('requests.post') as mock_post_request:
+    with mock.patch('requests.Session.post') as mock_post_request:
         alert.alert([match])
 
     body = "Bold Text"
@@ -2287,7 +2358,7 @@ def test_stride_hyperlink():
         '@timestamp': '2016-01-01T00:00:00',
         'somefield': 'foobarbaz'
     }
-    with mock.patch('requests.post') as mock_post_request:
+    with mock.patch('requests.Session.post') as mock_post_request:
         alert.alert([match])
 
     body = "Link"
@@ -2333,7 +2404,7 @@ def test_stride_html():
         '@timestamp': '2016-01-01T00:00:00',
         'somefield': 'foobarbaz'
     }
-    with mock.patch('requests.post') as mock_post_request:
+    with mock.patch('requests.Session.post') as mock_post_request:
         alert.alert([match])
 
     expected_data = {'body': {'version': 1, 'type': "doc", 'content': [
@@ -2452,7 +2523,7 @@ def test_alerta_no_auth(ea):
     rules_loader = FileRulesLoader({})
     rules_loader.load_modules(rule)
     alert = AlertaAlerter(rule)
-    with mock.patch('requests.post') as mock_post_request:
+    with mock.patch('requests.Session.post') as mock_post_request:
         alert.alert([match])
 
     expected_data = {
@@ -2507,7 +2578,7 @@ def test_alerta_auth(ea):
     rules_loader = FileRulesLoader({})
     rules_loader.load_modules(rule)
     alert = AlertaAlerter(rule)
-    with mock.patch('requests.post') as mock_post_request:
+    with mock.patch('requests.Session.post') as mock_post_request:
         alert.alert([match])
 
     mock_post_request.assert_called_once_with(
@@ -2551,7 +2622,7 @@ def test_alerta_new_style(ea):
     rules_loader = FileRulesLoader({})
     rules_loader.load_modules(rule)
     alert = AlertaAlerter(rule)
-    with mock.patch('requests.post') as mock_post_request:
+    with mock.patch('requests.Session.post') as mock_post_request:
         alert.alert([match])
 
     expected_data = {
@@ -2611,3 +2682,207 @@ def test_alert_subject_size_limit_with_args(ea):
     alert = Alerter(rule)
     alertSubject = alert.create_custom_title([{'test_term': 'test_value', '@timestamp': '2014-10-31T00:00:00'}])
     assert 6 == len(alertSubject)
+
+
+def test_http_session_pool():
+    rule = {'name': 'Test Rule', 'type': 'any', 'http_read_timeout': 5}
+    first = HTTPPostAlerter(dict(rule, http_post_url='https://example.com/first'))
+    second = HTTPPostAlerter(dict(rule, http_post_url='https://example.com/second'))
+    other = HTTPPostAlerter(dict(rule, http_post_url='https://other.example.com/'))
+    session = first.get_http_session(first.post_url[0])
+    assert second.get_http_session(second.post_url[0]) is session
+    assert other.get_http_session(other.post_url[0]) is not session
+
+    with mock.patch('requests.Session.request') as mock_request:
+        session.post('https://example.com/first', data='{}')
+        session.post('https://example.com/first', data='{}', timeout=60)
+    assert mock_request.call_args_list[0][1]['timeout'] == (10, 5)
+    assert mock_request.call_args_list[1][1]['timeout'] == 60
+
+
+def test_stomp_keepalive():
+    rule = {'name': 'Test Rule', 'type': mock_rule(), 'timestamp_field': '@timestamp', 'rule_file': 'rule.yaml',
+            'stomp_hostname': 'keepalive.test', 'stomp_hostport': '61613', 'stomp_login': 'admin', 'stomp_password': 'admin',
+            'stomp_keepalive': True}
+    StompAlerter.stomp_connections.clear()
+    with mock.patch('elastalert.alerts.stomp.Connection') as mock_connection:
+        mock_connection.return_value.is_connected.return_value = True
+        StompAlerter(rule).alert([{'@timestamp': '2014-10-10T00:00:00'}])
+        StompAlerter(dict(rule, name='Other Rule')).alert([{'@timestamp': '2014-10-10T00:00:00'}])
+    conn = mock_connection.return_value
+    assert mock_connection.call_count == 1
+    assert conn.connect.call_count == 1
+    assert conn.send.call_count == 2
+    assert not conn.disconnect.called
+    StompAlerter.stomp_connections.clear()
+
+
+def test_stomp_keepalive_reconnect():
+    rule = {'name': 'Test Rule', 'type': mock_rule(), 'timestamp_field': '@timestamp', 'rule_file': 'rule.yaml',
+            'stomp_hostname': 'keepalive.test', 'stomp_hostport': '61613', 'stomp_login': 'admin', 'stomp_password': 'admin',
+            'stomp_keepalive': True}
+    StompAlerter.stomp_connections.clear()
+    dropped, failing, fresh = mock.Mock(), mock.Mock(), mock.Mock()
+    dropped.is_connected.return_value = False
+    failing.send.side_effect = Exception('broken pipe')
+    with mock.patch('elastalert.alerts.stomp.Connection', side_effect=[dropped, failing, fresh]):
+        alerter = StompAlerter(rule)
+        alerter.alert([{'@timestamp': '2014-10-10T00:00:00'}])
+        # The broker dropped the connection, so a new one is made, on which sending fails
+        with pytest.raises(Exception):
+            alerter.alert([{'@timestamp': '2014-10-10T00:00:00'}])
+        assert dropped.disconnect.called
+        assert failing.disconnect.called
+        # The connection on which sending failed is not reused
+        alerter.alert([{'@timestamp': '2014-10-10T00:00:00'}])
+    assert fresh.start.called
+    assert fresh.send.call_count == 1
+    StompAlerter.stomp_connections.clear()
+
+
+def test_zabbix_metric_batch():
+    sender = mock.Mock()
+    batch = ZabbixMetricBatch(sender, chunk_size=3, flush_interval=60)
+    batch.add(['first', 'second'])
+    assert not sender.send.called
+    batch.add(['third'])
+    sender.send.assert_called_once_with(['first', 'second', 'third'])
+
+    batch.add(['fourth'])
+    batch.close()
+    sender.send.assert_called_with(['fourth'])
+    batch.flush_thread.join(1)
+    assert not batch.flush_thread.is_alive()
+
+
+def test_zabbix_metric_batch_settings():
+    # Rules with different batch settings do not share a batch
+    with mock.patch('elastalert.zabbix.ZabbixMetricBatch') as mock_batch:
+        mock_batch.side_effect = lambda sender, chunk_size, flush_interval: mock.Mock(chunk_size=chunk_size)
+        batch = get_metric_batch('zabbix.test', 10051, 100, 5)
+        assert get_metric_batch('zabbix.test', 10051, 100, 5) is batch
+        other = get_metric_batch('zabbix.test', 10051, 10, 5)
+    assert other is not batch
+    assert other.chunk_size == 10
+
+    # Closing sends what every batch still holds
+    close_metric_batches()
+    assert batch.close.called
+    assert other.close.called
+    assert not metric_batches
+
+
+def test_jira_caches():
+    rule = {
+        'name': 'test alert',
+        'jira_account_file': 'jirafile',
+        'type': mock_rule(),
+        'jira_project': 'testproject',
+        'jira_issuetype': 'testtype',
+        'jira_server': 'jiraserver',
+        'jira_bump_tickets': True,
+        'jira_bump_after_inactivity': 1,
+        'jira_transition_to': 'Reopened',
+        'timestamp_field': '@timestamp',
+        'rule_file': '/tmp/foo.yaml'
+    }
+    recent_issue = mock.Mock()
+    recent_issue.fields.updated = str(ts_now())
+    old_issue = mock.Mock()
+    old_issue.fields.updated = str(ts_now() - datetime.timedelta(days=4))
+    match = {'@timestamp': '2014-10-31T00:00:00'}
+    with mock.patch('elastalert.alerts.JIRA') as mock_jira, \
+            mock.patch('elastalert.alerts.yaml_loader') as mock_open:
+        mock_open.return_value = {'user': 'jirauser', 'password': 'jirapassword'}
+        client = mock_jira.return_value
+        client.fields.return_value = []
+        client.priorities.return_value = []
+        client.transitions.return_value = [{'name': 'Reopened', 'id': '3'}]
+        client.search_issues.return_value = [recent_issue]
+        alert = JiraAlerter(rule)
+
+        # A recently updated ticket is found once and reused
+        alert.alert([match])
+        alert.alert([match])
+        assert client.fields.call_count == 1
+        assert client.search_issues.call_count == 1
+        assert not client.add_comment.called
+
+        # Commenting on a ticket invalidates the search, transitions are reused
+        alert.search_cache.clear()
+        client.search_issues.return_value = [old_issue]
+        alert.alert([match])
+        alert.alert([match])
+        assert client.search_issues.call_count == 3
+        assert client.add_comment.call_count == 2
+        assert client.transition_issue.call_count == 2
+        assert client.transitions.call_count == 1
+
+
+def test_pretty_print_json():
+    blob = {'b': [1, 2.5, True, None, {}], 'a': {'nested': ['☃', 'quote"d', '\n'], 'empty': []},
+            'time': datetime.datetime(2014, 10, 31), 'inf': float('inf'), 'tuple': (1, 'two')}
+    assert pretty_print_json(blob) == json.dumps(blob, cls=DateTimeEncoder, sort_keys=True, indent=4, ensure_ascii=False)
+    with pytest.raises(TypeError):
+        pretty_print_json({1: 'non string key'})
+
+
+def test_aggregated_email_templates_compiled_once():
+    rule = {'name': 'Test Rule', 'type': mock_rule(), 'timestamp_field': '@timestamp', 'email': ['testing@test.test'],
+            'aggregation': {'minutes': 5}, 'summary_table_fields': ['user', 'host.name'],
+            'alert_subject': 'Alert for {0} on {1}', 'alert_subject_args': ['user', 'host.name'],
+            'alert_text': 'User {0} from {1} at {2}', 'alert_text_args': ['user', 'source.ip', 'owner'], 'owner': 'the owner'}
+    matches = [{'@timestamp': '2014-10-31T00:00:%02d' % (i % 60), 'user': 'user%d' % (i % 50), 'host': {'name': 'host%d' % (i % 7)},
+                'source': {'ip': '10.0.0.%d' % (i % 255)}, 'tags': ['a', 'b'], 'nested': {'count': i}} for i in range(10000)]
+    _get_alert_template.cache_clear()
+    with mock.patch('elastalert.alerts.SMTP') as mock_smtp, \
+            mock.patch('elastalert.alerts.AlertTemplate', wraps=AlertTemplate) as mock_template:
+        alert = EmailAlerter(rule)
+        alert.alert(matches)
+        text = alert.create_alert_body(matches)
+    body = mock_smtp.return_value.sendmail.call_args[0][2]
+    assert 'Subject: Alert for user0 on host0' in body
+
+    # The subject and the text are each compiled once for every match
+    assert sorted(call[0][0] for call in mock_template.call_args_list) == ['Alert for {0} on {1}', 'User {0} from {1} at {2}']
+    assert text.count('\n----------------------------------------\n') == 10000
+    assert 'User user49 from 10.0.0.49 at the owner\n\n' in text
+    assert re.search(r'\| user0 +\| host0 +\| 29 +\|', text)
+
+
+def test_aggregation_summary_max_rows():
+    # By default, at most 1000 distinct values are counted
+    summary = AggregationSummary.from_rule({'summary_table_fields': 'user'})
+    summary.add_matches([{'user': 'user%d' % (i)} for i in range(1005)] + [{'user': 'user0'}])
+    assert len(summary.counts) == 1000
+    assert summary.counts[('user0',)] == 2
+    assert summary.other == 5
+    assert summary.total == 1006
+
+
+def test_aggregation_summary_shared():
+    rule = {'name': 'Test Rule', 'type': mock_rule(), 'timestamp_field': '@timestamp', 'aggregation': {'minutes': 5},
+            'summary_table_fields': ['user'], 'summary_table_max_rows': 2, 'alert_text_type': 'aggregation_summary_only'}
+    matches = [{'user': user} for user in ['alice', 'bob', 'alice', 'carol', 'dave']]
+    pipeline = {}
+    first = Alerter(rule)
+    second = Alerter(rule)
+    first.pipeline = pipeline
+    second.pipeline = pipeline
+    with mock.patch.object(AggregationSummary, 'add_matches', side_effect=AggregationSummary.add_matches,
+                           autospec=True) as mock_add_matches:
+        text = first.create_alert_body(matches)
+        assert second.create_alert_body(matches) == text
+    # The matches are counted once, and matches beyond the maximum number of rows are counted together
+    assert mock_add_matches.call_count == 1
+    assert pipeline['aggregation_summary'].counts == {('alice',): 2, ('bob',): 1}
+    assert re.search(r'\| <OTHER> +\| 2 +\|', text)
+
+
+def test_aggregation_summary_dates():
+    timestamp = datetime.datetime(2014, 10, 10, 0, 0, tzinfo=dateutil.tz.tzutc())
+    # Dates are shown with str, or as written to the writeback index for matches counted as they are aggregated
+    assert list(AggregationSummary(['@timestamp']).add_matches([{'@timestamp': timestamp}]).counts) == [
+        ('2014-10-10 00:00:00+00:00',)]
+    assert list(AggregationSummary(['@timestamp'], written=True).add_matches([{'@timestamp': timestamp}]).counts) == [
+        ('2014-10-10T00:00:00+00:00',)]
@@ -13,6 +13,8 @@ from elasticsearch.exceptions import ElasticsearchException
 from elastalert.enhancements import BaseEnhancement
 from elastalert.enhancements import DropMatchException
 from elastalert.kibana import dashboard_temp
+from elastalert.outbox import AlertOutbox
+from elastalert.ruletypes import MetricAggregationRule
 from elastalert.util import dt_to_ts
 from elastalert.util import dt_to_unix
 from elastalert.util import dt_to_unixms
@@ -20,6 +22,7 @@ from elastalert.util import EAException
 from elastalert.util import ts_now
 from elastalert.util import ts_to_dt
 from elastalert.util import unix_to_dt
+from elastalert.writeback import SQLiteWriteback
 
 START_TIMESTAMP = '2014-09-26T12:34:45Z'
 END_TIMESTAMP = '2014-09-27T12:34:45Z'
@@ -416,20 +419,20 @@ def test_agg_matchtime(ea):
 
     with mock.patch('elastalert.elastalert.elasticsearch_client') as mock_es:
         ea.send_pending_alerts()
-        # Assert that current_es was refreshed from the aggregate rules
-        assert mock_es.called_with(host='', port='')
-        assert mock_es.call_count == 2
+        # Assert that current_es was set to the client of the aggregate rules, which is reused
+        assert mock_es.call_count == 0
+        assert ea.thread_data.current_es is ea.es_clients[ea.rules[0]['name']]
     assert_alerts(ea, [hits_timestamps[:2], hits_timestamps[2:]])
 
-    call1 = ea.writeback_es.deprecated_search.call_args_list[7][1]['body']
-    call2 = ea.writeback_es.deprecated_search.call_args_list[8][1]['body']
-    call3 = ea.writeback_es.deprecated_search.call_args_list[9][1]['body']
-    call4 = ea.writeback_es.deprecated_search.call_args_list[10][1]['body']
+    call1 = ea.writeback_es.deprecated_search.call_args_list[-4][1]['body']
+    call2 = ea.writeback_es.deprecated_search.call_args_list[-3][1]['body']
+    call3 = ea.writeback_es.deprecated_search.call_args_list[-2][1]['body']
+    call4 = ea.writeback_es.deprecated_search.call_args_list[-1][1]['body']
 
     assert 'alert_time' in call2['filter']['range']
     assert call3['query']['query_string']['query'] == 'aggregate_id:ABCD'
     assert call4['query']['query_string']['query'] == 'aggregate_id:CDEF'
-    assert ea.writeback_es.deprecated_search.call_args_list[9][1]['size'] == 1337
+    assert ea.writeback_es.deprecated_search.call_args_list[-2][1]['size'] == 1337
 
 
 def test_agg_not_matchtime(ea):
@@ -514,9 +517,10 @@ def test_agg_no_writeback_connectivity(ea):
         with mock.patch.object(ea, 'find_pending_aggregate_alert', return_value=None):
             ea.run_rule(ea.rules[0], END, START)
 
-    assert ea.rules[0]['agg_matches'] == [{'@timestamp': hit1, 'num_hits': 0, 'num_matches': 3},
-                                          {'@timestamp': hit2, 'num_hits': 0, 'num_matches': 3},
-                                          {'@timestamp': hit3, 'num_hits': 0, 'num_matches': 3}]
+    assert ea.rules[0]['agg_matches'].keys() == [None]
+    assert ea.rules[0]['agg_matches'].buffers[None] == [{'@timestamp': hit1, 'num_hits': 0, 'num_matches': 3},
+                                                        {'@timestamp': hit2, 'num_hits': 0, 'num_matches': 3},
+                                                        {'@timestamp': hit3, 'num_hits': 0, 'num_matches': 3}]
 
     ea.thread_data.current_es.search.return_value = {'hits': {'total': 0, 'hits': []}}
     ea.add_aggregated_alert = mock.Mock()
@@ -529,6 +533,50 @@ def test_agg_no_writeback_connectivity(ea):
     ea.add_aggregated_alert.assert_any_call({'@timestamp': hit3, 'num_hits': 0, 'num_matches': 3}, ea.rules[0])
 
 
+def test_agg_no_writeback_connectivity_by_key(ea):
+    """ Tests that matches kept in memory are sent by aggregation key, once their aggregation is due """
+    ea.rules[0]['aggregation'] = datetime.timedelta(minutes=10)
+    ea.rules[0]['aggregation_key'] = 'key'
+    ea.writeback_es.index.side_effect = elasticsearch.exceptions.ElasticsearchException('Nope')
+    with mock.patch.object(ea, 'find_pending_aggregate_alert', return_value=None):
+        for key in ['a', 'b', 'a']:
+            ea.add_aggregated_alert({'@timestamp': '2014-09-26T12:34:45', 'key': key}, ea.rules[0])
+    assert sorted(ea.rules[0]['agg_matches'].keys()) == ['a', 'b']
+
+    ea.rules[0]['aggregate_alert_time']['a'] = ts_now() - datetime.timedelta(minutes=1)
+    with mock.patch.object(ea, 'find_recent_pending_alerts', return_value=[]):
+        with mock.patch.object(ea, 'alert') as mock_alert:
+            ea.send_pending_alerts()
+    mock_alert.assert_called_once_with([{'@timestamp': '2014-09-26T12:34:45', 'key': 'a'}] * 2, ea.rules[0])
+    assert ea.rules[0]['agg_matches'].keys() == ['b']
+
+
+def test_aggregation_deadlines(ea):
+    """ Tests that pending alerts are sent when the earliest aggregation is due """
+    ea.running = True
+    ea.scheduler.add_job.reset_mock()
+    now = ts_to_dt('2014-09-26T12:34:45Z')
+    ea.rules[0]['aggregation'] = datetime.timedelta(minutes=10)
+    ea.rules[0]['aggregation_key'] = 'key'
+    with mock.patch('elastalert.elastalert.ts_now', return_value=now):
+        with mock.patch.object(ea, 'find_pending_aggregate_alert', return_value=None):
+            ea.add_aggregated_alert({'@timestamp': '2014-09-26T12:34:45', 'key': 'a'}, ea.rules[0])
+        ea.add_aggregation_deadline(now + datetime.timedelta(minutes=20))
+        ea.add_aggregation_deadline(now + datetime.timedelta(minutes=5))
+    # Only the deadlines which were the earliest were scheduled
+    run_dates = [call[1]['run_date'] for call in ea.scheduler.add_job.call_args_list]
+    assert run_dates == [now + datetime.timedelta(minutes=10, seconds=1), now + datetime.timedelta(minutes=5, seconds=1)]
+    assert ea.scheduler.add_job.call_args[1]['id'] == '_internal_flush_aggregations'
+
+    ea.scheduler.add_job.reset_mock()
+    with mock.patch('elastalert.elastalert.ts_now', return_value=now + datetime.timedelta(minutes=10, seconds=1)):
+        with mock.patch.object(ea, 'send_pending_alerts') as mock_send:
+            ea.handle_aggregation_deadlines()
+    assert mock_send.call_count == 1
+    assert ea.aggregation_deadlines == [now + datetime.timedelta(minutes=20)]
+    assert ea.scheduler.add_job.call_args[1]['run_date'] == now + datetime.timedelta(minutes=20, seconds=1)
+
+
 def test_agg_with_aggregation_key(ea):
     ea.max_aggregation = 1337
     hits_timestamps = ['2014-09-26T12:34:45', '2014-09-26T12:40:45', '2014-09-26T12:43:45']
@@ -585,20 +633,20 @@ def test_agg_with_aggregation_key(ea):
     with mock.patch('elastalert.elastalert.elasticsearch_client') as mock_es:
         mock_es.return_value = ea.thread_data.current_es
         ea.send_pending_alerts()
-        # Assert that current_es was refreshed from the aggregate rules
-        assert mock_es.called_with(host='', port='')
-        assert mock_es.call_count == 2
+        # Assert that current_es was set to the client of the aggregate rules, which is reused
+        assert mock_es.call_count == 0
+        assert ea.thread_data.current_es is ea.es_clients[ea.rules[0]['name']]
     assert_alerts(ea, [[hits_timestamps[0], hits_timestamps[2]], [hits_timestamps[1]]])
 
-    call1 = ea.writeback_es.deprecated_search.call_args_list[7][1]['body']
-    call2 = ea.writeback_es.deprecated_search.call_args_list[8][1]['body']
-    call3 = ea.writeback_es.deprecated_search.call_args_list[9][1]['body']
-    call4 = ea.writeback_es.deprecated_search.call_args_list[10][1]['body']
+    call1 = ea.writeback_es.deprecated_search.call_args_list[-4][1]['body']
+    call2 = ea.writeback_es.deprecated_search.call_args_list[-3][1]['body']
+    call3 = ea.writeback_es.deprecated_search.call_args_list[-2][1]['body']
+    call4 = ea.writeback_es.deprecated_search.call_args_list[-1][1]['body']
 
     assert 'alert_time' in call2['filter']['range']
     assert call3['query']['query_string']['query'] == 'aggregate_id:ABCD'
     assert call4['query']['query_string']['query'] == 'aggregate_id:CDEF'
-    assert ea.writeback_es.deprecated_search.call_args_list[9][1]['size'] == 1337
+    assert ea.writeback_es.deprecated_search.call_args_list[-2][1]['size'] == 1337
 
 
 def test_silence(ea):
@@ -840,6 +888,127 @@ def test_query_segmenting(ea):
         run_and_assert_segmented_queries(ea, START, END, ea.run_every)
 
 
+def test_composite_aggregation_query(ea):
+    rule = ea.rules[0]
+    rule['five'] = True
+    rule['aggregation_query_element'] = {'metric_cpu_avg': {'avg': {'field': 'cpu'}}}
+    rule['query_key'] = 'host,service'
+    rule['use_composite_aggregation'] = True
+    rule['aggregation_page_size'] = 2
+    rule['type'].add_aggregation_data = mock.Mock()
+    pages = [{'hits': {'total': 3},
+              'aggregations': {'bucket_aggs': {'after_key': {'host': 'a', 'service': 'y'},
+                                               'buckets': [{'key': {'host': 'a', 'service': 'x'}, 'doc_count': 1,
+                                                            'metric_cpu_avg': {'value': 10}},
+                                                           {'key': {'host': 'a', 'service': 'y'}, 'doc_count': 1,
+                                                            'metric_cpu_avg': {'value': 20}}]}}},
+             {'hits': {'total': 3},
+              'aggregations': {'bucket_aggs': {'after_key': {'host': 'b', 'service': 'x'},
+                                               'buckets': [{'key': {'host': 'b', 'service': 'x'}, 'doc_count': 1,
+                                                            'metric_cpu_avg': {'value': 30}}]}}}]
+    queries = []
+
+    def search(**kwargs):
+        queries.append(copy.deepcopy(kwargs['body']))
+        return pages[len(queries) - 1]
+
+    ea.thread_data.current_es = mock.Mock()
+    ea.thread_data.current_es.is_atleastsixtwo.return_value = True
+    ea.thread_data.current_es.is_atleastseven.return_value = False
+    ea.thread_data.current_es.deprecated_search.side_effect = search
+    assert ea.run_query(rule, START, END)
+
+    assert len(queries) == 2
+    composite = queries[0]['aggs']['bucket_aggs']['composite']
+    assert composite == {'size': 2, 'sources': [{'host': {'terms': {'field': 'host'}}},
+                                                {'service': {'terms': {'field': 'service'}}}]}
+    assert queries[0]['aggs']['bucket_aggs']['aggs'] == rule['aggregation_query_element']
+    assert queries[1]['aggs']['bucket_aggs']['composite']['after'] == {'host': 'a', 'service': 'y'}
+    assert ea.thread_data.num_hits == 3
+
+    # Each page is passed to the rule type as nested term buckets
+    calls = rule['type'].add_aggregation_data.call_args_list
+    assert len(calls) == 2
+    assert calls[0][0][0] == {END: {'bucket_aggs': {'buckets': [
+        {'key': 'a', 'bucket_aggs': {'buckets': [{'key': 'x', 'doc_count': 1, 'metric_cpu_avg': {'value': 10}},
+                                                 {'key': 'y', 'doc_count': 1, 'metric_cpu_avg': {'value': 20}}]}}]}}}
+    assert calls[1][0][0] == {END: {'bucket_aggs': {'buckets': [
+        {'key': 'b', 'bucket_aggs': {'buckets': [{'key': 'x', 'doc_count': 1, 'metric_cpu_avg': {'value': 30}}]}}]}}}
+
+
+def test_composite_aggregation_query_versions(ea):
+    rule = ea.rules[0]
+    rule['five'] = True
+    rule['aggregation_query_element'] = {'metric_cpu_avg': {'avg': {'field': 'cpu'}}}
+    rule['query_key'] = 'host'
+    rule['use_composite_aggregation'] = True
+    rule['aggregation_page_size'] = 1
+    rule['type'].add_aggregation_data = mock.Mock()
+    ea.thread_data.current_es = mock.Mock()
+    ea.thread_data.current_es.is_atleastseven.return_value = False
+
+    # Before Elasticsearch 6.2, the terms aggregation is used
+    ea.thread_data.current_es.is_atleastsixtwo.return_value = False
+    with mock.patch.object(ea, 'get_hits_aggregation', return_value={}) as mock_terms:
+        assert ea.run_query(rule, START, END)
+    assert mock_terms.called
+    assert not ea.thread_data.current_es.deprecated_search.called
+
+    # Before Elasticsearch 6.3, pages without an after_key resume from their last bucket
+    ea.thread_data.current_es.is_atleastsixtwo.return_value = True
+    ea.thread_data.current_es.deprecated_search.side_effect = [
+        {'hits': {'total': 2}, 'aggregations': {'bucket_aggs': {'buckets': [{'key': {'host': 'a'}, 'doc_count': 1}]}}},
+        {'hits': {'total': 2}, 'aggregations': {'bucket_aggs': {'buckets': []}}}]
+    assert ea.run_query(rule, START, END)
+    queries = [call[1]['body'] for call in ea.thread_data.current_es.deprecated_search.call_args_list]
+    assert len(queries) == 2
+    assert queries[1]['aggs']['bucket_aggs']['composite']['after'] == {'host': 'a'}
+
+
+def test_combined_aggregation_queries(ea):
+    ea.combine_aggregation_queries = True
+    rules = []
+    for metric_agg_key in ['cpu', 'memory']:
+        rule = copy.copy(ea.rules[0])
+        rule.update({'name': 'metric_%s' % (metric_agg_key), 'metric_agg_key': metric_agg_key, 'metric_agg_type': 'avg',
+                     'max_threshold': 90, 'buffer_time': datetime.timedelta(minutes=5)})
+        rule['type'] = MetricAggregationRule(rule)
+        ea.init_rule(rule, True)
+        rules.append(rule)
+    other_rule = copy.copy(rules[0])
+    other_rule['index'] = 'other_idx'
+    assert rules[0]['aggregation_signature'] == rules[1]['aggregation_signature']
+    assert ea.get_aggregation_signature(other_rule) != rules[0]['aggregation_signature']
+    ea.rules = rules
+
+    # The second rule to run in the same run_every period uses the first rule's endtime
+    assert ea.get_aggregation_group_endtime(rules[0], END) == END
+    assert ea.get_aggregation_group_endtime(rules[1], END + datetime.timedelta(seconds=5)) == END
+    rules[1]['previous_endtime'] = END
+    later = END + datetime.timedelta(seconds=10)
+    assert ea.get_aggregation_group_endtime(rules[1], later) == later
+
+    # One query answers both rules
+    ea.thread_data.current_es.deprecated_search.return_value = {
+        'hits': {'total': 10},
+        'aggregations': {'filtered': {'metric_cpu_avg': {'value': 95}, 'metric_memory_avg': {'value': 50}}}}
+    data = ea.get_hits_aggregation(rules[0], START, END, 'idx', None)
+    body = ea.thread_data.current_es.deprecated_search.call_args[1]['body']
+    assert body['aggs']['filtered']['aggs'] == {'metric_cpu_avg': {'avg': {'field': 'cpu'}},
+                                                'metric_memory_avg': {'avg': {'field': 'memory'}}}
+    assert ea.get_hits_aggregation(rules[1], START, END, 'idx', None) == data
+    assert ea.thread_data.current_es.deprecated_search.call_count == 1
+
+    rules[0]['type'].add_aggregation_data(data)
+    rules[1]['type'].add_aggregation_data(data)
+    assert len(rules[0]['type'].matches) == 1
+    assert len(rules[1]['type'].matches) == 0
+
+    # A different window needs a new query
+    ea.get_hits_aggregation(rules[1], START, later, 'idx', None)
+    assert ea.thread_data.current_es.deprecated_search.call_count == 2
+
+
 def test_get_starttime(ea):
     endtime = '2015-01-01T00:00:00Z'
     mock_es = mock.Mock()
@@ -1109,6 +1278,71 @@ def test_count_keys(ea):
     assert counts['top_events_that'] == {'d': 10, 'c': 12}
 
 
+def test_count_keys_batched(ea):
+    rule = ea.rules[0]
+    rule['timeframe'] = datetime.timedelta(minutes=60)
+    rule['top_count_keys'] = ['this', 'that']
+    rule['query_key'] = 'user'
+    rule['doc_type'] = 'blah'
+    response = {'aggregations': {'filtered': {
+        'counts_0': {'buckets': [{'key': 'a', 'doc_count': 10}, {'key': 'b', 'doc_count': 5}]},
+        'counts_1': {'buckets': [{'key': 'd', 'doc_count': 10}, {'key': 'c', 'doc_count': 12}]}}}}
+    ea.thread_data.current_es.msearch.return_value = {'responses': [response, response]}
+    matches = [{'@timestamp': '2014-09-26T12:00:%02d' % (i), 'user': 'bob' if i % 3 else 'alice'} for i in range(30)]
+    with mock.patch.object(ea, 'alert'):
+        ea.send_alert(matches, rule)
+
+    # Matches in the same minute with the same query_key value share one search, with an aggregation per key
+    ea.thread_data.current_es.msearch.assert_called_once()
+    body = ea.thread_data.current_es.msearch.call_args[1]['body']
+    assert len(body) == 4
+    assert body[0]['search_type'] == 'count'
+    aggs = body[1]['aggs']['filtered']['aggs']
+    assert aggs['counts_0']['terms'] == {'field': 'this', 'size': 5, 'min_doc_count': 1}
+    assert aggs['counts_1']['terms']['field'] == 'that'
+    for match in matches:
+        assert match['top_events_this'] == {'a': 10, 'b': 5}
+        assert match['top_events_that'] == {'d': 10, 'c': 12}
+
+    # Lookups are cached
+    ea.send_alert([{'@timestamp': '2014-09-26T12:00:45', 'user': 'bob'}], rule)
+    ea.thread_data.current_es.msearch.assert_called_once()
+
+    # Failed searches are not cached
+    ea.thread_data.current_es.msearch.return_value = {'responses': [{'error': 'oops'}]}
+    counts = ea.get_top_counts_batch(rule, [(END, END, 'carol')], ['this'])
+    assert counts == [{'top_events_this': {}}]
+    assert not ea.top_counts_cache.get((rule['name'], END, END, 'carol', ('this',), 5))
+
+
+def test_count_keys_local(ea):
+    rule = ea.rules[0]
+    rule['top_count_local'] = True
+    rule['top_count_keys'] = ['username']
+    rule['timeframe'] = datetime.timedelta(minutes=10)
+    rule = ea.init_rule(rule, True)
+    assert rule['top_count_keys'] == ['username.raw']
+    timestamps = [dt_to_ts(START + datetime.timedelta(minutes=i)) for i in range(30)]
+    hits = generate_hits(timestamps)
+    for i, hit in enumerate(hits['hits']['hits']):
+        hit['_source']['username'] = 'bob' if i % 3 else 'alice'
+    ea.thread_data.current_es.search.return_value = hits
+    ea.thread_data.current_es.msearch.return_value = {'responses': [{}]}
+    ea.run_query(rule, START, START + datetime.timedelta(minutes=30))
+
+    # Top counts are computed from the queried events, if they cover the window
+    match = {'@timestamp': timestamps[20]}
+    with mock.patch.object(ea, 'alert'):
+        ea.send_alert([match, {'@timestamp': timestamps[5]}], rule)
+    assert match['top_events_username.raw'] == {'bob': 14, 'alice': 6}
+    ea.thread_data.current_es.msearch.assert_called_once()
+
+    # Queries which did not fetch every hit reset the window
+    hits['hits']['total'] = 100
+    ea.run_query(rule, START + datetime.timedelta(minutes=30), START + datetime.timedelta(minutes=40))
+    assert rule['top_count_window'].covered_start is None
+
+
 def test_exponential_realert(ea):
     ea.rules[0]['exponential_realert'] = datetime.timedelta(days=1)  # 1 day ~ 10 * 2**13 seconds
     ea.rules[0]['realert'] = datetime.timedelta(seconds=10)
@@ -1301,6 +1535,59 @@ def test_uncaught_exceptions(ea):
     assert mock_email.call_args_list[0][1] == {'exception': e, 'rule': ea.disabled_rules[0]}
 
 
+def test_background_warmup(ea):
+    rule = ea.rules[0]
+    rule['warmup_status'] = 'warming_up'
+    assert ea.get_warming_up_rules() == [rule['name']]
+
+    # Rules still warming up are skipped
+    with mock.patch.object(ea, 'run_rule') as mock_run:
+        ea.handle_rule_execution(rule)
+    assert not mock_run.called
+
+    # Successful warmup marks the rule as ready
+    ea.run_rule_warmup(rule)
+    assert rule['type'].warmup.called
+    assert rule['warmup_status'] == 'ready'
+    assert ea.get_warming_up_rules() == []
+
+
+def test_background_warmup_failure(ea):
+    rule = ea.rules[0]
+    rule['type'].warmup.side_effect = EAException('Error searching for existing terms')
+    ea.scheduler = mock.Mock()
+    with mock.patch.object(ea, 'writeback'):
+        ea.run_rule_warmup(rule)
+    assert rule['warmup_status'] == 'failed'
+    assert len(ea.rules) == 0
+    assert ea.disabled_rules == [rule]
+    ea.scheduler.pause_job.assert_called_with(job_id=rule['name'])
+
+
+def test_background_warmup_failure_during_reload(ea):
+    rule = ea.rules[0]
+    rule['type'].warmup.side_effect = EAException('Error searching for existing terms')
+    ea.scheduler = mock.Mock()
+    with mock.patch.object(ea, 'writeback'):
+        # The rule is only disabled once a reload holding the rules has finished
+        with ea.rules_lock:
+            thread = threading.Thread(target=ea.run_rule_warmup, args=(rule,))
+            thread.start()
+            thread.join(0.1)
+            assert thread.is_alive()
+            assert ea.rules == [rule]
+        thread.join()
+        assert ea.disabled_rules == [rule]
+
+        # A failed warmup does not disable the rule which replaced it
+        reloaded_rule = copy.copy(rule)
+        ea.rules = [reloaded_rule]
+        ea.disabled_rules = []
+        ea.run_rule_warmup(rule)
+    assert ea.rules == [reloaded_rule]
+    assert ea.disabled_rules == []
+
+
 def test_get_top_counts_handles_no_hits_returned(ea):
     with mock.patch.object(ea, 'get_hits_terms') as mock_hits:
         mock_hits.return_value = None
@@ -1357,6 +1644,15 @@ def test_query_with_whitelist_filter_es_five(ea_sixsix):
            new_rule['filter'][-1]['query_string']['query']
 
 
+def test_query_with_empty_whitelist(ea_sixsix):
+    ea_sixsix.rules[0]['filter'] = [{'query_string': {'query': 'baz'}}]
+    ea_sixsix.rules[0]['compare_key'] = "username"
+    ea_sixsix.rules[0]['whitelist'] = set()
+    new_rule = copy.copy(ea_sixsix.rules[0])
+    ea_sixsix.init_rule(new_rule, True)
+    assert new_rule['filter'] == [{'query_string': {'query': 'baz'}}]
+
+
 def test_query_with_blacklist_filter_es(ea):
     ea.rules[0]['_source_enabled'] = False
     ea.rules[0]['filter'] = [{'query_string': {'query': 'baz'}}]
@@ -1378,3 +1674,391 @@ def test_query_with_blacklist_filter_es_five(ea_sixsix):
     ea_sixsix.init_rule(new_rule, True)
     assert 'username:"xudan1" OR username:"xudan12" OR username:"aa1"' in new_rule['filter'][-1]['query_string'][
         'query']
+
+
+def test_query_with_blacklist_terms_filter(ea_sixsix):
+    ea_sixsix.rules[0]['filter'] = [{'query_string': {'query': 'baz'}}]
+    ea_sixsix.rules[0]['compare_key'] = "username"
+    ea_sixsix.rules[0]['blacklist'] = ['xudan1', '/xu.*/', 'aa1']
+    ea_sixsix.rules[0]['filter_by_list_type'] = 'terms'
+    new_rule = copy.copy(ea_sixsix.rules[0])
+    ea_sixsix.init_rule(new_rule, True)
+    assert new_rule['filter'][-1] == {'bool': {'should': [{'terms': {'username.keyword': ['aa1', 'xudan1']}},
+                                                          {'query_string': {'query': 'username:/xu.*/'}}]}}
+
+    # Without regular expressions, only the terms filter is added
+    ea_sixsix.rules[0]['blacklist'] = ['xudan1', 'aa1']
+    ea_sixsix.rules[0]['filter'] = []
+    ea_sixsix.rules[0]['filter_by_list_raw'] = False
+    new_rule = copy.copy(ea_sixsix.rules[0])
+    ea_sixsix.init_rule(new_rule, True)
+    assert new_rule['filter'] == [{'terms': {'username': ['aa1', 'xudan1']}}]
+
+    # Long lists are split into terms filters of at most filter_by_list_max_terms entries
+    ea_sixsix.rules[0]['blacklist'] = ['a', 'b', 'c', 'd', 'e']
+    ea_sixsix.rules[0]['filter'] = []
+    ea_sixsix.rules[0]['filter_by_list_max_terms'] = 2
+    new_rule = copy.copy(ea_sixsix.rules[0])
+    ea_sixsix.init_rule(new_rule, True)
+    assert new_rule['filter'] == [{'bool': {'should': [{'terms': {'username': ['a', 'b']}}, {'terms': {'username': ['c', 'd']}},
+                                                       {'terms': {'username': ['e']}}]}}]
+
+
+def test_query_with_whitelist_terms_lookup(ea_sixsix):
+    ea_sixsix.rules[0]['filter'] = []
+    ea_sixsix.rules[0]['compare_key'] = "username"
+    ea_sixsix.rules[0]['whitelist'] = ['xudan1', 'aa1']
+    ea_sixsix.rules[0]['filter_by_list_type'] = 'terms_lookup'
+    new_rule = copy.copy(ea_sixsix.rules[0])
+    with mock.patch('elastalert.elastalert.elasticsearch_client') as mock_es:
+        mock_es.return_value.is_atleastsixtwo.return_value = True
+        mock_es.return_value.is_atleastseven.return_value = True
+        ea_sixsix.init_rule(new_rule, True)
+    mock_es.return_value.index.assert_called_with(index='wb_lists', id='anytest_whitelist', body=mock.ANY)
+    assert mock_es.return_value.index.call_args[1]['body']['terms'] == ['aa1', 'xudan1']
+    lookup = {'index': 'wb_lists', 'id': 'anytest_whitelist', 'path': 'terms'}
+    assert new_rule['filter'] == [{'bool': {'must_not': [{'terms': {'username.keyword': lookup}}]}}]
+
+    # If the list cannot be written, it is used inline
+    new_rule = copy.copy(ea_sixsix.rules[0])
+    new_rule['filter'] = []
+    with mock.patch('elastalert.elastalert.elasticsearch_client') as mock_es:
+        mock_es.return_value.index.side_effect = ElasticsearchException
+        with mock.patch.object(ea_sixsix, 'handle_error') as mock_error:
+            ea_sixsix.init_rule(new_rule, True)
+    assert mock_error.called
+    assert new_rule['filter'] == [{'bool': {'must_not': [{'terms': {'username.keyword': ['aa1', 'xudan1']}}]}}]
+
+    # Long lists are written to one field of the document per terms filter
+    new_rule = copy.copy(ea_sixsix.rules[0])
+    new_rule['filter'] = []
+    new_rule['whitelist'] = ['a', 'b', 'c']
+    new_rule['filter_by_list_max_terms'] = 2
+    with mock.patch('elastalert.elastalert.elasticsearch_client') as mock_es:
+        mock_es.return_value.is_atleastseven.return_value = True
+        ea_sixsix.init_rule(new_rule, True)
+    body = mock_es.return_value.index.call_args[1]['body']
+    assert (body['terms'], body['terms_1']) == (['a', 'b'], ['c'])
+    assert new_rule['filter'] == [{'bool': {'must_not': [{'terms': {'username.keyword': dict(lookup, path='terms')}},
+                                                         {'terms': {'username.keyword': dict(lookup, path='terms_1')}}]}}]
+
+
+def test_send_alert_dispatched(ea):
+    ea.alert_dispatcher = mock.Mock()
+    match = {'@timestamp': '2014-11-17T00:00:00', 'name': 'bob'}
+    ea.send_alert([match], ea.rules[0])
+    assert ea.alert_dispatcher.dispatch.call_count == 1
+    assert not ea.rules[0]['alert'][0].alert.called
+    assert not ea.writeback_es.index.called
+    # Alerts are only counted once they have been sent
+    assert ea.thread_data.alerts_sent == 0
+
+    # Alerts are written back once the dispatcher reports the outcome
+    alerters, matches, pipeline, on_complete = ea.alert_dispatcher.dispatch.call_args[0]
+    assert alerters == ea.rules[0]['alert']
+    on_complete([(alerters[0], EAException('failed'))])
+    body = ea.writeback_es.index.call_args[1]['body']
+    assert body['alert_sent'] is False
+    assert body['alert_exception'] == 'failed'
+    assert ea.thread_data.alerts_sent == 0
+
+    # Alerts sent by the dispatcher are counted by the next run of the rule
+    on_complete([(alerters[0], None)])
+    assert ea.dispatched_alerts_sent == {'anytest': 1}
+    ea.thread_data.alerts_sent = 0
+    with mock.patch.object(ea, 'run_query'):
+        ea.run_rule(ea.rules[0], END, START)
+    assert ea.writeback_es.index.call_args[1]['body']['alerts_sent'] == 1
+    assert ea.dispatched_alerts_sent == {}
+
+
+def test_stop_closes_alerters(ea):
+    ea.writeback_store = mock.Mock()
+    disabled_rule = dict(ea.rules[0], name='disabled', alert=[mock.Mock()])
+    ea.disabled_rules = [disabled_rule]
+    ea.rules[0]['alert'][0].close.side_effect = Exception('failed')
+    ea.stop()
+    # Every alerter sends what it still holds, even if another one fails to
+    assert ea.rules[0]['alert'][0].close.called
+    assert disabled_rule['alert'][0].close.called
+    assert ea.writeback_store.close.called
+
+
+def test_send_alert_unexpected_error(ea):
+    # Without the dispatcher, unexpected errors from an alerter are raised to be handled as errors of the rule
+    ea.rules[0]['alert'][0].alert.side_effect = ValueError('bad')
+    with pytest.raises(ValueError):
+        ea.send_alert([{'@timestamp': '2014-11-17T00:00:00', 'name': 'bob'}], ea.rules[0])
+    assert not ea.writeback_es.index.called
+    assert ea.thread_data.alerts_sent == 0
+
+
+def test_alert_outbox(ea, tmpdir):
+    ea.alert_outbox = AlertOutbox(str(tmpdir.join('outbox.log')), ea.alert_time_limit, retry_backoff=0)
+    ea.pending_alerts_scanned = True
+    alerter = ea.rules[0]['alert'][0]
+    alerter.alert.side_effect = EAException('failed')
+    match = {'@timestamp': '2014-11-17T00:00:00', 'name': 'bob'}
+    ea.send_alert([match], ea.rules[0])
+    # The failed alert is kept in the outbox instead of being written back as pending
+    assert not [call for call in ea.writeback_es.index.call_args_list if 'alert_sent' in call[1]['body']]
+    assert len(ea.alert_outbox.entries) == 1
+
+    alerter.alert.side_effect = None
+    ea.send_pending_alerts()
+    assert alerter.alert.call_args_list[-1][0][0] == [match]
+    assert not ea.alert_outbox.entries
+    assert ea.writeback_es.index.call_args[1]['body']['alert_sent'] is True
+    # Pending alerts are only searched for when aggregation is used
+    assert not ea.writeback_es.search.called
+
+
+def test_alert_outbox_retry_scheduled(ea, tmpdir):
+    """ Tests that a failed alert in the outbox is retried after its backoff, not at the next sweep """
+    ea.alert_outbox = AlertOutbox(str(tmpdir.join('outbox.log')), ea.alert_time_limit, retry_backoff=30)
+    ea.running = True
+    ea.scheduler.add_job.reset_mock()
+    ea.rules[0]['alert'][0].alert.side_effect = EAException('failed')
+    now = ts_to_dt('2014-11-17T00:00:00Z')
+    with mock.patch('elastalert.outbox.time.time', return_value=dt_to_unix(now)):
+        ea.send_alert([{'@timestamp': '2014-11-17T00:00:00', 'name': 'bob'}], ea.rules[0])
+    assert ea.aggregation_deadlines == [now + datetime.timedelta(seconds=30)]
+    assert ea.scheduler.add_job.call_args[1]['id'] == '_internal_flush_aggregations'
+
+
+def test_alert_outbox_expired(ea, tmpdir):
+    """ Tests that an alert which the outbox gives up on is written back as unsent, with its error """
+    ea.alert_outbox = AlertOutbox(str(tmpdir.join('outbox.log')), ea.alert_time_limit, retry_backoff=0,
+                                  on_expired=ea.write_expired_alert)
+    ea.rules[0]['alert'][0].alert.side_effect = EAException('failed')
+    matches = [{'@timestamp': '2014-11-17T00:00:00', 'name': 'bob'}, {'@timestamp': '2014-11-17T00:00:01', 'name': 'alice'}]
+    ea.send_alert(matches, ea.rules[0])
+    assert not [call for call in ea.writeback_es.index.call_args_list if 'alert_sent' in call[1]['body']]
+
+    ea.writeback_es.index.reset_mock()
+    ea.writeback_es.index.return_value = {'_id': 'ABCD'}
+    with mock.patch('elastalert.outbox.ts_now', return_value=ts_now() + ea.alert_time_limit * 2):
+        assert ea.alert_outbox.due() == []
+    assert not ea.alert_outbox.entries
+    bodies = [call[1]['body'] for call in ea.writeback_es.index.call_args_list]
+    assert [body['match_body'] for body in bodies] == matches
+    assert all(body['alert_sent'] is False and body['alert_exception'] == 'failed' for body in bodies)
+    assert 'aggregate_id' not in bodies[0]
+    assert bodies[1]['aggregate_id'] == 'ABCD'
+
+    # The alert is still recorded if its rule was removed
+    ea.writeback_es.index.reset_mock()
+    ea.write_expired_alert({'rule_name': 'removed', 'alert_time': '2014-11-17T00:00:00Z', 'matches': matches[:1],
+                            'error': 'failed'})
+    body = ea.writeback_es.index.call_args[1]['body']
+    assert body['rule_name'] == 'removed'
+    assert body['alert_sent'] is False
+    assert body['alert_exception'] == 'failed'
+
+
+def test_agg_summary_counted_incrementally(ea):
+    rule = ea.rules[0]
+    rule['aggregation'] = datetime.timedelta(minutes=10)
+    rule['summary_table_fields'] = ['username']
+    matches = [{'@timestamp': '2014-09-26T12:34:45', 'username': name} for name in ['bob', 'bob', 'alice']]
+    ids = ['ABCD', 'BCDE', 'CDEF']
+    ea.writeback_es.index.side_effect = [{'_id': _id, 'created': True} for _id in ids]
+    for match in matches:
+        ea.add_aggregated_alert(match, rule)
+    summary = rule['aggregation_summaries']['ABCD']
+    assert summary.counts == {('bob',): 2, ('alice',): 1}
+    bodies = [call[1]['body'] for call in ea.writeback_es.index.call_args_list]
+    bodies[0]['alert_time'] = dt_to_ts(ts_now() - datetime.timedelta(minutes=1))
+
+    def send(aggregated_ids):
+        ea.writeback_es.deprecated_search.side_effect = [
+            {'hits': {'hits': [{'_id': 'ABCD', '_index': 'wb', '_source': dict(bodies[0])}]}},
+            {'hits': {'hits': [{'_id': _id, '_index': 'wb', '_source': body}
+                               for _id, body in zip(ids[1:], bodies[1:]) if _id in aggregated_ids]}}]
+        with mock.patch.object(ea, 'alert') as mock_alert, \
+                mock.patch('elastalert.elastalert.elasticsearch_client'):
+            ea.send_pending_alerts()
+        return mock_alert
+
+    # The summary is sent with the aggregated alert and dropped
+    mock_alert = send(ids)
+    assert mock_alert.call_args[1]['aggregation_summary'] is summary
+    assert len(mock_alert.call_args[0][0]) == 3
+    assert not rule['aggregation_summaries']
+
+    # If not as many matches were aggregated as were counted, the summary is counted again when sent
+    rule['aggregation_summaries']['ABCD'] = summary
+    mock_alert = send(['BCDE'])
+    assert mock_alert.call_args[1]['aggregation_summary'] is None
+    assert not rule['aggregation_summaries']
+
+
+def test_agg_summary_dropped(ea):
+    rule = ea.rules[0]
+    rule['aggregation'] = datetime.timedelta(minutes=10)
+    rule['summary_table_fields'] = ['username']
+    ea.add_aggregated_alert({'@timestamp': '2014-09-26T12:34:45', 'username': 'bob'}, rule)
+    assert list(rule['aggregation_summaries']) == ['ABCD']
+
+    # Summaries are kept when the rule is reloaded
+    new_rule = ea.init_rule(copy.copy(rule), False)
+    assert new_rule['aggregation_summaries'] is rule['aggregation_summaries']
+
+    # The summaries of aggregations which were never sent are dropped once they are too old to be sent
+    with mock.patch.object(ea, 'find_recent_pending_alerts', return_value=[]):
+        ea.send_pending_alerts()
+        assert list(rule['aggregation_summaries']) == ['ABCD']
+        with mock.patch('elastalert.elastalert.ts_now', return_value=ts_now() + ea.alert_time_limit + datetime.timedelta(hours=1)):
+            ea.send_pending_alerts()
+    assert not rule['aggregation_summaries']
+
+    # Enhancements run when the alert is sent may change the summary table, so it is counted again
+    enhancement = mock.Mock()
+    rule['match_enhancements'] = [enhancement]
+    with mock.patch.object(ea, 'deliver_alert') as mock_deliver:
+        ea.send_alert([{'@timestamp': '2014-09-26T12:34:45', 'username': 'bob'}], rule, aggregation_summary=mock.Mock())
+    assert mock_deliver.call_args[0][4] is None
+
+
+def test_send_pending_alerts_bulk_deletes(ea):
+    rule = ea.rules[0]
+    rule['aggregation'] = datetime.timedelta(minutes=10)
+    alert_time = dt_to_ts(ts_now() - datetime.timedelta(minutes=1))
+    pending = {'rule_name': rule['name'], 'alert_time': alert_time, 'match_body': {'@timestamp': START_TIMESTAMP}}
+    aggregated = {'rule_name': rule['name'], 'alert_time': alert_time, 'aggregate_id': 'ABCD',
+                  'match_body': {'@timestamp': END_TIMESTAMP}}
+    ea.writeback_es.deprecated_search.side_effect = [
+        {'hits': {'hits': [{'_id': 'ABCD', '_index': 'wb', '_source': pending}]}},
+        {'hits': {'hits': [{'_id': 'agg%d' % (i), '_index': 'wb', '_source': dict(aggregated)} for i in range(1500)]}}]
+    ea.writeback_es.bulk.side_effect = [
+        {'errors': False, 'items': []},
+        {'errors': True, 'items': [{'delete': {'_id': 'agg1000', 'status': 404}},
+                                   {'delete': {'_id': 'agg1001', 'status': 500, 'error': 'oops'}}]},
+        {'errors': False, 'items': []}]
+    with mock.patch.object(ea, 'alert') as mock_alert, mock.patch.object(ea, 'handle_error') as mock_error:
+        ea.send_pending_alerts()
+    assert len(mock_alert.call_args[0][0]) == 1501
+
+    # The aggregated matches are deleted in chunks, then the sent alert
+    bodies = [call[1]['body'] for call in ea.writeback_es.bulk.call_args_list]
+    assert [len(body) for body in bodies] == [1000, 500, 1]
+    assert bodies[0][0] == {'delete': {'_index': ea.writeback_index, '_id': 'agg0', '_type': 'elastalert'}}
+    assert bodies[2] == [{'delete': {'_index': ea.writeback_index, '_id': 'ABCD', '_type': 'elastalert'}}]
+    assert not ea.writeback_es.delete.called
+    # Documents which were already deleted are ignored
+    assert mock_error.call_count == 1
+    assert mock_error.call_args[0][1] == {'ids': ['agg1001']}
+
+
+def test_delete_writeback_docs_six(ea_sixsix):
+    # Bulk actions need a type before Elasticsearch 7, which is _doc for the writeback indices of 6.2+
+    ea_sixsix.writeback_es.is_atleastsixtwo.return_value = True
+    ea_sixsix.delete_writeback_docs(['ABCD'])
+    body = ea_sixsix.writeback_es.bulk.call_args[1]['body']
+    assert body == [{'delete': {'_index': ea_sixsix.writeback_index, '_id': 'ABCD', '_type': '_doc'}}]
+
+    ea_sixsix.writeback_es.is_atleastseven.return_value = True
+    ea_sixsix.delete_writeback_docs(['ABCD'])
+    body = ea_sixsix.writeback_es.bulk.call_args[1]['body']
+    assert body == [{'delete': {'_index': ea_sixsix.writeback_index, '_id': 'ABCD'}}]
+
+
+def test_send_pending_alerts_paginated(ea_sixsix):
+    ea = ea_sixsix
+    ea.writeback_page_size = 2
+    ea.max_aggregation = 3
+    rule = ea.rules[0]
+    rule['aggregation'] = datetime.timedelta(minutes=10)
+    alert_time = dt_to_ts(ts_now() - datetime.timedelta(minutes=1))
+
+    def pending(i):
+        return {'_id': 'alert%d' % (i), 'sort': [alert_time, 'alert%d' % (i)],
+                '_source': {'rule_name': rule['name'], 'alert_time': alert_time, 'match_body': {'@timestamp': i}}}
+
+    def aggregated(i):
+        return {'_id': 'agg%d' % (i), 'sort': [i, 'agg%d' % (i)], '_source': {'match_body': {'@timestamp': i}}}
+
+    # Pending alerts and the matches of their aggregates are fetched and deleted one page at a time
+    ea.writeback_es.deprecated_search.side_effect = [
+        {'hits': {'hits': [pending(0), pending(1)]}},
+        {'hits': {'hits': [aggregated(0), aggregated(1)]}},
+        {'hits': {'hits': [aggregated(2), aggregated(3)]}},
+        {'hits': {'hits': [aggregated(4)]}},
+        {'hits': {'hits': []}},
+        {'hits': {'hits': [pending(2)]}},
+        {'hits': {'hits': []}}]
+    with mock.patch.object(ea, 'alert') as mock_alert:
+        ea.send_pending_alerts()
+
+    queries = [call[1]['body'] for call in ea.writeback_es.deprecated_search.call_args_list]
+    assert queries[0]['sort'] == [{'alert_time': {'order': 'asc'}}, {'_id': {'order': 'asc'}}]
+    assert 'search_after' not in queries[0]
+    assert queries[2]['search_after'] == [1, 'agg1']
+    assert queries[5]['search_after'] == [alert_time, 'alert1']
+
+    # Matches over max_aggregation are deleted, but not sent
+    assert [len(call[0][0]) for call in mock_alert.call_args_list] == [4, 1, 1]
+    deleted = [[action['delete']['_id'] for action in call[1]['body']] for call in ea.writeback_es.bulk.call_args_list]
+    assert deleted == [['agg0', 'agg1'], ['agg2', 'agg3'], ['agg4'], ['alert0', 'alert1'], ['alert2']]
+
+
+def test_writeback_store(ea, tmpdir):
+    ea.writeback_store = SQLiteWriteback(str(tmpdir.join('writeback.db')))
+    rule = ea.rules[0]
+    rule['aggregation'] = datetime.timedelta(minutes=10)
+    for ts in ['2014-09-26T12:34:45', '2014-09-26T12:40:45']:
+        ea.add_aggregated_alert({'@timestamp': ts}, rule)
+    assert not ea.writeback_es.index.called
+
+    # After a restart, the aggregation is found in the store
+    agg_id = rule['current_aggregate_id'][None]
+    rule['current_aggregate_id'] = {}
+    ea.add_aggregated_alert({'@timestamp': '2014-09-26T12:44:45'}, rule)
+    assert rule['current_aggregate_id'] == {None: agg_id}
+
+    with mock.patch('elastalert.elastalert.ts_now', return_value=ts_now() + datetime.timedelta(minutes=11)), \
+            mock.patch.object(ea, 'alert') as mock_alert:
+        ea.send_pending_alerts()
+    timestamps = [match['@timestamp'] for match in mock_alert.call_args[0][0]]
+    assert timestamps == ['2014-09-26T12:34:45', '2014-09-26T12:40:45', '2014-09-26T12:44:45']
+    assert list(ea.writeback_store.find_pending_alerts(ts_now() - datetime.timedelta(days=1), ts_now(), 10)) == []
+
+    ea.set_realert('rule._silence', ts_now() + datetime.timedelta(hours=1), 0)
+    ea.silence_cache = {}
+    assert ea.is_silenced('rule._silence')
+    assert not ea.is_silenced('other._silence')
+
+    ea.writeback('elastalert_status', {'rule_name': rule['name'], 'endtime': ts_now()})
+    assert ea.get_starttime(rule) is not None
+    assert not ea.writeback_es.deprecated_search.called
+
+    # Stopping closes the store
+    ea.stop()
+    assert ea.writeback('elastalert_status', {'rule_name': rule['name'], 'endtime': ts_now()}) is None
+
+
+def test_pending_aggregates_preloaded(ea):
+    rule = ea.rules[0]
+    rule['aggregation'] = datetime.timedelta(minutes=10)
+    rule['aggregation_key'] = 'key'
+    alert_time = dt_to_ts(ts_now() + datetime.timedelta(minutes=5))
+    ea.writeback_es.deprecated_search.return_value = {'hits': {'hits': [
+        {'_id': 'old', '_source': {'rule_name': rule['name'], 'alert_time': alert_time, 'aggregation_key': 'a'}},
+        {'_id': 'other', '_source': {'rule_name': 'other rule', 'alert_time': alert_time, 'aggregation_key': 'b'}}]}}
+
+    # The pending aggregations of every rule are loaded once, then only memory is used
+    for key in ['a', 'b', 'c', 'a']:
+        ea.add_aggregated_alert({'@timestamp': '2014-09-26T12:34:45', 'key': key}, rule)
+    assert ea.writeback_es.deprecated_search.call_count == 1
+    bodies = [call[1]['body'] for call in ea.writeback_es.index.call_args_list]
+    assert bodies[0]['aggregate_id'] == 'old'
+    assert 'aggregate_id' not in bodies[1]
+    assert 'aggregate_id' not in bodies[2]
+    assert bodies[3]['aggregate_id'] == 'old'
+    assert ea.pending_aggregates[rule['name']]['b']['_id'] == 'ABCD'
+    assert ea.find_pending_aggregate_alert(rule, 'c')['_id'] == 'ABCD'
+
+    # Aggregations which were sent are removed
+    ea.remove_pending_aggregate(rule, 'old')
+    assert ea.find_pending_aggregate_alert(rule, 'a') is None
+    assert ea.writeback_es.deprecated_search.call_count == 1
@@ -64,9 +64,11 @@ class mock_es_client(object):
         self.return_hits = []
         self.search = mock.Mock()
         self.deprecated_search = mock.Mock()
+        self.msearch = mock.Mock()
         self.create = mock.Mock()
         self.index = mock.Mock()
         self.delete = mock.Mock()
+        self.bulk = mock.Mock(return_value={'errors': False, 'items': []})
         self.info = mock.Mock(return_value={'status': 200, 'name': 'foo', 'version': {'number': '2.0'}})
         self.ping = mock.Mock(return_value=True)
         self.indices = mock_es_indices_client()
@@ -76,6 +78,8 @@ class mock_es_client(object):
         self.is_atleastsixtwo = mock.Mock(return_value=False)
         self.is_atleastsixsix = mock.Mock(return_value=False)
         self.is_atleastseven = mock.Mock(return_value=False)
+        self.is_atleastseventen = mock.Mock(return_value=False)
+        self.is_atleastseventwelve = mock.Mock(return_value=False)
         self.resolve_writeback_index = mock.Mock(return_value=writeback_index)
 
 
@@ -86,9 +90,11 @@ class mock_es_sixsix_client(object):
         self.return_hits = []
         self.search = mock.Mock()
         self.deprecated_search = mock.Mock()
+        self.msearch = mock.Mock()
         self.create = mock.Mock()
         self.index = mock.Mock()
         self.delete = mock.Mock()
+        self.bulk = mock.Mock(return_value={'errors': False, 'items': []})
         self.info = mock.Mock(return_value={'status': 200, 'name': 'foo', 'version': {'number': '6.6.0'}})
         self.ping = mock.Mock(return_value=True)
         self.indices = mock_es_indices_client()
@@ -98,6 +104,8 @@ class mock_es_sixsix_client(object):
         self.is_atleastsixtwo = mock.Mock(return_value=False)
         self.is_atleastsixsix = mock.Mock(return_value=True)
         self.is_atleastseven = mock.Mock(return_value=False)
+        self.is_atleastseventen = mock.Mock(return_value=False)
+        self.is_atleastseventwelve = mock.Mock(return_value=False)
 
         def writeback_index_side_effect(index, doc_type):
             if doc_type == 'silence':
@@ -130,11 +138,13 @@ class mock_ruletype(object):
         self.get_match_data = lambda x: x
         self.get_match_str = lambda x: "some stuff happened"
         self.garbage_collect = mock.Mock()
+        self.warmup = mock.Mock()
 
 
 class mock_alert(object):
     def __init__(self):
         self.alert = mock.Mock()
+        self.close = mock.Mock()
 
     def get_info(self):
         return {'type': 'mock'}
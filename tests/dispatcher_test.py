@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+import threading
+
+import mock
+
+from elastalert.alerts import Alerter
+from elastalert.dispatcher import AlertDispatcher
+from elastalert.util import EAException
+
+
+class RecordingAlerter(Alerter):
+    def __init__(self, rule, log, fail_times=0, pipeline_key=None):
+        super(RecordingAlerter, self).__init__(rule)
+        self.log = log
+        self.fail_times = fail_times
+        self.pipeline_key = pipeline_key
+        self.seen_pipeline = None
+
+    def alert(self, matches):
+        if self.fail_times:
+            self.fail_times -= 1
+            raise EAException('failed')
+        if self.pipeline_key:
+            self.pipeline[self.pipeline_key] = True
+        self.seen_pipeline = dict(self.pipeline)
+        self.log.append(self)
+
+    def get_info(self):
+        return {'type': 'recording'}
+
+
+class PipelineAlerter(RecordingAlerter):
+    writes_pipeline = True
+
+
+def dispatch(dispatcher, alerters):
+    done = threading.Event()
+    outcome = []
+
+    def on_complete(results):
+        outcome.extend(results)
+        done.set()
+
+    dispatcher.dispatch(alerters, [{'@timestamp': 'now'}], {'alert_time': 'alert_time'}, on_complete)
+    assert done.wait(5)
+    return outcome
+
+
+def test_dispatch_fan_out_and_pipeline_order():
+    log = []
+    dispatcher = AlertDispatcher(workers=4, retry_backoff=0)
+    others = [RecordingAlerter({}, log) for _ in range(3)]
+    writer = PipelineAlerter({}, log, pipeline_key='jira_ticket')
+    outcome = dispatch(dispatcher, others + [writer])
+    dispatcher.shutdown()
+
+    assert len(outcome) == 4
+    assert all(error is None for _, error in outcome)
+    # The pipeline writer is sent first and the others see what it wrote
+    assert log[0] is writer
+    for alerter in others:
+        assert alerter.seen_pipeline == {'alert_time': 'alert_time', 'jira_ticket': True}
+
+
+def test_dispatch_retries():
+    log = []
+    dispatcher = AlertDispatcher(workers=2, retries=2, retry_backoff=0)
+    flaky = RecordingAlerter({}, log, fail_times=2)
+    broken = RecordingAlerter({}, log, fail_times=3)
+    with mock.patch('elastalert.dispatcher.time.sleep') as mock_sleep:
+        outcome = dict(dispatch(dispatcher, [flaky, broken]))
+    dispatcher.shutdown()
+
+    assert outcome[flaky] is None
+    assert isinstance(outcome[broken], EAException)
+    assert log == [flaky]
+    assert mock_sleep.call_count == 4
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+import datetime
+
+import mock
+
+from elastalert.outbox import AlertOutbox
+from elastalert.util import ts_now
+from elastalert.util import unix_to_dt
+
+
+def test_outbox_replay(tmpdir):
+    path = str(tmpdir.join('outbox.log'))
+    outbox = AlertOutbox(path, datetime.timedelta(days=2), retry_backoff=0)
+    sent = outbox.add('rule', [{'field': 'sent'}], ts_now())
+    failed = outbox.add('rule', [{'field': 'failed'}], ts_now())
+    crashed = outbox.add('rule', [{'field': 'crashed'}], ts_now())
+    outbox.complete(sent)
+    assert outbox.retry(failed, 'error')
+    # Alerts which are being sent are not due
+    assert [entry['id'] for entry in outbox.due()] == [failed]
+
+    # A partial record written when stopping is ignored
+    with open(path, 'a') as log:
+        log.write('{"op": "ad')
+    outbox = AlertOutbox(path, datetime.timedelta(days=2), retry_backoff=0)
+    due = outbox.due()
+    assert [entry['id'] for entry in due] == [failed, crashed]
+    assert due[0]['attempts'] == 1
+    assert due[0]['error'] == 'error'
+    assert due[1]['matches'] == [{'field': 'crashed'}]
+    # The log was rewritten with the pending alerts only
+    with open(path) as log:
+        assert len(log.readlines()) == 2
+
+
+def test_outbox_backoff_and_expiry(tmpdir):
+    outbox = AlertOutbox(str(tmpdir.join('outbox.log')), datetime.timedelta(hours=1), retry_backoff=10, max_backoff=30)
+    entry_id = outbox.add('rule', [{}], ts_now())
+    with mock.patch('elastalert.outbox.time.time', return_value=1000):
+        for backoff in (10, 20, 30, 30):
+            assert outbox.retry(entry_id, 'error')
+            assert outbox.entries[entry_id]['next_try'] == 1000 + backoff
+    assert outbox.next_try_times() == [unix_to_dt(1030)]
+
+    on_expired = mock.Mock()
+    outbox.on_expired = on_expired
+    old_id = outbox.add('rule', [{}], ts_now() - datetime.timedelta(hours=2))
+    assert not outbox.retry(old_id, 'error')
+    assert old_id not in outbox.entries
+    assert on_expired.call_args[0][0]['id'] == old_id
+    assert on_expired.call_args[0][0]['error'] == 'error'
+
+    # Alerts which expire while waiting to be retried are dropped from due
+    with mock.patch('elastalert.outbox.ts_now', return_value=ts_now() + datetime.timedelta(hours=2)):
+        assert outbox.due() == []
+    assert not outbox.entries
+    assert on_expired.call_args[0][0]['id'] == entry_id
+
+
+def test_outbox_compaction(tmpdir):
+    path = str(tmpdir.join('outbox.log'))
+    outbox = AlertOutbox(path, datetime.timedelta(days=2))
+    outbox.compact_threshold = 10
+    pending = outbox.add('rule', [{}], ts_now())
+    for _ in range(10):
+        outbox.complete(outbox.add('rule', [{}], ts_now()))
+    assert outbox.records < 10
+    assert list(AlertOutbox(path, datetime.timedelta(days=2)).entries) == [pending]
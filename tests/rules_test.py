@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import copy
 import datetime
+import os
 
 import mock
 import pytest
@@ -13,9 +14,12 @@ from elastalert.ruletypes import ChangeRule
 from elastalert.ruletypes import EventWindow
 from elastalert.ruletypes import FlatlineRule
 from elastalert.ruletypes import FrequencyRule
+from elastalert.ruletypes import get_mapped_list
+from elastalert.ruletypes import HyperLogLog
 from elastalert.ruletypes import MetricAggregationRule
 from elastalert.ruletypes import NewTermsRule
 from elastalert.ruletypes import PercentageMatchRule
+from elastalert.ruletypes import SlidingHyperLogLog
 from elastalert.ruletypes import SpikeRule
 from elastalert.ruletypes import WhitelistRule
 from elastalert.util import dt_to_ts
@@ -488,6 +492,95 @@ def test_whitelist():
     assert_matches_have(rule.matches, [('term', 'bad'), ('term', 'really bad')])
 
 
+def test_blacklist_whitelist_regex():
+    events = [{'@timestamp': ts_to_dt('2014-09-26T12:34:56Z'), 'term': 'good'},
+              {'@timestamp': ts_to_dt('2014-09-26T12:34:57Z'), 'term': 'bad'},
+              {'@timestamp': ts_to_dt('2014-09-26T12:34:58Z'), 'term': 'badger'},
+              {'@timestamp': ts_to_dt('2014-09-26T12:34:59Z'), 'term': 'really bad'},
+              {'@timestamp': ts_to_dt('2014-09-26T12:35:00Z'), 'term': 'host42'}]
+    rules = {'blacklist': ['bad', '/really .*/', '/host[0-9]+/'],
+             'compare_key': 'term',
+             'timestamp_field': '@timestamp'}
+    rule = BlacklistRule(rules)
+    rule.add_data(events)
+    # Patterns must match the whole term
+    assert_matches_have(rule.matches, [('term', 'bad'), ('term', 'really bad'), ('term', 'host42')])
+
+    rules = {'whitelist': ['good', '/bad.*/'],
+             'compare_key': 'term',
+             'ignore_null': True,
+             'timestamp_field': '@timestamp'}
+    rule = WhitelistRule(rules)
+    rule.add_data(events)
+    assert_matches_have(rule.matches, [('term', 'really bad'), ('term', 'host42')])
+
+    rules['whitelist'] = ['/bad[/']
+    with pytest.raises(EAException):
+        WhitelistRule(rules)
+
+
+def test_blacklist_mmap_list_files(tmpdir):
+    list_file = tmpdir.join('blacklist.txt')
+    list_file.write('bad\nreally bad\n/host[0-9]+/\n')
+    events = [{'@timestamp': ts_to_dt('2014-09-26T12:34:56Z'), 'term': 'good'},
+              {'@timestamp': ts_to_dt('2014-09-26T12:34:57Z'), 'term': 'bad'},
+              {'@timestamp': ts_to_dt('2014-09-26T12:34:58Z'), 'term': 'worse'},
+              {'@timestamp': ts_to_dt('2014-09-26T12:34:59Z'), 'term': 'really bad'},
+              {'@timestamp': ts_to_dt('2014-09-26T12:35:00Z'), 'term': 'host42'}]
+    rules = {'blacklist': ['worse', '!file %s' % (list_file)],
+             'compare_key': 'term',
+             'timestamp_field': '@timestamp',
+             'mmap_list_files': True,
+             'list_cache_dir': str(tmpdir)}
+    rule = BlacklistRule(copy.deepcopy(rules))
+    rule.add_data(events)
+    assert_matches_have(rule.matches, [('term', 'bad'), ('term', 'worse'), ('term', 'really bad'), ('term', 'host42')])
+    assert rule.rules['blacklist'] == set(['worse'])
+    assert rule.rules['filter_by_list'] is False
+
+    # The mapped list is shared between rules
+    other_rule = BlacklistRule(copy.deepcopy(rules))
+    assert other_rule.list_files[0] is rule.list_files[0]
+    assert len(rule.list_files[0]) == 2
+
+
+def test_whitelist_mmap_list_files(tmpdir):
+    list_file = tmpdir.join('whitelist.txt')
+    list_file.write('good\n/host[0-9]+/\n')
+    events = [{'@timestamp': ts_to_dt('2014-09-26T12:34:56Z'), 'term': 'good'},
+              {'@timestamp': ts_to_dt('2014-09-26T12:34:57Z'), 'term': 'bad'},
+              {'@timestamp': ts_to_dt('2014-09-26T12:34:58Z'), 'term': 'host42'}]
+    rules = {'whitelist': ['!file %s' % (list_file)],
+             'compare_key': 'term',
+             'timestamp_field': '@timestamp',
+             'ignore_null': True,
+             'mmap_list_files': True,
+             'list_cache_dir': str(tmpdir)}
+    rule = WhitelistRule(rules)
+    rule.add_data(events)
+    assert_matches_have(rule.matches, [('term', 'bad')])
+    # The whitelist has no inline entries, so it is not added to the query
+    assert rule.rules['whitelist'] == set()
+    assert rule.rules['filter_by_list'] is False
+
+    # Changes to the file are picked up on the next refresh
+    list_file.write('worst\n')
+    stat = os.stat(str(list_file))
+    os.utime(str(list_file), (stat.st_atime, stat.st_mtime + 10))
+    rule.list_files[0].next_check = 0
+    assert 'worst' in rule.list_files[0]
+    assert 'bad' not in rule.list_files[0]
+    assert rule.list_files[0].regex is None
+
+    # Refreshing an unchanged file maps the existing list without rebuilding it
+    mapped_list = rule.list_files[0]
+    with mock.patch.object(mapped_list, 'build') as mock_build:
+        mapped_list.next_check = 0
+        mapped_list.refresh()
+    assert not mock_build.called
+    assert get_mapped_list(str(list_file), str(tmpdir)) is mapped_list
+
+
 def test_whitelist_dont_ignore_nulls():
     events = [{'@timestamp': ts_to_dt('2014-09-26T12:34:56Z'), 'term': 'good'},
               {'@timestamp': ts_to_dt('2014-09-26T12:34:57Z'), 'term': 'bad'},
@@ -547,6 +640,37 @@ def test_change():
     assert rule.matches == []
 
 
+def test_change_state_is_bounded():
+    rules = {'compound_compare_key': ['term'],
+             'query_key': 'username',
+             'ignore_null': True,
+             'timestamp_field': '@timestamp',
+             'timeframe': datetime.timedelta(minutes=1),
+             'max_query_keys': 2}
+    rule = ChangeRule(rules)
+    # Without max_query_keys, the number of keys is still bounded
+    assert ChangeRule({k: v for k, v in rules.items() if k not in ('timeframe', 'max_query_keys')}).max_query_keys == 100000
+    # State is not shared between rules
+    assert ChangeRule(dict(rules)).occurrences is not rule.occurrences
+
+    start = ts_to_dt('2014-09-26T12:00:00Z')
+    rule.add_data([{'@timestamp': start, 'username': 'alice', 'term': 'good'},
+                   {'@timestamp': start, 'username': 'bob', 'term': 'good'},
+                   {'@timestamp': start, 'username': 'carol', 'term': 'good'}])
+    # alice is the least recently seen key and is dropped beyond max_query_keys
+    assert list(rule.occurrences) == ['bob', 'carol']
+    assert 'alice' not in rule.occurrence_time
+
+    rule.add_data([{'@timestamp': start + datetime.timedelta(seconds=30), 'username': 'bob', 'term': 'bad'}])
+    assert list(rule.occurrences) == ['carol', 'bob']
+    assert_matches_have(rule.matches, [('username', 'bob', 'old_value', ['good'], 'new_value', ['bad'])])
+
+    # carol has not been seen for longer than timeframe
+    rule.add_data([{'@timestamp': start + datetime.timedelta(seconds=70), 'username': 'bob', 'term': 'bad'}])
+    assert list(rule.occurrences) == ['bob']
+    assert list(rule.change_map) == ['bob']
+
+
 def test_new_term():
     rules = {'fields': ['a', 'b'],
              'timestamp_field': '@timestamp',
@@ -641,6 +765,33 @@ def test_new_term_nested_field():
     rule.matches = []
 
 
+def test_new_term_background_warmup():
+    rules = {'fields': ['a', 'b'],
+             'timestamp_field': '@timestamp',
+             'es_host': 'example.com', 'es_port': 10, 'index': 'logstash',
+             'ts_to_dt': ts_to_dt, 'dt_to_ts': dt_to_ts,
+             'background_warmup': True}
+    mock_res = {'aggregations': {'filtered': {'values': {'buckets': [{'key': 'key1', 'doc_count': 1},
+                                                                     {'key': 'key2', 'doc_count': 5}]}}}}
+
+    with mock.patch('elastalert.ruletypes.elasticsearch_client') as mock_es:
+        mock_es.return_value = mock.Mock()
+        mock_es.return_value.search.return_value = mock_res
+        mock_es.return_value.info.return_value = {'version': {'number': '2.x.x'}}
+        rule = NewTermsRule(rules)
+
+        # Construction does not query for existing terms
+        assert mock_es.return_value.search.call_count == 0
+
+        rule.warmup()
+    assert rule.es.search.call_count == 60
+
+    rule.add_data([{'@timestamp': ts_now(), 'a': 'key1', 'b': 'key2'}])
+    assert rule.matches == []
+    rule.add_data([{'@timestamp': ts_now(), 'a': 'key2', 'b': 'key3'}])
+    assert len(rule.matches) == 1
+
+
 def test_new_term_with_terms():
     rules = {'fields': ['a'],
              'timestamp_field': '@timestamp',
@@ -1002,6 +1153,115 @@ def test_cardinality_qk():
     assert rule.matches[1]['foo'] == 'fiz'
 
 
+def test_cardinality_garbage_collect_expired_only():
+    rules = {'max_cardinality': 100,
+             'timeframe': datetime.timedelta(minutes=10),
+             'cardinality_field': 'foo',
+             'timestamp_field': '@timestamp',
+             'query_key': 'user'}
+    rule = CardinalityRule(rules)
+    start = ts_to_dt('2014-09-26T12:00:00Z')
+
+    rule.add_data([{'@timestamp': start, 'user': 'bob', 'foo': 'a'},
+                   {'@timestamp': start, 'user': 'bob', 'foo': 'b'},
+                   {'@timestamp': start, 'user': 'alice', 'foo': 'a'},
+                   {'@timestamp': start + datetime.timedelta(minutes=5), 'user': 'carol', 'foo': 'a'},
+                   {'@timestamp': start + datetime.timedelta(minutes=5), 'user': 'bob', 'foo': 'a'}])
+    assert list(rule.cardinality_cache['bob']) == ['b', 'a']
+
+    # Only bob's 'b' and alice's 'a' have expired
+    rule.garbage_collect(start + datetime.timedelta(minutes=12))
+    assert list(rule.cardinality_cache['bob']) == ['a']
+    assert len(rule.cardinality_cache['alice']) == 0
+    assert len(rule.cardinality_cache['carol']) == 1
+    assert len(rule.expiry_index) == 2
+
+    rule.garbage_collect(start + datetime.timedelta(minutes=20))
+    assert all(len(terms) == 0 for terms in rule.cardinality_cache.values())
+    assert rule.expiry_index == []
+
+    # Terms added after the cache emptied are indexed again
+    rule.add_data([{'@timestamp': start + datetime.timedelta(minutes=21), 'user': 'alice', 'foo': 'c'}])
+    rule.garbage_collect(start + datetime.timedelta(minutes=40))
+    assert len(rule.cardinality_cache['alice']) == 0
+
+
+def test_cardinality_approximate_max():
+    rules = {'max_cardinality': 4,
+             'timeframe': datetime.timedelta(minutes=10),
+             'cardinality_field': 'user',
+             'timestamp_field': '@timestamp',
+             'cardinality_approximate': True}
+    rule = CardinalityRule(rules)
+    now = datetime.datetime.now()
+
+    # Add 4 different usernames
+    users = ['bill', 'coach', 'zoey', 'louis']
+    for user in users:
+        rule.add_data([{'@timestamp': now, 'user': user}])
+        assert len(rule.matches) == 0
+    assert isinstance(rule.cardinality_cache['all'], SlidingHyperLogLog)
+
+    # Add a duplicate, stay at 4 cardinality
+    rule.add_data([{'@timestamp': now, 'user': 'coach'}])
+    rule.garbage_collect(now)
+    assert len(rule.matches) == 0
+
+    # Next unique will trigger
+    rule.add_data([{'@timestamp': now, 'user': 'francis'}])
+    assert len(rule.matches) == 1
+    rule.matches = []
+
+    # 15 minutes later, the old slices are gone and adding more will not trigger an alert
+    for user in ['nick', 'rochelle', 'ellis']:
+        rule.add_data([{'@timestamp': now + datetime.timedelta(minutes=15), 'user': user}])
+        assert len(rule.matches) == 0
+    assert len(rule.cardinality_cache['all']) == 3
+
+
+def test_cardinality_approximate_precision():
+    rules = {'max_cardinality': 4,
+             'timeframe': datetime.timedelta(minutes=10),
+             'cardinality_field': 'user',
+             'cardinality_approximate': True,
+             'cardinality_precision': 20}
+    with pytest.raises(EAException):
+        CardinalityRule(rules)
+
+
+def test_hyperloglog():
+    sketch = HyperLogLog(12)
+    assert sketch.count() == 0
+    for i in range(20000):
+        sketch.add('10.0.%d.%d' % (i // 256, i % 256))
+    # Within 4 standard errors of 1.6%
+    assert abs(sketch.count() - 20000) < 20000 * 0.065
+    assert not sketch.add('10.0.0.0')
+
+    other = HyperLogLog(12)
+    for i in range(10000, 30000):
+        other.add('10.0.%d.%d' % (i // 256, i % 256))
+    sketch.merge(other)
+    assert abs(sketch.count() - 30000) < 30000 * 0.065
+
+
+def test_sliding_hyperloglog():
+    sketch = SlidingHyperLogLog(datetime.timedelta(minutes=10), 12, 5)
+    start = ts_to_dt('2014-09-26T12:00:00Z')
+    for minute in range(10):
+        for i in range(100):
+            sketch.add('user%d_%d' % (minute, i), start + datetime.timedelta(minutes=minute))
+    assert abs(len(sketch) - 1000) < 50
+
+    # Expiring at 12:14 drops the slices holding minutes 0-3
+    sketch.expire(start + datetime.timedelta(minutes=14))
+    assert len(sketch.sketches) == 3
+    assert abs(len(sketch) - 600) < 30
+
+    sketch.expire(start + datetime.timedelta(minutes=30))
+    assert len(sketch) == 0
+
+
 def test_cardinality_nested_cardinality_field():
     rules = {'max_cardinality': 4,
              'timeframe': datetime.timedelta(minutes=10),
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+import datetime
+
+from elastalert.topcounts import SpaceSaving
+from elastalert.topcounts import TopCountWindow
+from elastalert.util import ts_to_dt
+
+
+def test_space_saving():
+    counter = SpaceSaving(3)
+    for value in ['a'] * 10 + ['b'] * 5 + ['c', 'd', 'e'] + ['b'] * 2:
+        counter.add(value)
+    assert len(counter.counts) == 3
+    assert counter.counts['a'] == 10
+    assert counter.counts['b'] == 7
+    # The least frequent values replace each other and overestimate their counts
+    assert sum(counter.counts.values()) == 20
+
+
+def test_top_count_window():
+    start = ts_to_dt('2014-09-26T12:00:30Z')
+    window = TopCountWindow(['user'], ['user.keyword'], 'host', datetime.timedelta(hours=1), 10)
+    hits = [{'@timestamp': start + datetime.timedelta(minutes=i), 'user': 'user%d' % (i % 3), 'host': 'host%d' % (i % 2)}
+            for i in range(30)]
+    window.add_hits(hits, '@timestamp')
+    window.extend(start, start + datetime.timedelta(minutes=30))
+
+    counts = window.get_counts(start + datetime.timedelta(minutes=1), start + datetime.timedelta(minutes=11), 'host0', 5)
+    assert counts == {'top_events_user.keyword': {'user0': 1, 'user1': 2, 'user2': 2}}
+    # The window does not cover the first, partially queried, minute
+    assert window.get_counts(start, start + datetime.timedelta(minutes=10), 'host0', 5) is None
+
+    # Old buckets are dropped
+    window.extend(start + datetime.timedelta(minutes=30), start + datetime.timedelta(minutes=80))
+    assert window.get_counts(start + datetime.timedelta(minutes=10), start + datetime.timedelta(minutes=30), 'host0', 5) is None
+    counts = window.get_counts(start + datetime.timedelta(minutes=20), start + datetime.timedelta(minutes=30), 'host1', 5)
+    assert counts == {'top_events_user.keyword': {'user0': 2, 'user1': 1, 'user2': 2}}
+
+    # Gaps and incomplete queries reset the window
+    window.extend(start + datetime.timedelta(minutes=90), start + datetime.timedelta(minutes=100))
+    assert window.get_counts(start + datetime.timedelta(minutes=20), start + datetime.timedelta(minutes=30), 'host1', 5) is None
+    window.extend(start + datetime.timedelta(minutes=100), start + datetime.timedelta(minutes=110), complete=False)
+    assert window.covered_start is None
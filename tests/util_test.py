@@ -7,6 +7,7 @@ import pytest
 from dateutil.parser import parse as dt
 
 from elastalert.util import add_raw_postfix
+from elastalert.util import compile_es_key
 from elastalert.util import format_index
 from elastalert.util import lookup_es_key
 from elastalert.util import parse_deadline
@@ -124,6 +125,20 @@ def test_looking_up_arrays(ea):
     assert lookup_es_key(record, 'objects[1]foo[0]baz') is None
 
 
+def test_compile_es_key():
+    records = [
+        {'flags': [1, 2, 3], 'objects': [{'foo': 'bar'}, {'foo': [{'bar': 'baz'}]}, {'foo': {'bar': 'baz'}}]},
+        {'Fields': {'ts.value': 12467267, 'null': None}, 'Fields.ts': 'flat'},
+        {},
+    ]
+    terms = ['flags[0]', 'flags[1]', 'objects[0]foo', 'objects[1]foo[0]bar', 'objects[2]foo.bar', 'objects[1]foo[1]bar',
+             'objects[1]foo[0]baz', 'Fields.ts.value', 'Fields.ts', 'Fields.null.foo', 'missing']
+    for term in terms:
+        lookup = compile_es_key(term)
+        for record in records:
+            assert lookup(record) == lookup_es_key(record, term)
+
+
 def test_add_raw_postfix(ea):
     expected = 'foo.raw'
     assert add_raw_postfix('foo', False) == expected
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+import datetime
+
+import mock
+import pytest
+
+from elastalert.util import dt_to_ts
+from elastalert.util import ts_now
+from elastalert.writeback import ElasticsearchWriteback
+from elastalert.writeback import SQLiteWriteback
+from elastalert.writeback import WritebackMirror
+
+
+def test_sqlite_writeback(tmpdir):
+    path = str(tmpdir.join('writeback.db'))
+    store = SQLiteWriteback(path)
+    now = ts_now()
+    store.index('elastalert_status', {'rule_name': 'rule', '@timestamp': dt_to_ts(now - datetime.timedelta(minutes=5)),
+                                      'endtime': 'old'})
+    store.index('elastalert_status', {'rule_name': 'rule', '@timestamp': dt_to_ts(now), 'endtime': 'new'})
+    store.index('silence', {'rule_name': 'rule._silence', 'until': dt_to_ts(now + datetime.timedelta(hours=1)), 'exponent': 2})
+    store.index('silence', {'rule_name': 'rule._silence', 'until': dt_to_ts(now), 'exponent': 0})
+    assert store.get_last_status('rule')['endtime'] == 'new'
+    assert store.get_last_status('other') is None
+    assert store.get_silence('rule._silence')['exponent'] == 2
+
+    # Pending alerts, and aggregations, persist across restarts
+    alert_time = dt_to_ts(now + datetime.timedelta(minutes=10))
+    agg_id = store.index('elastalert', {'rule_name': 'rule', 'alert_time': alert_time, 'alert_sent': False,
+                                        'aggregation_key': 'key', 'match_body': {'n': 0}})['_id']
+    for i in range(1, 5):
+        store.index('elastalert', {'rule_name': 'rule', 'alert_time': alert_time, 'alert_sent': False, 'aggregate_id': agg_id,
+                                   '@timestamp': dt_to_ts(now + datetime.timedelta(seconds=i)), 'match_body': {'n': i}})
+    store.close()
+    store = SQLiteWriteback(path)
+    assert store.find_pending_aggregate_alert('rule', now, 'key')['_id'] == agg_id
+    assert store.find_pending_aggregate_alert('rule', now, 'other') is None
+    pages = list(store.get_aggregated_matches(agg_id, 3))
+    assert [[hit['_source']['match_body']['n'] for hit in page] for page in pages] == [[1, 2, 3], [4]]
+
+    # Only alerts which are due, and not part of an aggregation, are pending
+    assert list(store.find_pending_alerts(now - datetime.timedelta(days=1), now, 3)) == []
+    pages = list(store.find_pending_alerts(now - datetime.timedelta(days=1), now + datetime.timedelta(hours=1), 3))
+    assert [[hit['_id'] for hit in page] for page in pages] == [[agg_id]]
+
+    store.delete([hit['_id'] for hit in pages[0]] + [hit['_id'] for hit in list(store.get_aggregated_matches(agg_id, 10))[0]])
+    assert store.find_pending_aggregate_alert('rule', now) is None
+    assert list(store.get_aggregated_matches(agg_id, 10)) == []
+
+
+def test_sqlite_writeback_prune(tmpdir):
+    store = SQLiteWriteback(str(tmpdir.join('writeback.db')), retention=datetime.timedelta(days=1))
+    store.prune_interval = 7
+    now = ts_now()
+    old = dt_to_ts(now - datetime.timedelta(days=2))
+    store.index('elastalert_status', {'rule_name': 'rule', '@timestamp': old, 'endtime': 'old'})
+    store.index('elastalert_error', {'@timestamp': old, 'message': 'old'})
+    store.index('silence', {'rule_name': 'rule._silence', '@timestamp': old, 'until': old})
+    store.index('silence', {'rule_name': 'other._silence', '@timestamp': old, 'until': dt_to_ts(now + datetime.timedelta(days=1))})
+    store.index('elastalert', {'rule_name': 'rule', '@timestamp': old, 'alert_time': old, 'alert_sent': True})
+    pending_id = store.index('elastalert', {'rule_name': 'rule', '@timestamp': old, 'alert_sent': False,
+                                            'alert_time': dt_to_ts(now + datetime.timedelta(hours=1))})['_id']
+    assert store.get_last_status('rule')['endtime'] == 'old'
+
+    # The seventh write prunes what is older than the retention and no longer needed
+    store.index('elastalert_status', {'rule_name': 'other', '@timestamp': dt_to_ts(now), 'endtime': 'new'})
+    assert store.get_last_status('rule') is None
+    assert store.get_last_status('other')['endtime'] == 'new'
+    assert store.get_silence('rule._silence') is None
+    assert store.get_silence('other._silence') is not None
+    pages = list(store.find_pending_alerts(now - datetime.timedelta(days=3), None, 10))
+    assert [[hit['_id'] for hit in page] for page in pages] == [[pending_id]]
+    with store.lock:
+        assert store.db.execute('SELECT COUNT(*) FROM writeback').fetchone()[0] == 3
+
+
+def test_elasticsearch_writeback():
+    writeback_es = mock.Mock()
+    writeback_es.is_atleastfive.return_value = True
+    writeback_es.is_atleastsix.return_value = True
+    writeback_es.is_atleastsixtwo.return_value = True
+    writeback_es.is_atleastsixsix.return_value = True
+    writeback_es.is_atleastseven.return_value = True
+    writeback_es.is_atleastseventen.return_value = False
+    writeback_es.resolve_writeback_index.side_effect = lambda index, doc_type: '%s_%s' % (index, doc_type)
+    store = ElasticsearchWriteback(writeback_es, 'wb')
+
+    writeback_es.search.return_value = {'hits': {'hits': [{'_id': 'ABCD', '_source': {'endtime': 'then'}}]}}
+    assert store.get_last_status('rule') == {'endtime': 'then'}
+    assert writeback_es.search.call_args[1]['index'] == 'wb_elastalert_status'
+    assert store.find_pending_aggregate_alert('rule', ts_now(), 'key')['_id'] == 'ABCD'
+    writeback_es.search.return_value = {'hits': {'hits': []}}
+    assert store.get_silence('rule._silence') is None
+    assert writeback_es.search.call_args[1]['index'] == 'wb_silence'
+
+    # Pages are fetched with search_after until one is not full
+    writeback_es.search.side_effect = [{'hits': {'hits': [{'_id': 'A', 'sort': [1, 'A']}, {'_id': 'B', 'sort': [2, 'B']}]}},
+                                       {'hits': {'hits': [{'_id': 'C', 'sort': [3, 'C']}]}}]
+    pages = list(store.get_aggregated_matches('ABCD', 2, 100))
+    assert [[hit['_id'] for hit in page] for page in pages] == [['A', 'B'], ['C']]
+    assert writeback_es.search.call_args[1]['body']['search_after'] == [2, 'B']
+    assert writeback_es.search.call_args[1]['size'] == 2
+    assert writeback_es.search.call_args[1]['body']['sort'][1] == {'_id': {'order': 'asc'}}
+
+    writeback_es.bulk.return_value = {'errors': True, 'items': [{'delete': {'_id': 'A', 'status': 200}},
+                                                                {'delete': {'_id': 'B', 'status': 404}},
+                                                                {'delete': {'_id': 'C', 'status': 500}}]}
+    assert store.delete(['A', 'B', 'C']) == [{'_id': 'C', 'status': 500}]
+    assert writeback_es.bulk.call_args[1]['body'][0] == {'delete': {'_index': 'wb', '_id': 'A'}}
+
+
+def test_elasticsearch_writeback_point_in_time():
+    # From Elasticsearch 7.10, pages are searched in a point in time, without sorting on _id
+    writeback_es = mock.Mock()
+    writeback_es.is_atleastseventen.return_value = True
+    writeback_es.is_atleastseventwelve.return_value = True
+    writeback_es.open_point_in_time.return_value = {'id': 'pit0'}
+    writeback_es.search.side_effect = [{'pit_id': 'pit1', 'hits': {'hits': [{'_id': 'A', 'sort': [1, 0]}, {'_id': 'B', 'sort': [1, 1]}]}},
+                                       {'pit_id': 'pit2', 'hits': {'hits': []}}]
+    store = ElasticsearchWriteback(writeback_es, 'wb')
+    pages = list(store.find_pending_alerts(ts_now() - datetime.timedelta(days=1), ts_now(), 2, 1000))
+    assert [[hit['_id'] for hit in page] for page in pages] == [['A', 'B']]
+
+    writeback_es.open_point_in_time.assert_called_once_with(index='wb', keep_alive='1m')
+    first, second = [call[1] for call in writeback_es.search.call_args_list]
+    assert 'index' not in first
+    assert first['body']['pit'] == {'id': 'pit0', 'keep_alive': '1m'}
+    assert first['body']['sort'] == [{'alert_time': {'order': 'asc'}}, {'_shard_doc': {'order': 'asc'}}]
+    assert 'search_after' not in first['body']
+    assert second['body']['pit'] == {'id': 'pit1', 'keep_alive': '1m'}
+    assert second['body']['search_after'] == [1, 1]
+    writeback_es.close_point_in_time.assert_called_once_with(body={'id': 'pit2'})
+
+
+@pytest.mark.parametrize('version, point_in_time, tiebreaker', [
+    ('5.6.0', False, '_uid'),
+    ('6.8.0', False, '_id'),
+    ('7.9.3', False, '_id'),
+    ('7.10.2', True, '_id'),
+    ('7.11.1', True, '_id'),
+    ('7.12.0', True, '_shard_doc'),
+    ('8.1.0', True, '_shard_doc'),
+])
+def test_elasticsearch_writeback_page_query(version, point_in_time, tiebreaker):
+    # _shard_doc only exists from Elasticsearch 7.12, points in time from 7.10
+    major, minor = [int(part) for part in version.split('.')[:2]]
+    writeback_es = mock.Mock()
+    writeback_es.is_atleastfive.return_value = major >= 5
+    writeback_es.is_atleastsix.return_value = major >= 6
+    writeback_es.is_atleastsixtwo.return_value = major >= 6
+    writeback_es.is_atleastseventen.return_value = (major, minor) >= (7, 10)
+    writeback_es.is_atleastseventwelve.return_value = (major, minor) >= (7, 12)
+    writeback_es.open_point_in_time.return_value = {'id': 'pit'}
+    writeback_es.search.return_value = {'hits': {'hits': []}}
+    writeback_es.deprecated_search.return_value = {'hits': {'hits': []}}
+    store = ElasticsearchWriteback(writeback_es, 'wb')
+    assert list(store.get_aggregated_matches('ABCD', 10, 100)) == []
+
+    search = writeback_es.search if major >= 6 else writeback_es.deprecated_search
+    body = search.call_args[1]['body']
+    assert body['sort'] == [{'@timestamp': 'asc'}, {tiebreaker: {'order': 'asc'}}]
+    assert ('pit' in body) == point_in_time
+    assert ('index' in search.call_args[1]) != point_in_time
+
+
+def test_writeback_mirror(tmpdir):
+    writeback_es = mock.Mock()
+    writeback_es.is_atleastsixtwo.return_value = True
+    writeback_es.resolve_writeback_index.side_effect = lambda index, doc_type: '%s_%s' % (index, doc_type)
+    writeback_es.bulk.return_value = {'errors': False}
+    mirror = WritebackMirror(writeback_es, 'wb')
+    store = SQLiteWriteback(str(tmpdir.join('writeback.db')), mirror)
+    doc_id = store.index('silence', {'rule_name': 'rule', 'until': dt_to_ts(ts_now())})['_id']
+    store.delete([doc_id])
+    store.close()
+
+    body = [operation for call in writeback_es.bulk.call_args_list for operation in call[1]['body']]
+    assert body[0] == {'index': {'_index': 'wb_silence', '_id': doc_id}}
+    assert body[1]['rule_name'] == 'rule'
+    assert body[2] == {'delete': {'_index': 'wb', '_id': doc_id}}
+
+
+def test_writeback_mirror_six(tmpdir):
+    # Before Elasticsearch 7, bulk actions need the _doc type of the writeback indices
+    writeback_es = mock.Mock()
+    writeback_es.is_atleastsixtwo.return_value = True
+    writeback_es.is_atleastseven.return_value = False
+    writeback_es.resolve_writeback_index.return_value = 'wb'
+    writeback_es.bulk.return_value = {'errors': False}
+    mirror = WritebackMirror(writeback_es, 'wb')
+    mirror.index('elastalert', 'ABCD', {'rule_name': 'rule'})
+    mirror.delete(['ABCD'])
+    mirror.close()
+
+    body = [operation for call in writeback_es.bulk.call_args_list for operation in call[1]['body']]
+    assert body[0] == {'index': {'_index': 'wb', '_id': 'ABCD', '_type': '_doc'}}
+    assert body[2] == {'delete': {'_index': 'wb', '_id': 'ABCD', '_type': '_doc'}}